@@ -1,16 +1,42 @@
-from flask import Flask, jsonify, request, Response
-from flask_socketio import SocketIO, join_room, leave_room
-from flask_jwt_extended import JWTManager, create_access_token, unset_access_cookies, jwt_required, get_jwt_identity
+import os
+# Make blocking I/O (pymongo sockets, threads) cooperative before anything else imports it,
+# so one slow query does not stall unrelated sockets. gunicorn's eventlet worker does this too.
+if os.getenv('EVENTLET_MONKEY_PATCH', '1') == '1':
+    import eventlet
+    eventlet.monkey_patch()
+from flask import Flask, jsonify, request, Response, g
+from flask_socketio import SocketIO, ConnectionRefusedError, join_room, leave_room
+from flask_jwt_extended import JWTManager, create_access_token, unset_access_cookies, jwt_required, get_jwt_identity, get_jwt, decode_token, verify_jwt_in_request
 from flask_cors import CORS
-from db import get_rooms_from_type,add_room_members, get_all_friends, get_room, get_room_members, get_rooms_for_user, get_user, is_room_member, save_room, save_user,add_a_room_member, remove_a_room_member, direct_room,create_new_chat_room, add_message, get_messages
+from werkzeug.middleware.proxy_fix import ProxyFix
+from db import get_rooms_from_type,add_room_members, bulk_add_room_members, remove_room_members, get_all_friends, get_room, get_room_members, get_rooms_for_user, get_user, is_room_member, save_room, save_user,add_a_room_member, remove_a_room_member, direct_room, direct_rooms,create_new_chat_room, build_message, add_messages, get_messages_page, MESSAGE_PAGE_SIZE, get_cache_stats, ROOM_PAGE_SIZE, FRIEND_PAGE_SIZE, MAX_MESSAGE_PAGE_SIZE, get_messages_since, get_room_summaries, mark_room_read, update_password, revoke_token, get_revoked_tokens, search_messages, SEARCH_PAGE_SIZE, SEARCH_CONTEXT, compact_messages, join_public_room
+from message_writer import MessageWriter, DeadLetterFile
+from compaction import Compactor
+from backplane import socketio_options
+from connections import ConnectionRegistry
+from presence import PresenceTracker
+from recent_messages import RecentMessages, latest_page
+from rate_limit import AttemptLimiter, TokenBucketLimiter
+from backpressure import OutboundLimiter
+from passwords import needs_rehash
+from identity import ClaimsCache, RevocationList
+import time
+import async_db
+import wire
+import metrics
 # from chatRoom import ChatRoom
 from dotenv import load_dotenv
 from datetime import timedelta
-import os
+import atexit
 # Load environment variables from .env file
 load_dotenv()
 app = Flask(__name__)
 CORS(app)
+# Number of reverse proxies in front of the app whose X-Forwarded-For/-Proto/-Host can be
+# trusted; request.remote_addr is then the client's address rather than the proxy's
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', 0))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS, x_host=TRUSTED_PROXY_HOPS)
 app.secret_key = os.getenv('SECRET_KEY')
 
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY')
@@ -19,17 +45,162 @@ app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(minutes=360)
 app.config['JWT_COOKIE_SECURE'] = True
 app.config['JWT_COOKIE_SAMESITE'] = 'None'
 
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Rooms are shared across workers/hosts through the configured message queue (see backplane.py)
+socketio = SocketIO(app, cors_allowed_origins="*", **socketio_options())
 jwt = JWTManager(app)
 
+# Tokens revoked by /logout, checked in memory and shared between workers through the db
+revoked_tokens = RevocationList(revoke_token, get_revoked_tokens,
+                                refresh_interval=float(os.getenv('REVOCATION_REFRESH_INTERVAL', 5)))
+# Socket tokens are verified once and their claims reused for a short time
+socket_claims = ClaimsCache(decode_token, ttl=float(os.getenv('IDENTITY_CACHE_TTL', 60)))
+
+@jwt.token_in_blocklist_loader
+def is_token_revoked(jwt_header, jwt_payload):
+    return revoked_tokens.is_revoked(jwt_payload['jti'])
+
 ##init chatroom
 # chat_room = ChatRoom()
 
+# Batches that still fail after retries are kept on disk for `manage.py replay-messages`
+dead_letters = DeadLetterFile()
+
+def _message_write_failed(batch):
+    try:
+        dead_letters.save(batch)
+    except OSError:
+        metrics.messages_write_failed.inc('lost', amount=len(batch))
+        raise
+    metrics.messages_write_failed.inc('saved', amount=len(batch))
+
+# Messages are persisted in batches behind the broadcast (see MessageWriter)
+message_writer = MessageWriter(add_messages,
+                               batch_size=int(os.getenv('MESSAGE_WRITE_BATCH_SIZE', 100)),
+                               flush_interval=float(os.getenv('MESSAGE_WRITE_FLUSH_INTERVAL', 0.05)),
+                               max_pending=int(os.getenv('MESSAGE_WRITE_MAX_PENDING', 10000)),
+                               on_written=lambda batch: _messages_written(batch),
+                               on_failure=_message_write_failed)
+message_writer.start()
+atexit.register(message_writer.close)
+
+# Newest messages of active rooms, kept to serve the latest history page without a db read.
+# A buffer only sees messages sent through this worker, so with a message queue (several
+# workers) it re-reads the database every RECENT_MESSAGES_TTL seconds (0 never does).
+RECENT_MESSAGES_TTL = float(os.getenv('RECENT_MESSAGES_TTL', 2 if os.getenv('SOCKETIO_MESSAGE_QUEUE') else 0))
+recent_messages = RecentMessages(per_room=int(os.getenv('RECENT_MESSAGES_PER_ROOM', 100)),
+                                 max_bytes=int(os.getenv('RECENT_MESSAGES_MAX_MB', 64)) * 1024 * 1024,
+                                 ttl=RECENT_MESSAGES_TTL or None)
+
+# Apply retention policies and archive old messages this often, in seconds (0 disables).
+# Only the process with COMPACTION_WORKER=1 compacts, so several workers do not race over
+# the same rooms; it defaults to on only without a message queue (a single process).
+COMPACTION_INTERVAL = float(os.getenv('COMPACTION_INTERVAL', 3600))
+COMPACTION_WORKER = os.getenv('COMPACTION_WORKER', '0' if os.getenv('SOCKETIO_MESSAGE_QUEUE') else '1') == '1'
+
+
+def _compact_messages():
+    result = compact_messages()
+    metrics.messages_archived.inc(amount=result['archived'])
+    metrics.messages_expired.inc(amount=result['expired'])
+    # Buffered recent messages may include ones a retention policy just deleted
+    for room_id in result['pruned_rooms']:
+        recent_messages.discard(room_id)
+    return result
+
+
+compactor = Compactor(_compact_messages, COMPACTION_INTERVAL)
+if COMPACTION_WORKER and COMPACTION_INTERVAL:
+    compactor.start()
+    atexit.register(compactor.close)
+
+# Authenticated socket connections and the rooms each one has joined
+connections = ConnectionRegistry()
+# Online and typing state per room, broadcast as coalesced `presence` events
+presence = PresenceTracker(heartbeat_ttl=float(os.getenv('PRESENCE_HEARTBEAT_TTL', 60)),
+                           typing_ttl=float(os.getenv('TYPING_TTL', 5)),
+                           flush_interval=float(os.getenv('PRESENCE_FLUSH_INTERVAL', 0.5)))
+
+# Failed logins allowed per (username, client IP) and per client IP in LOGIN_ATTEMPT_WINDOW
+# seconds, and signups per client IP, so bursts of password hashing cannot starve
+# message delivery. Keying usernames by IP too keeps others from locking a user out.
+LOGIN_ATTEMPT_WINDOW = float(os.getenv('LOGIN_ATTEMPT_WINDOW', 300))
+login_attempts_by_user = AttemptLimiter(int(os.getenv('LOGIN_ATTEMPTS_PER_USER', 5)), LOGIN_ATTEMPT_WINDOW)
+login_attempts_by_ip = AttemptLimiter(int(os.getenv('LOGIN_ATTEMPTS_PER_IP', 20)), LOGIN_ATTEMPT_WINDOW)
+signup_attempts_by_ip = AttemptLimiter(int(os.getenv('SIGNUP_ATTEMPTS_PER_IP', 10)), LOGIN_ATTEMPT_WINDOW)
+
+# send_message rate limits: a burst, then a sustained rate per second, per connection and per room
+message_rate_per_connection = TokenBucketLimiter(float(os.getenv('SEND_RATE_PER_CONNECTION', 5)),
+                                                 float(os.getenv('SEND_BURST_PER_CONNECTION', 10)))
+message_rate_per_room = TokenBucketLimiter(float(os.getenv('SEND_RATE_PER_ROOM', 50)),
+                                           float(os.getenv('SEND_BURST_PER_ROOM', 100)))
+# Outbound packets queued per client before the slow consumer policy applies (0 disables)
+outbound_limiter = OutboundLimiter(int(os.getenv('OUTBOUND_QUEUE_SIZE', 1000)),
+                                   os.getenv('SLOW_CONSUMER_POLICY', 'drop_oldest'),
+                                   on_drop=lambda policy, count: metrics.socketio_events_dropped.inc(policy, amount=count))
+outbound_limiter.install(socketio.server)
+
+def _too_many_attempts(retry_after):
+    res = jsonify({'error': 'Too many attempts, try again later'})
+    res.headers['Retry-After'] = str(int(retry_after) + 1)
+    return res, 429
+
+# Longest message accepted by send_message, in characters
+MAX_MESSAGE_LENGTH = int(os.getenv('MAX_MESSAGE_LENGTH', 4000))
+# Gzip JSON/msgpack responses of at least this many bytes (0 disables)
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+# Let socket clients negotiate compact/msgpack receive_message frames (auth.format)
+COMPACT_SOCKET_FRAMES = os.getenv('COMPACT_SOCKET_FRAMES', '0') == '1'
+
+# Requests and socket events slower than this are logged (unset to disable)
+SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_MS', 0)) / 1000 or None
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+metrics.Gauge('chat_connected_sockets', 'Authenticated Socket.IO connections on this worker', function=connections.count)
+metrics.Gauge('chat_message_write_pending', 'Messages queued for a batched write', function=message_writer.pending)
+metrics.Gauge('chat_recent_messages', 'Recent-message buffer statistics', ['stat'],
+              function=lambda: {(stat,): value for stat, value in recent_messages.stats().items()})
+metrics.Gauge('chat_cache', 'Room/membership cache statistics', ['cache', 'stat'],
+              function=lambda: {(cache, stat): value
+                                for cache, stats in get_cache_stats().items()
+                                for stat, value in stats.items()})
+
+@app.before_request
+def start_request_metrics():
+    g.request_metrics = metrics.begin(request.endpoint or 'unmatched')
+
+@app.after_request
+def record_request_metrics(response):
+    request_metrics = g.pop('request_metrics', None)
+    if request_metrics:
+        elapsed = metrics.end(*request_metrics, slow_threshold=SLOW_REQUEST_SECONDS)
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.http_request_seconds.observe(elapsed, request.method, endpoint, response.status_code)
+    if COMPRESS_MIN_BYTES:
+        response = wire.gzip_response(response, request.headers.get('Accept-Encoding'), COMPRESS_MIN_BYTES)
+    return response
+
+def _room_activity(summary, last_read_seq):
+    last_seq = summary.get('last_seq', 0)
+    last_message = summary.get('last_message')
+    return {
+        'last_seq': last_seq,
+        'unread_count': max(0, last_seq - last_read_seq),
+        'last_message': dict(last_message, created_at=last_message['created_at'].isoformat()) if last_message else None
+    }
+
 @app.route('/',methods=['GET'])
 @jwt_required() 
 def home():
     current_username = get_jwt_identity()
-    rooms = get_rooms_for_user(current_username)
+    # Group rooms come from the user's room_members rows (private ones, and public ones the
+    # user joined) and DMs from the rooms themselves; the two queries run concurrently
+    rooms, direct = async_db.gather(async_db.futures.get_rooms_for_user(current_username),
+                                    async_db.futures.get_direct_rooms_for_user(current_username))
+    member_room_ids = {str(room['_id']['room_id']) for room in rooms}
+    direct = [room for room in direct if str(room['_id']) not in member_room_ids]
+    # Latest sequence number and message preview of every room, and the DMs' read markers
+    summaries, direct_markers = async_db.gather(
+        async_db.futures.get_room_summaries(list(member_room_ids) + [str(room['_id']) for room in direct]),
+        async_db.futures.get_read_markers([room['_id'] for room in direct], current_username))
     # Convert ObjectId to string for JSON serialization
     formatted_rooms = []
     for room in rooms:
@@ -41,6 +212,19 @@ def home():
             'added_at': room['added_at'].isoformat(),
             'is_room_admin': room['is_room_admin']
         }
+        formatted_room.update(_room_activity(summaries.get(room_id_str, {}), room.get('last_read_seq', 0)))
+        formatted_rooms.append(formatted_room)
+    for room in direct:
+        room_id_str = str(room['_id'])
+        formatted_room = {
+            'room_id': room_id_str,
+            'room_name': room['name'],
+            'added_by': room['created_by'],
+            'added_at': room['created_at'].isoformat(),
+            'is_room_admin': False,
+            'direct_to': room['direct_to']
+        }
+        formatted_room.update(_room_activity(summaries.get(room_id_str, {}), direct_markers.get(room_id_str, 0)))
         formatted_rooms.append(formatted_room)
     return jsonify({'username': current_username, 'rooms':formatted_rooms}), 200
 
@@ -52,14 +236,26 @@ def login():
 
     if not username or not password_input:
         return jsonify({'error': 'Invalid credentials'}), 400
+
+    # Throttled attempts are refused before any password hashing is done
+    user_key = (username, request.remote_addr)
+    retry_after = max(login_attempts_by_user.retry_after(user_key), login_attempts_by_ip.retry_after(request.remote_addr))
+    if retry_after:
+        return _too_many_attempts(retry_after)
     
     try:
         user = get_user(username)
         if user and user.check_password(password_input):
+            login_attempts_by_user.reset(user_key)
+            # Upgrade hashes made with an older method while the password is at hand
+            if needs_rehash(user.password):
+                update_password(username, password_input)
             access_token = create_access_token(identity=user.get_id())
             res = jsonify(accessToken=access_token, username=user.get_id())
             return res
         else:
+            login_attempts_by_user.record(user_key)
+            login_attempts_by_ip.record(request.remote_addr)
             return jsonify({'error': 'Failed to login'}), 401
     except Exception as e:
         # Log the error for debugging
@@ -70,6 +266,11 @@ def login():
 @jwt_required() 
 def logout():
     print('Received POST request for /logout')
+    claims = get_jwt()
+    revoked_tokens.revoke(claims['jti'], claims['exp'])
+    # Drop this worker's sockets that authenticated with the revoked token
+    for sid in connections.sids_with_token(claims['jti']):
+        socketio.server.disconnect(sid, namespace='/')
     res = Response(status=204)
     unset_access_cookies(res)
     return res
@@ -80,6 +281,12 @@ def signup():
     username = data.get('username')
     password_input = data.get('password')
 
+    retry_after = signup_attempts_by_ip.retry_after(request.remote_addr)
+    if retry_after:
+        return _too_many_attempts(retry_after)
+    # Every attempt counts: a successful signup hashes a password too
+    signup_attempts_by_ip.record(request.remote_addr)
+
     if not username or not password_input:
         return jsonify({'error': 'Invalid credentials'}), 400
     
@@ -109,16 +316,17 @@ def create_room():
                 room_id = save_room(room_name, room_type, current_username)
                 if current_username in usernames:
                     usernames.remove(current_username)
-                if len(usernames) > 1 or usernames[0] != '':
-                    if room_type == 'PrivateGroup':
-                        add_room_members(room_id, room_name, usernames, current_username)
+                # Blank usernames are skipped; users that cannot be added are reported per user
+                members = None
+                if room_type == 'PrivateGroup':
+                    members = add_room_members(room_id, room_name, usernames, current_username)
 
                 # Create a new chat room
                 # chat_room.create_new_chat_room(room_id)
                 create_new_chat_room(room_id)
 
 
-                return jsonify(room_id=str(room_id))
+                return jsonify(room_id=str(room_id), members=members)
             else:
                 return jsonify({'error': 'Invalid credentials'}), 400
         except ValueError  as e:
@@ -131,7 +339,9 @@ def create_room():
 def view_room(room_id):
     try:
         current_username = get_jwt_identity()
-        room = get_room(room_id)
+        # The room and its members are independent lookups, so run them concurrently
+        room, room_members = async_db.gather(async_db.futures.get_room(room_id),
+                                             async_db.futures.get_room_members(room_id))
 
         if room:
             if room['type'] == 'PrivateGroup':
@@ -149,7 +359,6 @@ def view_room(room_id):
             if room['type'] == 'Direct':
                 formatted_room['direct_to'] = room['direct_to']
             
-            room_members = get_room_members(room_id)
             formatted_room_members = []
             for room_member in room_members:
                 room_id_str = str(room_member['_id']['room_id'])
@@ -177,16 +386,36 @@ def get_chat_room(room_id):
     if not is_room_member(room_id, current_username):
         return jsonify({'error': 'You are not a member of this room.'}), 403
 
-    # Retrieve chat room details from the database
-    room = get_room(room_id)
+    before = request.args.get('before')
+    after = request.args.get('after')
+    limit = min(request.args.get('limit', MESSAGE_PAGE_SIZE, type=int), MAX_MESSAGE_PAGE_SIZE)
+    latest = not before and not after
+
+    # The latest page of an active room is served from its recent-message buffer
+    page = recent_messages.latest(room_id, limit) if latest else None
+    if page is not None:
+        room = get_room(room_id)
+    else:
+        # Retrieve chat room details and one page of chat messages for the room (the most
+        # recent page by default) concurrently
+        # chat_messages = chat_room.get_messages(room_id)
+        try:
+            room, page = async_db.gather(
+                async_db.futures.get_room(room_id),
+                async_db.futures.get_messages_page(room_id, before=before, after=after,
+                                                   limit=max(limit, recent_messages.per_room) if latest else limit))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if latest:
+            # Warm the room's buffer with the wider read (merged with messages still being
+            # written), then answer with the requested size
+            recent_messages.warm(room_id, page)
+            page = (recent_messages.latest(room_id, limit)
+                    or latest_page(page['messages'], max(1, limit), not page['has_more']))
     if not room:
         return jsonify({'error': 'Chat room not found.'}), 404
 
-    # Retrieve chat messages for the room
-    # chat_messages = chat_room.get_messages(room_id)
-    chat_messages = get_messages(room_id)
-
-
+    wire_format = wire.negotiate(request.args.get('format'), request.headers.get('Accept'))
     # Format room data and messages for response
     formatted_room = {
         '_id': str(room['_id']),
@@ -194,13 +423,71 @@ def get_chat_room(room_id):
         'type': room['type'],
         'created_by': room['created_by'],
         'created_at': room['created_at'].isoformat(),
-        'chat_messages': chat_messages
+        'chat_messages': wire.encode_messages(page['messages'], wire_format),
+        'paging': {
+            'before': page['before'],
+            'after': page['after'],
+            'has_more': page['has_more']
+        }
     }
     # Check if the room type is "Direct" and include the direct_to field
     if room['type'] == 'Direct':
         formatted_room['direct_to'] = room['direct_to']
 
-    return jsonify(formatted_room), 200
+    return wire.response(formatted_room, wire_format)
+
+
+@app.route('/chatRoom/<room_id>/since/<int:seq>', methods=['GET'])
+@jwt_required()
+def get_chat_room_since(room_id, seq):
+    current_username = get_jwt_identity()
+
+    # Check if the user is a member of the requested room
+    try:
+        if not is_room_member(room_id, current_username):
+            return jsonify({'error': 'You are not a member of this room.'}), 403
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+
+    limit = min(request.args.get('limit', MESSAGE_PAGE_SIZE, type=int), MAX_MESSAGE_PAGE_SIZE)
+    wire_format = wire.negotiate(request.args.get('format'), request.headers.get('Accept'))
+    page = _messages_since(room_id, seq, limit)
+    return wire.response(dict(page, messages=wire.encode_messages(page['messages'], wire_format)), wire_format)
+
+
+@app.route('/chatRoom/<room_id>/search', methods=['GET'])
+@jwt_required()
+def search_chat_room(room_id):
+    current_username = get_jwt_identity()
+
+    # Check if the user is a member of the requested room
+    try:
+        if not is_room_member(room_id, current_username):
+            return jsonify({'error': 'You are not a member of this room.'}), 403
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+
+    text = request.args.get('q', '').strip()
+    if not text:
+        return jsonify({'error': 'Missing search text (q).'}), 400
+    results = search_messages(room_id, text,
+                              sender=request.args.get('sender'),
+                              offset=request.args.get('offset', 0, type=int),
+                              limit=request.args.get('limit', SEARCH_PAGE_SIZE, type=int),
+                              context=request.args.get('context', SEARCH_CONTEXT, type=int))
+    return jsonify(results), 200
+
+
+@app.route('/chatRoom/<room_id>/read', methods=['POST'])
+@jwt_required()
+def mark_chat_room_read(room_id):
+    current_username = get_jwt_identity()
+    seq = (request.get_json(silent=True) or {}).get('seq')
+    if not isinstance(seq, int):
+        return jsonify({'error': 'seq must be an integer.'}), 400
+    if not mark_room_read(room_id, current_username, seq):
+        return jsonify({'error': 'You are not a member of this room.'}), 403
+    return jsonify({'room_id': room_id, 'last_read_seq': seq}), 200
 
 
 @app.route('/friends', methods=['GET'])
@@ -209,11 +496,12 @@ def get_friends():
     try:
         # Get the current user's identity from the JWT token
         current_username = get_jwt_identity()
-        # Retrieve the list of friends for the current user
-        friends = get_all_friends(current_username)
-        
-        # Return the list of friends as a JSON response
-        return jsonify({'friends': friends}), 200
+        # Retrieve one page of friends for the current user; 'next' is the cursor for the next page
+        page = get_all_friends(current_username,
+                               prefix=request.args.get('prefix'),
+                               after=request.args.get('after'),
+                               limit=request.args.get('limit', FRIEND_PAGE_SIZE, type=int))
+        return jsonify(page), 200
     except Exception as e:
         # Handle any exceptions and return an error response
         return jsonify({'error': str(e)}), 500
@@ -223,7 +511,9 @@ def get_friends():
 def get_room_list(room_type):
     try:
         username = get_jwt_identity()
-        rooms_list = get_rooms_from_type(room_type, username)
+        rooms_list = get_rooms_from_type(room_type, username,
+                                         after=request.args.get('after'),
+                                         limit=request.args.get('limit', ROOM_PAGE_SIZE, type=int))
         return rooms_list
     except Exception as e:
         # Handle any exceptions and return an error response
@@ -244,7 +534,61 @@ def add_member(room_id,username):
 def remove_member(room_id,username):
     try:
         remove_by = get_jwt_identity()
-        return remove_a_room_member(room_id, remove_by, username)
+        response, status = remove_a_room_member(room_id, remove_by, username)
+        if status == 200:
+            _unsubscribe_from_room(room_id, username)
+        return response, status
+    except Exception as e:
+        # Handle any exceptions and return an error response
+        return jsonify({'error': str(e)}), 500
+
+def _request_usernames():
+    # Usernames from a JSON body {"usernames": [...]} or {"usernames": "a, b"}
+    usernames = (request.get_json(silent=True) or {}).get('usernames') or []
+    if isinstance(usernames, str):
+        usernames = usernames.split(',')
+    return [str(username).strip() for username in usernames]
+
+def _unsubscribe_from_room(room_id, username):
+    # Every worker unsubscribes the removed user's sockets (see backplane.ControlChannel)
+    socketio.server.manager.publish_control('unsubscribe', {'room': room_id, 'username': username})
+
+def _unsubscribe_local(data):
+    # Unsubscribe a removed user's sockets on this worker from the room
+    room_id, username = data['room'], data['username']
+    for sid in connections.sids_in_room(room_id, username):
+        connection = connections.get(sid)
+        if connection:
+            socketio.server.leave_room(sid, connection.socket_room(room_id), namespace='/')
+            socketio.server.leave_room(sid, _seqs_room(room_id), namespace='/')
+        connections.leave(sid, room_id)
+        presence.leave(sid, room_id)
+
+socketio.server.manager.on_control('unsubscribe', _unsubscribe_local)
+
+@app.route('/rooms/<room_id>/add_members', methods=['POST'])
+@jwt_required()
+def add_members(room_id):
+    try:
+        added_by = get_jwt_identity()
+        return jsonify(bulk_add_room_members(room_id, _request_usernames(), added_by)), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        # Handle any exceptions and return an error response
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/rooms/<room_id>/remove_members', methods=['POST'])
+@jwt_required()
+def remove_members(room_id):
+    try:
+        remove_by = get_jwt_identity()
+        result = remove_room_members(room_id, remove_by, _request_usernames())
+        for username in result['removed']:
+            _unsubscribe_from_room(room_id, username)
+        return jsonify(result), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         # Handle any exceptions and return an error response
         return jsonify({'error': str(e)}), 500
@@ -267,36 +611,281 @@ def find_direct_room(friendname):
     # Handle any other exceptions and return an error response
         return jsonify({'error': str(e)}), 500
 
+@app.route('/rooms/<room_id>/presence', methods=['GET'])
+@jwt_required()
+def get_room_presence(room_id):
+    # Served from memory: a user with a socket in the room is known to be a member,
+    # anyone else is checked against the (cached) membership
+    username = get_jwt_identity()
+    try:
+        if not connections.sids_in_room(room_id, username) and not is_room_member(room_id, username):
+            return jsonify({'error': 'You are not a member of this room.'}), 403
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+    return jsonify(presence.snapshot(room_id)), 200
+
+@app.route('/rooms/direct', methods=['POST'])
+@jwt_required()
+def find_direct_rooms():
+    # Resolve the DM rooms for a whole contact list in one call
+    try:
+        return jsonify(direct_rooms(get_jwt_identity(), _request_usernames())), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus scrape endpoint; protected by a static bearer token when METRICS_TOKEN is set
+    if METRICS_TOKEN and request.headers.get('Authorization') != 'Bearer ' + METRICS_TOKEN:
+        return jsonify({'error': 'Unauthorized'}), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/stats/cache', methods=['GET'])
+@jwt_required()
+def cache_stats():
+    return jsonify(get_cache_stats()), 200
+
 ##############################################################    
 # socket programming...
 ##############################################################
 
+def _socket_claims(auth):
+    # Token from the Socket.IO auth payload or ?token=, otherwise the usual header/cookie
+    token = (auth or {}).get('token') or request.args.get('token')
+    if token:
+        claims = socket_claims.claims(token)
+        if revoked_tokens.is_revoked(claims['jti']):
+            raise ValueError('Token has been revoked')
+        return claims
+    verify_jwt_in_request()
+    return get_jwt()
+
+def _event_data(data):
+    # Event payloads come straight from the client; anything but an object is ignored
+    return data if isinstance(data, dict) else {}
+
+def _connection():
+    # The current socket's connection, checked against token expiry and revocation in memory
+    connection = connections.get(request.sid)
+    if connection is None:
+        return None
+    if (connection.expires_at and connection.expires_at <= time.time()) or revoked_tokens.is_revoked(connection.jti):
+        socketio.server.disconnect(request.sid, namespace='/')
+        return None
+    return connection
+
+@socketio.on('connect')
+@metrics.timed_event('connect', SLOW_REQUEST_SECONDS)
+def handle_connect_event(auth=None):
+    try:
+        claims = _socket_claims(auth)
+    except Exception as e:
+        app.logger.info("Rejected socket connection: {}".format(e))
+        raise ConnectionRefusedError('unauthorized')
+    wire_format = wire.negotiate((auth or {}).get('format')) if COMPACT_SOCKET_FRAMES else 'json'
+    connections.add(request.sid, claims[app.config['JWT_IDENTITY_CLAIM']], claims.get('jti'), claims.get('exp'), wire_format)
+    presence.connect(request.sid, claims[app.config['JWT_IDENTITY_CLAIM']])
+
+@socketio.on('disconnect')
+@metrics.timed_event('disconnect', SLOW_REQUEST_SECONDS)
+def handle_disconnect_event():
+    connections.remove(request.sid)
+    presence.disconnect(request.sid)
+    message_rate_per_connection.discard(request.sid)
+
 @socketio.on('send_message')
+@metrics.timed_event('send_message', SLOW_REQUEST_SECONDS)
 def handle_send_message_event(data):
-    room_id = data['room']
-    sender = data['username']
-    message = data['message']
+    connection = _connection()
+    data = _event_data(data)
+    room_id = data.get('room')
+    # Only rooms the server has joined this connection to (membership was checked then)
+    if connection is None or room_id not in connection.rooms:
+        return {'error': 'You have not joined this room.'}
+    message = data.get('message')
+    if not isinstance(message, str) or not message.strip() or len(message) > MAX_MESSAGE_LENGTH:
+        return {'error': 'The message must be non-empty text of at most {} characters.'.format(MAX_MESSAGE_LENGTH)}
+    for scope, limiter, key in (('connection', message_rate_per_connection, request.sid),
+                                ('room', message_rate_per_room, room_id)):
+        retry_after = limiter.acquire(key)
+        if retry_after:
+            metrics.socketio_events_throttled.inc(scope)
+            return {'error': 'Too many messages.', 'retry_after': round(retry_after, 3)}
+    sender = connection.username
+    # Sending counts as a heartbeat and ends the sender's typing indicator
+    presence.typing(request.sid, room_id, False)
     
-    # Add the message to the chat room
-    # chat_room.add_message(room_id, sender, message)
-    add_message(room_id, sender, message)
+    message_document = build_message(room_id, sender, message)
+    # The sequence number is assigned when the message is written (see _messages_written)
+    recent_messages.add(room_id, {
+        'id': str(message_document['_id']),
+        'seq': None,
+        'sender': sender,
+        'message': message,
+        'created_at': message_document['created_at']
+    })
     
-    # Broadcast the message to all clients in the room
-    socketio.emit('receive_message', data, room=room_id)
-
-
-# @socketio.on('join_room')
-# def handle_join_room_event(data):
-#     app.logger.info("{} has joined the room {}".format(data['username'], data['room']))
-#     join_room(data['room'])
-#     socketio.emit('join_room_announcement', data, room=data['room'])
-
+    # Broadcast the message to all clients in the room, in each client's wire format
+    payload = {
+        'room': room_id,
+        'id': str(message_document['_id']),
+        'username': sender,
+        'message': message
+    }
+    targets = _room_targets(room_id)
+    local_rooms = socketio.server.manager.rooms.get('/', {})
+    metrics.broadcast_fanout.observe(sum(len(local_rooms.get(target, ())) for target, _ in targets))
+    for target, wire_format in targets:
+        socketio.emit('receive_message', wire.broadcast_frame(payload, wire_format), room=target)
 
-# @socketio.on('leave_room')
-# def handle_leave_room_event(data):
-#     app.logger.info("{} has left the room {}".format(data['username'], data['room']))
-#     leave_room(data['room'])
-#     socketio.emit('leave_room_announcement', data, room=data['room'])
+    # Queue the message for a batched write to the chat room
+    # chat_room.add_message(room_id, sender, message)
+    message_writer.submit(message_document)
+    return {'ok': True, 'id': str(message_document['_id'])}
+
+
+def _messages_written(batch):
+    # Tell each room which sequence numbers its newly written messages got, so clients
+    # can keep a `since` cursor, and number the buffered copies
+    seqs = {}
+    for message in batch:
+        seqs.setdefault(message['room_id'], {})[str(message['_id'])] = message['seq']
+    for room_id, room_seqs in seqs.items():
+        recent_messages.sequenced(room_id, room_seqs)
+        update = {'room': room_id, 'seqs': room_seqs, 'last_seq': max(room_seqs.values())}
+        socketio.emit('message_seqs', update, room=_seqs_room(room_id))
+
+
+def _seqs_room(room_id):
+    # Socket.IO room of the sockets that joined a chat room with `seqs` (see join_room): an
+    # announcement per write batch is a second fan-out, paid only by clients that keep a cursor
+    return 'seqs:{}'.format(room_id)
+
+
+def _room_targets(room_id):
+    # (Socket.IO room, wire format) pairs that together reach every client in a chat room
+    targets = [(room_id, 'json')]
+    if COMPACT_SOCKET_FRAMES:
+        targets += [('{}:{}'.format(wire_format, room_id), wire_format) for wire_format in ('compact', 'msgpack')]
+    return targets
+
+
+def _emit_presence(room_id, update):
+    for target, _ in _room_targets(room_id):
+        socketio.emit('presence', update, room=target)
+
+
+presence.start(_emit_presence)
+atexit.register(presence.close)
+
+
+@socketio.on('heartbeat')
+@metrics.timed_event('heartbeat', SLOW_REQUEST_SECONDS)
+def handle_heartbeat_event(data=None):
+    if _connection() is None:
+        return {'error': 'Not authenticated.'}
+    presence.heartbeat(request.sid)
+    return {'ok': True}
+
+
+@socketio.on('typing')
+@metrics.timed_event('typing', SLOW_REQUEST_SECONDS)
+def handle_typing_event(data):
+    connection = _connection()
+    data = _event_data(data)
+    room_id = data.get('room')
+    if connection is None or room_id not in connection.rooms:
+        return {'error': 'You have not joined this room.'}
+    presence.typing(request.sid, room_id, bool(data.get('typing', True)))
+    return {'ok': True}
+
+
+@socketio.on('mark_read')
+@metrics.timed_event('mark_read', SLOW_REQUEST_SECONDS)
+def handle_mark_read_event(data):
+    connection = _connection()
+    data = _event_data(data)
+    room_id = data.get('room')
+    if connection is None or room_id not in connection.rooms:
+        return {'error': 'You have not joined this room.'}
+    if not isinstance(data.get('seq'), int):
+        return {'error': 'seq must be an integer.'}
+    if not mark_room_read(room_id, connection.username, data['seq']):
+        return {'error': 'You are not a member of this room.'}
+    return {'ok': True}
+
+
+def _messages_since(room_id, seq, limit):
+    # Recently active rooms are answered from the recent-message buffer
+    return recent_messages.since(room_id, seq, limit) or get_messages_since(room_id, seq, limit)
+
+
+@socketio.on('sync')
+@metrics.timed_event('sync', SLOW_REQUEST_SECONDS)
+def handle_sync_event(data):
+    connection = _connection()
+    data = _event_data(data)
+    room_id = data.get('room')
+    if connection is None or room_id not in connection.rooms:
+        return {'error': 'You have not joined this room.'}
+    try:
+        since = int(data.get('since', 0))
+        limit = min(int(data.get('limit', MESSAGE_PAGE_SIZE)), MAX_MESSAGE_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return {'error': 'Invalid sync request.'}
+    try:
+        page = _messages_since(room_id, since, limit)
+    except ValueError as e:
+        return {'error': str(e)}
+    # Copy the messages, since buffered ones are shared with the recent-message buffer
+    page['messages'] = [dict(message, created_at=message['created_at'].isoformat()) for message in page['messages']]
+    return page
+
+
+@socketio.on('join_room')
+@metrics.timed_event('join_room', SLOW_REQUEST_SECONDS)
+def handle_join_room_event(data):
+    connection = _connection()
+    data = _event_data(data)
+    room_id = data.get('room')
+    if connection is None:
+        return {'error': 'Not authenticated.'}
+    try:
+        if not is_room_member(room_id, connection.username):
+            return {'error': 'You are not a member of this room.'}
+    except Exception as e:
+        return {'error': str(e)}
+    # Joining a public room adds it to the user's rooms on / (written on the first join only)
+    join_public_room(room_id, connection.username)
+    app.logger.info("{} has joined the room {}".format(connection.username, room_id))
+    join_room(connection.socket_room(room_id))
+    if data.get('seqs'):
+        join_room(_seqs_room(room_id))
+    connections.join(request.sid, room_id)
+    presence.join(request.sid, room_id)
+    for target, _ in _room_targets(room_id):
+        socketio.emit('join_room_announcement', {'username': connection.username, 'room': room_id}, room=target)
+    return {'ok': True}
+
+
+@socketio.on('leave_room')
+@metrics.timed_event('leave_room', SLOW_REQUEST_SECONDS)
+def handle_leave_room_event(data):
+    connection = _connection()
+    data = _event_data(data)
+    room_id = data.get('room')
+    if connection is None or room_id not in connection.rooms:
+        return {'error': 'You have not joined this room.'}
+    app.logger.info("{} has left the room {}".format(connection.username, room_id))
+    leave_room(connection.socket_room(room_id))
+    leave_room(_seqs_room(room_id))
+    connections.leave(request.sid, room_id)
+    presence.leave(request.sid, room_id)
+    for target, _ in _room_targets(room_id):
+        socketio.emit('leave_room_announcement', {'username': connection.username, 'room': room_id}, room=target)
+    return {'ok': True}
 
 if __name__ == '__main__':
     socketio.run(app, host='0.0.0.0')
@@ -0,0 +1,78 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import asyncio
+import contextvars
+import functools
+import os
+
+import db
+import embedded
+
+# Size of the pool db calls run on. Under eventlet's monkey patching these are green
+# threads, so a slow query only parks its own green thread. 0 runs every call inline:
+# the default for the embedded engine, which answers from memory while holding the GIL,
+# so a pool cannot overlap its queries and the hand-offs only add latency.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 0 if isinstance(db.chat_db, embedded.Database) else 32))
+
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='db') if DB_POOL_SIZE else None
+
+
+def _run_inline(call):
+    # A completed Future, so gather() treats inline calls like pooled ones
+    future = Future()
+    try:
+        future.set_result(call())
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+class _FutureOperations:
+    """
+    Every db.py operation, returning a concurrent.futures.Future instead of blocking:
+    `futures.get_room(room_id)` starts the query and returns at once.
+    """
+
+    def __getattr__(self, name):
+        operation = getattr(db, name)
+        if not callable(operation):
+            raise AttributeError(name)
+
+        def submit(*args, **kwargs):
+            if _executor is None:
+                return _run_inline(functools.partial(operation, *args, **kwargs))
+            # Run in a copy of the caller's context so per-request accounting follows the query
+            return _executor.submit(contextvars.copy_context().run, operation, *args, **kwargs)
+        return submit
+
+
+class _AsyncOperations:
+    """
+    Every db.py operation as a coroutine for asyncio servers (e.g. socketio.AsyncServer):
+    `await aio.get_room(room_id)`.
+    """
+
+    def __getattr__(self, name):
+        operation = getattr(db, name)
+        if not callable(operation):
+            raise AttributeError(name)
+
+        async def run(*args, **kwargs):
+            if _executor is None:
+                return operation(*args, **kwargs)
+            loop = asyncio.get_running_loop()
+            call = functools.partial(contextvars.copy_context().run, operation, *args, **kwargs)
+            return await loop.run_in_executor(_executor, call)
+        return run
+
+
+futures = _FutureOperations()
+aio = _AsyncOperations()
+
+
+def gather(*pending):
+    """
+    Wait for futures started with `futures.<operation>(...)` and return their results
+    in order, so a handler waits for its slowest query rather than the sum of them.
+    The first exception raised by any of them is re-raised.
+    """
+    return [future.result() for future in pending]
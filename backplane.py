@@ -0,0 +1,125 @@
+import os
+import pickle
+import queue
+import threading
+
+import socketio
+
+
+# Prefix of the reserved event names control messages travel under
+CONTROL_PREFIX = 'chat-control:'
+
+
+class ControlChannel:
+    """
+    Mixin for Socket.IO client managers that delivers control messages (such as "this
+    user was removed from that room") to every worker's server instead of to clients.
+    Over a pub/sub backplane they travel as emits of reserved event names, and each
+    worker, the sender included, runs the handler registered with on_control().
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.control_handlers = {}
+
+    def on_control(self, name, handler):
+        self.control_handlers[CONTROL_PREFIX + name] = handler
+
+    def publish_control(self, name, data):
+        if isinstance(self, socketio.PubSubManager):
+            # Handled in this worker and published to the others, like any emit
+            self.emit(CONTROL_PREFIX + name, data, namespace='/')
+        else:
+            self.control_handlers[CONTROL_PREFIX + name](data)
+
+    def _handle_emit(self, message):
+        handler = self.control_handlers.get(message.get('event'))
+        if handler is None:
+            return super()._handle_emit(message)
+        handler(message.get('data'))
+
+
+class ControlManager(ControlChannel, socketio.Manager):
+    """
+    Client manager for a single process without a backplane.
+    """
+
+
+class LocalPubSubManager(ControlChannel, socketio.PubSubManager):
+    """
+    In-process Socket.IO client manager.
+
+    Every manager created with the same channel in this process shares one pub/sub
+    bus, so several SocketIO servers can share rooms the same way they would through
+    Redis or AMQP, without an outside broker. Messages are pickled on publish so
+    subscribers never share objects with the sender, like a real broker.
+    """
+    name = 'local'
+
+    _subscribers = {}
+    _lock = threading.Lock()
+
+    def _publish(self, data):
+        message = pickle.dumps(data)
+        with self._lock:
+            subscribers = list(self._subscribers.get(self.channel, []))
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+    def _listen(self):
+        subscriber = queue.Queue()
+        with self._lock:
+            self._subscribers.setdefault(self.channel, []).append(subscriber)
+        try:
+            while True:
+                yield subscriber.get()
+        finally:
+            with self._lock:
+                self._subscribers[self.channel].remove(subscriber)
+
+
+def _queue_manager(url, channel):
+    # The message queue Flask-SocketIO would pick for the URL, with the control channel added
+    if url.startswith(('redis://', 'rediss://')):
+        queue_class = socketio.RedisManager
+    elif url.startswith('kafka://'):
+        queue_class = socketio.KafkaManager
+    elif url.startswith('zmq'):
+        queue_class = socketio.ZmqManager
+    else:
+        queue_class = socketio.KombuManager
+    manager_class = type('Control' + queue_class.__name__, (ControlChannel, queue_class), {})
+    return manager_class(url, channel=channel)
+
+
+def socketio_options():
+    """
+    Build the SocketIO keyword arguments for the configured backplane.
+
+    SOCKETIO_MESSAGE_QUEUE selects how workers share rooms:
+      - unset: single process, no backplane
+      - local:// : LocalPubSubManager (one process, several servers, e.g. tests)
+      - redis://..., amqp://..., kafka://...: Flask-SocketIO message queue
+    SOCKETIO_CHANNEL names the pub/sub channel. SOCKETIO_TRANSPORTS (e.g. "websocket")
+    restricts transports; websocket-only clients need no sticky sessions behind a
+    load balancer, while long-polling needs the balancer to pin each client to a worker.
+    """
+    options = {}
+    message_queue = os.getenv('SOCKETIO_MESSAGE_QUEUE')
+    channel = os.getenv('SOCKETIO_CHANNEL', 'flask-socketio')
+    # Every manager carries the control channel (see ControlChannel)
+    if message_queue == 'local://':
+        options['client_manager'] = LocalPubSubManager(channel=channel)
+    elif message_queue:
+        options['client_manager'] = _queue_manager(message_queue, channel)
+    else:
+        options['client_manager'] = ControlManager()
+    # Long-polling responses above this size are gzip/deflate compressed; websocket
+    # frames use permessage-deflate when the client offers it (eventlet negotiates it)
+    compression_threshold = os.getenv('SOCKETIO_COMPRESSION_THRESHOLD')
+    if compression_threshold:
+        options['compression_threshold'] = int(compression_threshold)
+    transports = os.getenv('SOCKETIO_TRANSPORTS')
+    if transports:
+        options['transports'] = [transport.strip() for transport in transports.split(',')]
+    return options
@@ -0,0 +1,194 @@
+from contextlib import nullcontext
+import json
+import logging
+import re
+
+from engineio import packet as eio_packet
+import msgpack
+from socketio import packet as sio_packet
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ('drop_oldest', 'coalesce', 'disconnect')
+
+# Header of a binary event on the default namespace without an ack id ('5<attachments>-[...]')
+_BINARY_EVENT = re.compile(r'5(\d+)-\[')
+
+
+def _binary_attachments(pkt):
+    # Number of attachment packets that follow a droppable binary event header, else None
+    if pkt is not None and pkt.packet_type == eio_packet.MESSAGE and isinstance(pkt.data, str) \
+            and pkt.data.startswith('5'):
+        match = _BINARY_EVENT.match(pkt.data)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def _is_droppable(pkt):
+    # Socket.IO events on the default namespace without an ack id: plain ('2[...]') or the
+    # header of a binary event, which is dropped together with its attachments as one unit.
+    # Acks and connect/disconnect packets are kept.
+    return pkt is not None and pkt.packet_type == eio_packet.MESSAGE and isinstance(pkt.data, str) \
+        and (pkt.data.startswith('2[') or _binary_attachments(pkt) is not None)
+
+
+def _event_rooms(pkt, *attachments):
+    try:
+        event = json.loads(pkt.data[pkt.data.index('['):])
+    except ValueError:
+        return []
+    payload = event[1] if len(event) > 1 else None
+    if isinstance(payload, dict) and payload.get('_placeholder'):
+        # A msgpack receive_message frame is sent as a binary attachment
+        try:
+            payload = msgpack.unpackb(attachments[payload['num']].data)
+        except (IndexError, KeyError, TypeError, ValueError):
+            return []
+    if isinstance(payload, dict):
+        if payload.get('room'):
+            return [payload['room']]
+        # An earlier resync lists its rooms
+        return payload.get('rooms') or []
+    if isinstance(payload, list) and payload and isinstance(payload[0], str):
+        # Compact receive_message frames start with the room id (see wire.BROADCAST_COLUMNS)
+        return [payload[0]]
+    return []
+
+
+class OutboundLimiter:
+    """
+    Bounds every client's Engine.IO outbound queue at `max_queue` packets, so a slow
+    receiver cannot make the server buffer without limit. When a client's queue is
+    full, `policy` decides what happens:
+      - drop_oldest: the oldest queued event is discarded to make room
+      - coalesce: every queued event is replaced by one `resync` event listing the
+        rooms they were for, and the client catches up with `sync` / `/since/<seq>`
+      - disconnect: the client is disconnected and reconnects (then syncs) later
+    A binary event (a header packet followed by its attachments) counts as one event.
+    `on_drop(policy, count)` is called with the number of events discarded.
+    """
+
+    def __init__(self, max_queue=1000, policy='drop_oldest', on_drop=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown slow consumer policy '{}' (expected one of {})".format(policy, ', '.join(POLICIES)))
+        self.max_queue = max_queue
+        self.policy = policy
+        self.on_drop = on_drop
+        self.server = None
+        self._send_packet = None
+        self._disconnecting = set()
+        # sid -> [packets in the binary event, packets collected so far]
+        self._binary = {}
+
+    def install(self, server):
+        """
+        Route every packet `server` (a socketio.Server) sends through this limiter.
+        Nothing is installed when `max_queue` is 0 (no limit).
+        """
+        if not self.max_queue:
+            return
+        self.server = server
+        self._send_packet = server.eio.send_packet
+        server.eio.send_packet = self.send_packet
+
+    def send_packet(self, sid, pkt):
+        # Runs for every packet to every client: the common case, a text packet with no
+        # binary event being collected, must not parse the packet
+        pending = self._binary.get(sid) if self._binary else None
+        if pending is not None:
+            # An attachment of the binary event being collected
+            pending[1].append(pkt)
+            if len(pending[1]) < pending[0]:
+                return
+            del self._binary[sid]
+            return self._limit(sid, pending[1])
+        attachments = _binary_attachments(pkt)
+        if attachments:
+            # Python-socketio sends the attachments right after the header; the event is
+            # sent or dropped once all of them are here
+            self._binary[sid] = [1 + attachments, [pkt]]
+            return
+        self._limit(sid, [pkt])
+
+    def _limit(self, sid, event):
+        # `event` is a list of packets sent or dropped together
+        socket = self.server.eio.sockets.get(sid)
+        if socket is None or socket.queue.qsize() < self.max_queue:
+            return self._send(sid, event)
+        if self.policy == 'drop_oldest':
+            self._drop_oldest(sid, socket, event)
+        elif self.policy == 'coalesce':
+            self._coalesce(sid, socket, event)
+        else:
+            self._disconnect(sid, event)
+
+    def _send(self, sid, event):
+        for pkt in event:
+            self._send_packet(sid, pkt)
+
+    def _dropped(self, count):
+        if count and self.on_drop:
+            self.on_drop(self.policy, count)
+
+    def _remove_queued(self, socket, limit=None):
+        # Take droppable events out of the socket's queue, oldest first, each as a list of
+        # its packets (a binary event header is followed by its attachments)
+        queue = socket.queue
+        removed = []
+        with getattr(queue, 'mutex', nullcontext()):
+            kept = list(queue.queue)
+            queue.queue.clear()
+            index = 0
+            while index < len(kept):
+                event = kept[index:index + 1 + (_binary_attachments(kept[index]) or 0)]
+                index += len(event)
+                if _is_droppable(event[0]) and (limit is None or len(removed) < limit):
+                    removed.append(event)
+                else:
+                    queue.queue.extend(event)
+        for _ in range(sum(len(event) for event in removed)):
+            queue.task_done()
+        return removed
+
+    def _drop_oldest(self, sid, socket, event):
+        if self._remove_queued(socket, limit=1):
+            self._send(sid, event)
+        elif not _is_droppable(event[0]):
+            # Only acks and control packets are queued; those are never dropped
+            return self._send(sid, event)
+        # Otherwise the new event is the one dropped
+        self._dropped(1)
+
+    def _coalesce(self, sid, socket, event):
+        removed = self._remove_queued(socket)
+        if _is_droppable(event[0]):
+            removed.append(event)
+        else:
+            self._send(sid, event)
+        if not removed:
+            return
+        rooms = list(dict.fromkeys(room for removed_event in removed for room in _event_rooms(*removed_event)))
+        resync = sio_packet.Packet(sio_packet.EVENT, data=['resync', {'rooms': rooms}], namespace='/')
+        self._send_packet(sid, eio_packet.Packet(eio_packet.MESSAGE, data=resync.encode()))
+        self._dropped(len(removed))
+
+    def _disconnect(self, sid, event):
+        if not _is_droppable(event[0]):
+            # e.g. the disconnect packet itself
+            return self._send(sid, event)
+        if sid not in self._disconnecting:
+            self._disconnecting.add(sid)
+            logger.warning("Disconnecting slow consumer %s", sid)
+            self.server.start_background_task(self._close, sid)
+        self._dropped(1)
+
+    def _close(self, sid):
+        try:
+            socketio_sid = self.server.manager.sid_from_eio_sid(sid, '/')
+            if socketio_sid:
+                self.server.disconnect(socketio_sid, namespace='/')
+            else:
+                self.server.eio.disconnect(sid)
+        finally:
+            self._disconnecting.discard(sid)
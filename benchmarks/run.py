@@ -0,0 +1,212 @@
+"""
+Benchmark harness for the chat server.
+
+Drives the REST endpoints and many concurrent Socket.IO clients in-process against the
+embedded storage engine (see storage.py) or a real MongoDB, then reports p50/p99 latency, messages/sec and memory per
+connection. Every benchmark runs --runs times and each figure is the median across runs.
+Results can be saved as a baseline and later checked for regressions:
+
+    python benchmarks/run.py                      # embedded in-memory engine
+    python benchmarks/run.py --storage-url sqlite:///bench.db
+    python benchmarks/run.py --mongo-uri mongodb://localhost:27017
+    python benchmarks/run.py --save-baseline      # write benchmarks/baseline.json
+    python benchmarks/run.py --check              # exit 1 if p50 or messages/sec regressed
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Chat server benchmarks')
+    parser.add_argument('--storage-url', default='memory://', help='Storage backend URL (see storage.py)')
+    parser.add_argument('--mongo-uri', help='Benchmark against this MongoDB instead of --storage-url')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--history', type=int, default=500, help='Messages preloaded in the benchmark room')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per REST endpoint')
+    parser.add_argument('--clients', type=int, default=100, help='Concurrent Socket.IO clients')
+    parser.add_argument('--messages', type=int, default=20, help='send_message events per client')
+    parser.add_argument('--runs', type=int, default=3, help='Runs per benchmark; results are the median')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true', help='Compare against the saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown before --check fails')
+    return parser.parse_args()
+
+
+def load_app(storage_url):
+    # Configure the app for an in-process run before it is imported
+    os.environ['EVENTLET_MONKEY_PATCH'] = '0'
+    os.environ.pop('SOCKETIO_MESSAGE_QUEUE', None)
+    os.environ.setdefault('JWT_SECRET_KEY', 'benchmark-secret-key-benchmark-secret')
+    os.environ['STORAGE_URL'] = storage_url
+    # Every client sends as fast as it can, so the send rate limits would measure the throttle
+    os.environ['SEND_RATE_PER_CONNECTION'] = '0'
+    os.environ['SEND_RATE_PER_ROOM'] = '0'
+    sys.path.insert(0, ROOT)
+    import app
+    return app
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        'p50_ms': round(statistics.median(samples) * 1000, 3),
+        'p99_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 3),
+        'count': len(samples)
+    }
+
+
+def timed(call, count):
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def median_of_runs(runs):
+    # A single run's tail is mostly scheduler and GC noise, so report each figure's median
+    # (the lower middle one for an even number of runs, so it is a measured value)
+    return {
+        name: {key: statistics.median_low(run[name][key] for run in runs) for key in runs[0][name]}
+        for name in runs[0]
+    }
+
+
+def seed(app, args):
+    import db
+    from flask_jwt_extended import create_access_token
+
+    usernames = ['bench{}'.format(i) for i in range(args.users)]
+    # db.py's room helpers build Flask responses, so seed inside an app context
+    with app.app.app_context():
+        for username in usernames:
+            if not db.get_user(username):
+                db.save_user(username, 'password')
+        owner = usernames[0]
+        room_ids = [str(db.save_room('room{}'.format(i), 'PrivateGroup', owner)) for i in range(args.rooms)]
+        room_id = room_ids[0]
+        db.add_room_members(room_id, 'room0', usernames[1:args.clients], owner)
+        db.add_messages([db.build_message(room_id, owner, 'message {}'.format(i)) for i in range(args.history)])
+        tokens = {username: create_access_token(identity=username) for username in usernames[:args.clients]}
+    return owner, room_id, tokens
+
+
+def bench_rest(app, args, owner, room_id, tokens):
+    client = app.app.test_client()
+    headers = {'Authorization': 'Bearer ' + tokens[owner]}
+    endpoints = {
+        'POST /login': lambda: client.post('/login', json={'username': owner, 'password': 'password'}),
+        'GET /': lambda: client.get('/', headers=headers),
+        'GET /chatRoom/<room_id>/': lambda: client.get('/chatRoom/{}/'.format(room_id), headers=headers),
+        'GET /rooms_list/PrivateGroup': lambda: client.get('/rooms_list/PrivateGroup', headers=headers),
+    }
+    results = {}
+    for name, call in endpoints.items():
+        response = call()
+        assert response.status_code == 200, (name, response.status_code, response.get_data(as_text=True))
+        results[name] = timed(call, args.requests)
+    return results
+
+
+def bench_socketio(app, args, room_id, tokens):
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    clients = [app.socketio.test_client(app.app, auth={'token': token}) for token in tokens.values()]
+    connected, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    for client in clients:
+        assert client.emit('join_room', {'room': room_id}, callback=True) == {'ok': True}
+        client.get_received()
+
+    samples = []
+    elapsed = 0
+    delivered = 0
+    for i in range(args.messages):
+        start = time.perf_counter()
+        for client in clients:
+            sent = time.perf_counter()
+            ack = client.emit('send_message', {'room': room_id, 'message': 'load {}'.format(i)}, callback=True)
+            samples.append(time.perf_counter() - sent)
+            assert ack.get('ok'), ack
+        elapsed += time.perf_counter() - start
+        # Drained every round, untimed: the test client's get_received is quadratic in its backlog
+        delivered += sum(event['name'] == 'receive_message' for client in clients for event in client.get_received())
+    app.message_writer.flush()
+    for client in clients:
+        client.disconnect()
+
+    sent_count = args.messages * len(clients)
+    result = summarize(samples)
+    result.update({
+        'clients': len(clients),
+        'messages_per_sec': round(sent_count / elapsed, 1),
+        'deliveries_per_sec': round(delivered / elapsed, 1),
+        'memory_per_connection_kb': round((connected - before) / len(clients) / 1024, 2)
+    })
+    return {'socketio send_message fan-out': result}
+
+
+def check(results, tolerance):
+    """
+    Compare results with the baseline. Returns (failures, notes): failures are p50 and
+    messages/sec regressions beyond the tolerance, notes are p99 slowdowns, which are
+    too noisy to fail on and are only reported.
+    """
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f)
+    failures, notes = [], []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if not expected:
+            continue
+        if result['p50_ms'] > expected['p50_ms'] * (1 + tolerance):
+            failures.append('{} p50_ms: {} ms vs baseline {} ms'.format(name, result['p50_ms'], expected['p50_ms']))
+        if result['p99_ms'] > expected['p99_ms'] * (1 + tolerance):
+            notes.append('{} p99_ms: {} ms vs baseline {} ms'.format(name, result['p99_ms'], expected['p99_ms']))
+        if 'messages_per_sec' in expected and result['messages_per_sec'] < expected['messages_per_sec'] * (1 - tolerance):
+            failures.append('{} messages_per_sec: {} vs baseline {}'.format(
+                name, result['messages_per_sec'], expected['messages_per_sec']))
+    return failures, notes
+
+
+def main():
+    args = parse_args()
+    app = load_app(args.mongo_uri or args.storage_url)
+    owner, room_id, tokens = seed(app, args)
+    runs = []
+    for _ in range(args.runs):
+        run = bench_rest(app, args, owner, room_id, tokens)
+        run.update(bench_socketio(app, args, room_id, tokens))
+        runs.append(run)
+    results = median_of_runs(runs)
+
+    for name, result in results.items():
+        print('{:32} {}'.format(name, ', '.join('{}={}'.format(key, value) for key, value in result.items())))
+
+    if args.save_baseline:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Saved baseline to {}'.format(BASELINE_PATH))
+    if args.check:
+        failures, notes = check(results, args.tolerance)
+        for note in notes:
+            print('slower (not gated) ' + note)
+        for failure in failures:
+            print('REGRESSION ' + failure)
+        sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache:
+    """
+    Small per-process LRU cache whose entries expire after `ttl` seconds.
+    Keeps hit/miss/eviction counters so callers can see how well it works.
+    Invalidation only reaches this process: other workers keep their copy until it
+    expires, so `ttl` bounds how stale a change made elsewhere can be.
+    """
+
+    def __init__(self, maxsize=10000, ttl=30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        # key -> token of the load in progress; discarding the key drops its token, so a
+        # value loaded from before the invalidation is not cached (see get_or_load)
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        """
+        Return the cached value for `key`, calling `loader()` and caching its result on a miss.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            token = self._loading[key] = object()
+        value = loader()
+        with self._lock:
+            if self._loading.get(key) is token:
+                del self._loading[key]
+                self._store(key, value)
+        return value
+
+    def get(self, key, default=None):
+        """
+        Return the cached value for `key`, or `default` if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._loading.pop(key, None)
+
+    def discard_many(self, keys):
+        """
+        Drop several entries under one lock, so readers never see half of the change.
+        """
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+                self._loading.pop(key, None)
+
+    def discard_if(self, predicate):
+        """
+        Drop every entry whose key matches `predicate(key)`.
+        """
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+            for key in [key for key in self._loading if predicate(key)]:
+                del self._loading[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._loading.clear()
+
+    def _store(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,41 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Compactor:
+    """
+    Runs `compact()` every `interval` seconds on a background thread, e.g. to apply
+    message retention and archive old history (see db.compact_messages).
+    """
+
+    def __init__(self, compact, interval=3600.0):
+        self.compact = compact
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='compactor', daemon=True)
+            self._thread.start()
+
+    def run_once(self):
+        try:
+            return self.compact()
+        except Exception as e:
+            logger.error("Compaction failed: %s", e)
+            return None
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            result = self.run_once()
+            if result:
+                logger.info("Compaction finished: %s", result)
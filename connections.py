@@ -0,0 +1,74 @@
+import threading
+
+
+class Connection:
+    """
+    State kept for one authenticated Socket.IO connection.
+    `rooms` holds the rooms the server has checked and subscribed it to.
+    `wire_format` is the broadcast format the client negotiated (see wire.py).
+    """
+
+    def __init__(self, sid, username, jti=None, expires_at=None, wire_format='json'):
+        self.sid = sid
+        self.username = username
+        self.jti = jti
+        self.expires_at = expires_at
+        self.wire_format = wire_format
+        self.rooms = set()
+
+    def socket_room(self, room_id):
+        """
+        The Socket.IO room this connection listens on for a chat room: clients using
+        another wire format get their own sub-room so each can be sent its own frames.
+        """
+        return room_id if self.wire_format == 'json' else '{}:{}'.format(self.wire_format, room_id)
+
+
+class ConnectionRegistry:
+    """
+    Per-process map of Socket.IO session ids to their Connection, so events can be
+    authorized and routed in memory instead of with a database lookup.
+    """
+
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def add(self, sid, username, jti=None, expires_at=None, wire_format='json'):
+        connection = Connection(sid, username, jti, expires_at, wire_format)
+        with self._lock:
+            self._connections[sid] = connection
+        return connection
+
+    def remove(self, sid):
+        with self._lock:
+            return self._connections.pop(sid, None)
+
+    def get(self, sid):
+        return self._connections.get(sid)
+
+    def join(self, sid, room_id):
+        connection = self.get(sid)
+        if connection:
+            connection.rooms.add(room_id)
+
+    def leave(self, sid, room_id):
+        connection = self.get(sid)
+        if connection:
+            connection.rooms.discard(room_id)
+
+    def sids_in_room(self, room_id, username=None):
+        """
+        Session ids subscribed to the room, optionally only those of one user.
+        """
+        with self._lock:
+            connections = list(self._connections.values())
+        return [connection.sid for connection in connections
+                if room_id in connection.rooms and (username is None or connection.username == username)]
+
+    def sids_with_token(self, jti):
+        with self._lock:
+            return [connection.sid for connection in self._connections.values() if connection.jti == jti]
+
+    def count(self):
+        return len(self._connections)
@@ -1,74 +1,218 @@
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
-from werkzeug.security import generate_password_hash
+from pymongo import ASCENDING, DESCENDING, TEXT, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from passwords import hash_password
 from user import User
-from datetime import datetime
-from bson import ObjectId
+from cache import TTLCache
+import metrics
+import storage
+from datetime import datetime, timedelta, timezone
+from bson import Binary, ObjectId
+import bson
 from flask import jsonify
 import os
+import struct
+import zlib
 
-mongo_uri = os.getenv("MONGO_URI")
+# Page size for message history (see get_messages_page)
+MESSAGE_PAGE_SIZE = int(os.getenv("MESSAGE_PAGE_SIZE", 50))
+MAX_MESSAGE_PAGE_SIZE = int(os.getenv("MAX_MESSAGE_PAGE_SIZE", 200))
+# Message search page size and messages of context around each hit (see search_messages)
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 20))
+MAX_SEARCH_PAGE_SIZE = int(os.getenv("MAX_SEARCH_PAGE_SIZE", 100))
+SEARCH_CONTEXT = int(os.getenv("SEARCH_CONTEXT", 2))
+MAX_SEARCH_CONTEXT = int(os.getenv("MAX_SEARCH_CONTEXT", 10))
+# Characters of the newest message kept in each room summary
+MESSAGE_PREVIEW_LENGTH = int(os.getenv("MESSAGE_PREVIEW_LENGTH", 100))
+# A gap in a room's sequence numbers younger than this many seconds is treated as a batch
+# still being written; older gaps (a batch that was lost or dead-lettered) are skipped
+SEQ_GAP_GRACE = float(os.getenv("SEQ_GAP_GRACE", 30))
+# Messages older than this many days are moved into compressed archive segments (0 disables)
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", 90))
+ARCHIVE_SEGMENT_SIZE = int(os.getenv("ARCHIVE_SEGMENT_SIZE", 500))
+ARCHIVE_COMPRESSION_LEVEL = int(os.getenv("ARCHIVE_COMPRESSION_LEVEL", 6))
+# Days messages are kept per room type, e.g. RETENTION_DAYS_PUBLICGROUP=30 (0 keeps them forever)
+RETENTION_DAYS = {room_type: float(os.getenv("RETENTION_DAYS_" + room_type.upper(), 0))
+                  for room_type in ("Direct", "PrivateGroup", "PublicGroup")}
+# Page size for the user directory (see get_all_friends)
+FRIEND_PAGE_SIZE = int(os.getenv("FRIEND_PAGE_SIZE", 100))
+MAX_FRIEND_PAGE_SIZE = int(os.getenv("MAX_FRIEND_PAGE_SIZE", 1000))
+# Page size for public room listings (see get_rooms_from_type)
+ROOM_PAGE_SIZE = int(os.getenv("ROOM_PAGE_SIZE", 100))
+MAX_ROOM_PAGE_SIZE = int(os.getenv("MAX_ROOM_PAGE_SIZE", 500))
+# Per-process caches for room documents and membership rows used by authorization checks.
+# Invalidation only reaches the worker that made the change; others catch up within the TTL.
+ROOM_CACHE_SIZE = int(os.getenv("ROOM_CACHE_SIZE", 10000))
+ROOM_CACHE_TTL = float(os.getenv("ROOM_CACHE_TTL", 30))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 100000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 60))
+# Create missing indexes when the module is loaded (see ensure_indexes)
+ENSURE_INDEXES_ON_STARTUP = os.getenv("ENSURE_INDEXES_ON_STARTUP", "1") == "1"
 
-# Create a new client and connect to the server
-client = MongoClient(mongo_uri, server_api=ServerApi('1'))
-# Send a ping to confirm a successful connection
-try:
-    client.admin.command('ping')
-    print("Pinged your deployment. You successfully connected to MongoDB!")
-except Exception as e:
-    print(e)
-
-chat_db = client.get_database('chat-db')
+# MongoDB, or the embedded engine for memory:// and sqlite:/// URLs (see storage.py)
+chat_db = storage.open_database()
 # users
 users_collection = chat_db.get_collection("users")
 # rooms
 rooms_collection = chat_db.get_collection("rooms")
 room_members_collection = chat_db.get_collection("room_members")
-# chat_room
+# chat_room (legacy chat_list arrays, see migrate_chat_lists)
 chat_room_collection = chat_db.get_collection("chat_room")
+# messages
+messages_collection = chat_db.get_collection("messages")
+# compressed segments of old messages moved out of `messages` (see compact_messages)
+message_archives_collection = chat_db.get_collection("message_archives")
+# per-room counters and summaries, keyed by room id
+room_summaries_collection = chat_db.get_collection("room_summaries")
+# read markers of Direct rooms, which have no room_members rows
+read_markers_collection = chat_db.get_collection("read_markers")
+# revoked JWT ids, removed by a TTL index once the token would have expired anyway
+revoked_tokens_collection = chat_db.get_collection("revoked_tokens")
+
+# room id -> room document, (room id, username) -> room_members document (or None)
+room_cache = TTLCache(maxsize=ROOM_CACHE_SIZE, ttl=ROOM_CACHE_TTL)
+membership_cache = TTLCache(maxsize=ROOM_CACHE_SIZE, ttl=ROOM_CACHE_TTL)
+# username -> whether the user exists
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
 
 # User Operation--------------------------------------------------------------------------------------------------------
+def ensure_user_indexes():
+    users_collection.create_index([('username_lower', ASCENDING), ('_id', ASCENDING)], name='username_lower_1__id_1')
+    revoked_tokens_collection.create_index([('expires_at', ASCENDING)], name='expires_at_1', expireAfterSeconds=0)
+
 def save_user(username, password):
-    password_hash = generate_password_hash(password)
-    users_collection.insert_one({'_id':username, 'password':password_hash})
+    password_hash = hash_password(password)
+    users_collection.insert_one({'_id':username, 'username_lower': username.lower(), 'password':password_hash})
+    user_cache.discard(username)
+
+def user_exists(username):
+    exists = user_cache.get_or_load(username, lambda: users_collection.count_documents({'_id': username}, limit=1) > 0)
+    if not exists:
+        # Users are never deleted, so only a positive answer is safe to keep
+        user_cache.discard(username)
+    return exists
+
+def users_exist(usernames):
+    """
+    Return the subset of `usernames` that exist, with one query for those not cached.
+    """
+    usernames = set(usernames)
+    existing = {username for username in usernames if user_cache.get(username)}
+    missing = list(usernames - existing)
+    if missing:
+        for user in users_collection.find({'_id': {'$in': missing}}, {'_id': 1}):
+            user_cache.set(user['_id'], True)
+            existing.add(user['_id'])
+    return existing
+
+def revoke_token(jti, expires_at):
+    """
+    Record a revoked token id until `expires_at` (epoch seconds).
+    """
+    revoked_tokens_collection.update_one(
+        {'_id': jti},
+        {'$set': {'expires_at': datetime.utcfromtimestamp(expires_at)}},
+        upsert=True)
+
+def get_revoked_tokens():
+    """
+    Return {jti: expires_at (epoch seconds)} for every revocation that has not expired.
+    """
+    now = datetime.utcnow()
+    return {token['_id']: token['expires_at'].replace(tzinfo=timezone.utc).timestamp()
+            for token in revoked_tokens_collection.find({'expires_at': {'$gt': now}})}
+
+def update_password(username, password):
+    users_collection.update_one({'_id': username}, {'$set': {'password': hash_password(password)}})
 
 def get_user(username):
     user_data = users_collection.find_one({'_id':username})
     return User(user_data['_id'], user_data['password']) if user_data else None
 
-def get_all_friends(username):
-    # Retrieve all users from the database
-    all_users = users_collection.find({}, {'_id': 1})
-    # Extract usernames from user documents
-    all_usernames = [user['_id'] for user in all_users]
-    # Exclude the user's own username from the list of friends
-    friends = [friend for friend in all_usernames if friend != username]
-    return friends
+def get_all_friends(username, prefix=None, after=None, limit=FRIEND_PAGE_SIZE):
+    """
+    Return one page of other usernames ordered case-insensitively, as {'friends', 'next'}.
+    `prefix` is a case-insensitive prefix match on the indexed username_lower field and
+    `after` is the `next` cursor of the previous page (None on the last page).
+    """
+    conditions = [{'_id': {'$ne': username}}]
+    if prefix:
+        prefix = prefix.lower()
+        # Every string starting with prefix sorts between prefix and prefix + U+10FFFF
+        conditions.append({'username_lower': {'$gte': prefix, '$lt': prefix + '\U0010ffff'}})
+    if after:
+        after_lower = after.lower()
+        conditions.append({'$or': [
+            {'username_lower': {'$gt': after_lower}},
+            {'username_lower': after_lower, '_id': {'$gt': after}}
+        ]})
+    limit = max(1, min(int(limit), MAX_FRIEND_PAGE_SIZE))
+    # One more than the page tells whether there is a next page
+    users = users_collection.find({'$and': conditions}, {'_id': 1}) \
+        .sort([('username_lower', ASCENDING), ('_id', ASCENDING)]).limit(limit + 1)
+    friends = [user['_id'] for user in users]
+    return {'friends': friends[:limit], 'next': friends[limit - 1] if len(friends) > limit else None}
+
+def backfill_username_lower():
+    """
+    Set username_lower on users saved before it existed. Returns the number updated.
+    """
+    result = users_collection.update_many(
+        {'username_lower': {'$exists': False}},
+        [{'$set': {'username_lower': {'$toLower': '$_id'}}}])
+    return result.modified_count
 
 # Room Operation --------------------------------------------------------------------------------------------------------
+def ensure_room_indexes():
+    rooms_collection.create_index([('type', ASCENDING), ('_id', ASCENDING)], name='type_1__id_1')
+    rooms_collection.create_index([('type', ASCENDING), ('created_by', ASCENDING)], name='type_1_created_by_1')
+    rooms_collection.create_index([('type', ASCENDING), ('direct_to', ASCENDING)], name='type_1_direct_to_1')
+    # One Direct room per pair of users (see direct_room); other room types have no pair_key
+    rooms_collection.create_index([('pair_key', ASCENDING)], name='pair_key_1', unique=True,
+                                  partialFilterExpression={'pair_key': {'$exists': True}})
+    room_members_collection.create_index([('_id.username', ASCENDING)], name='_id.username_1')
+    room_members_collection.create_index([('_id.room_id', ASCENDING)], name='_id.room_id_1')
+    # Key Direct rooms created before pair_key existed, so direct_room finds them by it
+    backfill_direct_pair_keys()
+
 def update_room(room_id, room_name):
     rooms_collection.update_one({'_id': ObjectId(room_id)}, {'$set': {'name': room_name}})
     room_members_collection.update_many({'_id.room_id': ObjectId(room_id)}, {'$set': {'room_name': room_name}})
+    invalidate_room(room_id)
 
 def get_room(room_id):
-    return rooms_collection.find_one({'_id': ObjectId(room_id)})
-
-def get_rooms_from_type(room_type,username):
-    # Find all rooms with the specified room_type
-    rooms = rooms_collection.find({'type': room_type})
+    if not ObjectId.is_valid(room_id):
+        return None
+    return room_cache.get_or_load(str(room_id), lambda: rooms_collection.find_one({'_id': ObjectId(room_id)}))
 
-    # Extract _id and room_name from room documents
-    room_data = []
+def get_rooms_from_type(room_type, username, after=None, limit=ROOM_PAGE_SIZE):
+    """
+    List the rooms of a type visible to the user as [{'_id', 'name'}].
+    PrivateGroup rooms are resolved from the user's room_members rows and Direct rooms
+    from the user's own DMs, so the cost follows the user's rooms, not all rooms.
+    Other room types are public and paginated by room id (`after` is the last id seen).
+    """
     if room_type == "PrivateGroup":
-        for room in rooms:
-            room_id = str(room['_id'])
-            if is_room_member(room_id, username):
-                room_data.append({'_id': room_id, 'name': room['name']})
+        rooms = room_members_collection.aggregate([
+            {'$match': {'_id.username': username}},
+            {'$lookup': {'from': rooms_collection.name, 'localField': '_id.room_id', 'foreignField': '_id', 'as': 'room'}},
+            {'$unwind': '$room'},
+            {'$match': {'room.type': room_type}},
+            {'$project': {'_id': '$room._id', 'name': '$room.name'}}
+        ])
+    elif room_type == "Direct":
+        rooms = rooms_collection.find(
+            {'type': room_type, '$or': [{'created_by': username}, {'direct_to': username}]},
+            {'name': 1})
     else:
-        room_data = [{'_id': str(room['_id']), 'name': room['name']} for room in rooms]
-
+        query = {'type': room_type}
+        if after:
+            if not ObjectId.is_valid(after):
+                raise ValueError("Invalid room cursor '{}'".format(after))
+            query['_id'] = {'$gt': ObjectId(after)}
+        limit = max(1, min(int(limit), MAX_ROOM_PAGE_SIZE))
+        rooms = rooms_collection.find(query, {'name': 1}).sort('_id', ASCENDING).limit(limit)
 
-    return room_data
+    return [{'_id': str(room['_id']), 'name': room['name']} for room in rooms]
 
 # Room Member Operation -------------------------------------------------------------------------------------------------
 def add_a_room_member(room_id, username, added_by):
@@ -80,7 +224,7 @@ def add_a_room_member(room_id, username, added_by):
         if is_room_member(room_id, username):
             raise ValueError("User '{}' is already a member of the group".format(username))
         # Check if the user exists in the system
-        if users_collection.count_documents({"_id": username}) == 0:
+        if not user_exists(username):
             raise ValueError("User '{}' does not exist in the system".format(username))
         # Check if the room is private room
         if get_room_type(room_id) != 'PrivateGroup':
@@ -93,8 +237,10 @@ def add_a_room_member(room_id, username, added_by):
             'room_name': room_name, 
             'added_by': added_by,
             'added_at': datetime.now(), 
-            'is_room_admin': False
+            'is_room_admin': False,
+            'last_read_seq': _room_last_seq(room_id)
         })
+        invalidate_membership(room_id, username)
         return jsonify({'message': 'User {} added to room {}'.format(username, room_name)}), 200
     except ValueError as e:
         # print("valueerror")
@@ -103,7 +249,7 @@ def add_a_room_member(room_id, username, added_by):
 def add_admin(room_id, username, added_by):
     try:
         # Check if the user exists in the system
-        if users_collection.count_documents({"_id": username}) == 0:
+        if not user_exists(username):
             raise ValueError("User '{}' does not exist in the system".format(username))
         # Check if the room is private room
         if get_room_type(room_id) != 'PrivateGroup':
@@ -115,8 +261,10 @@ def add_admin(room_id, username, added_by):
             'room_name': room_name, 
             'added_by': added_by,
             'added_at': datetime.now(), 
-            'is_room_admin': True
+            'is_room_admin': True,
+            'last_read_seq': _room_last_seq(room_id)
         })
+        invalidate_membership(room_id, username)
         # print("add successful")
         return jsonify({'message': 'User {} added to room {}'.format(username, room_name)}), 200
     except ValueError as e:
@@ -124,27 +272,83 @@ def add_admin(room_id, username, added_by):
         print(str(e))
         return jsonify({'error': str(e)}), 400
 
+def join_public_room(room_id, username, is_admin=False):
+    """
+    Record that the user joined a PublicGroup room, so / lists it and the user's read marker
+    has a room_members row to live on. Does nothing for other room types or if the user
+    already joined, so only the first join writes.
+    """
+    if get_room_type(room_id) != 'PublicGroup' or get_room_membership(room_id, username) is not None:
+        return
+    room_members_collection.update_one(
+        {'_id': {'room_id': ObjectId(room_id), 'username': username}},
+        {'$setOnInsert': {
+            'room_name': get_room_name(room_id),
+            'added_by': username,
+            'added_at': datetime.now(),
+            'is_room_admin': is_admin,
+            'last_read_seq': _room_last_seq(room_id)
+        }},
+        upsert=True)
+    invalidate_membership(room_id, username)
+
 def add_room_members(room_id, room_name, usernames, added_by, is_admin = False):
+    """
+    Add many users to a room. All usernames are validated with one query on users and
+    one on room_members, and the new rows are written with one unordered insert.
+    Returns {'added': [usernames], 'failed': {username: reason}}.
+    """
+    usernames = list(dict.fromkeys(username for username in usernames if username))
+    existing_users = {user['_id'] for user in users_collection.find({'_id': {'$in': usernames}}, {'_id': 1})}
+    current_members = {member['_id']['username'] for member in room_members_collection.find(
+        {'_id': {'$in': [{'room_id': ObjectId(room_id), 'username': username} for username in usernames]}}, {'_id': 1})}
+
+    failed = {}
+    to_add = []
     for username in usernames:
         # Check if the user exists in the system
-        if users_collection.count_documents({"_id": username}) == 0:
-            raise ValueError("User '{}' does not exist in the system.".format(username))
-        
+        if username not in existing_users:
+            failed[username] = "User '{}' does not exist in the system.".format(username)
         # Check if the user is already a member of the group
-        if is_room_member(room_id, username):
-            raise ValueError("User '{}' is already a member of the group.".format(username))
-    
+        elif username in current_members:
+            failed[username] = "User '{}' is already a member of the group.".format(username)
+        else:
+            to_add.append(username)
+
+    # New members start with the room's history read
+    last_read_seq = _room_last_seq(room_id) if to_add else 0
     bulk_operations = [
         {
             '_id': {'room_id': ObjectId(room_id), 'username': username},
             'room_name': room_name,
             'added_by': added_by,
             'added_at': datetime.now(),
-            'is_room_admin': is_admin
+            'is_room_admin': is_admin,
+            'last_read_seq': last_read_seq
         }
-        for username in usernames
+        for username in to_add
     ]
-    room_members_collection.insert_many(bulk_operations)
+    if bulk_operations:
+        try:
+            room_members_collection.insert_many(bulk_operations, ordered=False)
+        except BulkWriteError as e:
+            # Rows added concurrently by someone else show up as duplicate keys
+            for error in e.details.get('writeErrors', []):
+                username = bulk_operations[error['index']]['_id']['username']
+                failed[username] = ("User '{}' is already a member of the group.".format(username)
+                                    if error.get('code') == 11000 else error.get('errmsg', 'Write failed'))
+    invalidate_memberships(room_id, usernames)
+    return {'added': [username for username in to_add if username not in failed], 'failed': failed}
+
+def bulk_add_room_members(room_id, usernames, added_by):
+    """
+    Add many users to a PrivateGroup on behalf of one of its admins (see add_room_members).
+    """
+    if not is_room_admin(room_id, added_by):
+        raise ValueError("User '{}' don't have permission to add member".format(added_by))
+    if get_room_type(room_id) != 'PrivateGroup':
+        raise ValueError("Room '{}' is not a PrivateGroup".format(room_id))
+    return add_room_members(room_id, get_room_name(room_id), usernames, added_by)
 
 def remove_a_room_member(room_id, remove_by, username):
     try:
@@ -162,6 +366,7 @@ def remove_a_room_member(room_id, remove_by, username):
         
         # Remove the user from the room
         room_members_collection.delete_one({'_id.room_id': ObjectId(room_id), '_id.username': username})
+        invalidate_membership(room_id, username)
         
         return jsonify({'message': "User '{}' removed from room".format(username)}), 200
     
@@ -169,27 +374,45 @@ def remove_a_room_member(room_id, remove_by, username):
         return jsonify({'error': str(e)}), 400
     
 def remove_room_members(room_id, remove_by, usernames):
+    """
+    Remove many users from a PrivateGroup. Membership is checked with one query and
+    the rows are deleted with one delete_many.
+    Returns {'removed': [usernames], 'failed': {username: reason}}.
+    """
     #only the admin can remove
     if not is_room_admin(room_id, remove_by):
-        raise ValueError("User '{} don't have permission to remove member'".format(username) )
+        raise ValueError("User '{}' doesn't have permission to remove member".format(remove_by))
     # Check if the room is private room
     if get_room_type(room_id) != 'PrivateGroup':
         raise ValueError("Room '{}' is not a PrivateGroup.".format(room_id))
-    for username in usernames:
-        # Check if the user is a member of the group
-        if not is_room_member(room_id, username):
-            raise ValueError("User '{}' is not a member of the group.".format(username))
-    
-    room_members_collection.delete_many({
-        '_id': {'$in': [{'_id.room_id': ObjectId(room_id), '_id.username': username} for username in usernames]}
-    })
+
+    usernames = list(dict.fromkeys(username for username in usernames if username))
+    member_ids = [{'room_id': ObjectId(room_id), 'username': username} for username in usernames]
+    current_members = {member['_id']['username'] for member in
+                       room_members_collection.find({'_id': {'$in': member_ids}}, {'_id': 1})}
+
+    # Check if the users are members of the group
+    failed = {username: "User '{}' is not a member of the group.".format(username)
+              for username in usernames if username not in current_members}
+    removed = [username for username in usernames if username in current_members]
+    if removed:
+        room_members_collection.delete_many({
+            '_id': {'$in': [{'room_id': ObjectId(room_id), 'username': username} for username in removed]}
+        })
+    invalidate_memberships(room_id, usernames)
+    return {'removed': removed, 'failed': failed}
+
 def save_room(room_name, room_type, created_by):
     room_id = rooms_collection.insert_one(
         {'name': room_name,
          'type': room_type, #(Direct, PublicGroup, PrivateGroup)
          'created_by': created_by,
          'created_at': datetime.now()}).inserted_id
-    add_admin(room_id, created_by, created_by)
+    invalidate_room(room_id)
+    if room_type == 'PublicGroup':
+        join_public_room(room_id, created_by, is_admin=True)
+    else:
+        add_admin(room_id, created_by, created_by)
     return room_id
 
 def get_room_members(room_id):
@@ -198,14 +421,25 @@ def get_room_members(room_id):
 def get_rooms_for_user(username):
     return list(room_members_collection.find({'_id.username': username}))
 
+def get_direct_rooms_for_user(username):
+    return list(rooms_collection.find({'type': 'Direct', '$or': [{'created_by': username}, {'direct_to': username}]}))
+
+
+def get_room_membership(room_id, username):
+    """
+    Return the room_members document for the user in the room, or None.
+    """
+    return membership_cache.get_or_load(
+        (str(room_id), username),
+        lambda: room_members_collection.find_one({'_id': {'room_id': ObjectId(room_id), 'username': username}}))
 
 def is_room_member(room_id, username):
-    room = rooms_collection.find_one({'_id': ObjectId(room_id)})
+    room = get_room(room_id)
     if room:
         if room['type'] == 'Direct':
             return room['direct_to'] == username or room['created_by'] == username
         elif room['type'] == 'PrivateGroup':
-            return room_members_collection.count_documents({'_id': {'room_id': ObjectId(room_id), 'username': username}})
+            return get_room_membership(room_id, username) is not None
         else:
             return True
     else:
@@ -214,11 +448,11 @@ def is_room_member(room_id, username):
 
 
 def is_room_admin(room_id, username):
-    return room_members_collection.count_documents(
-        {'_id': {'room_id': ObjectId(room_id), 'username': username}, 'is_room_admin': True})
+    membership = get_room_membership(room_id, username)
+    return bool(membership and membership.get('is_room_admin'))
 
 def get_room_type(room_id):
-    room = rooms_collection.find_one({'_id': ObjectId(room_id)})
+    room = get_room(room_id)
     if room:
         room_type = room.get('type')
         return room_type
@@ -226,75 +460,713 @@ def get_room_type(room_id):
         return None 
     
 def get_room_name(room_id):
-    room = rooms_collection.find_one({'_id': ObjectId(room_id)})
+    room = get_room(room_id)
     if room:
         room_name = room.get('name')
         return room_name
     else:
         return None 
     
-def direct_room(username, friendname):
-    # Check if there is a direct room between the two users
-    if users_collection.count_documents({"_id": username}) == 0:
-            raise ValueError(f"User '{username}' does not exist in the system.")
-    if users_collection.count_documents({"_id": friendname}) == 0:
-            raise ValueError(f"User '{friendname}' does not exist in the system.")
-    
-    query = {
-        "type": "Direct",
-        "$or": [
-            {"created_by": username, "direct_to": friendname},
-            {"created_by": friendname, "direct_to": username}
-        ]
-    }
-    direct_room = rooms_collection.find_one(query)
-    
-    if direct_room:
-        return str(direct_room['_id'])
-    # If no direct room found, create one
-    room_data = {
+def invalidate_room(room_id):
+    """
+    Drop the cached room document and every cached membership row of the room.
+    """
+    room_id = str(room_id)
+    room_cache.discard(room_id)
+    membership_cache.discard_if(lambda key: key[0] == room_id)
+
+def invalidate_membership(room_id, username):
+    membership_cache.discard((str(room_id), username))
+
+def invalidate_memberships(room_id, usernames):
+    membership_cache.discard_many([(str(room_id), username) for username in usernames])
+
+def get_cache_stats():
+    return {'rooms': room_cache.stats(), 'memberships': membership_cache.stats(), 'users': user_cache.stats()}
+
+def _direct_pair_key(username, friendname):
+    # The same key whichever of the two users opens the DM (joined with an ASCII unit separator)
+    return '\x1f'.join(sorted((username, friendname)))
+
+def _direct_room_update(username, friendname):
+    return {'$setOnInsert': {
         'name': "Direct",
         'type': "Direct",
         'created_by': username,
         'direct_to': friendname,
         'created_at': datetime.now()
-    }
-    
-    result = rooms_collection.insert_one(room_data)
-    room_id = str(result.inserted_id)
-    # print(f"new room between '{username}' and '{friendname}' was created")
-    # Return the created room
-    return room_id
+    }}
+
+def _legacy_direct_rooms_query(username, friendnames):
+    # Direct rooms without a pair_key between the user and any of the friends, in either direction
+    return {'type': 'Direct', 'pair_key': {'$exists': False}, '$or': [
+        {'created_by': username, 'direct_to': {'$in': friendnames}},
+        {'created_by': {'$in': friendnames}, 'direct_to': username}]}
+
+def _claim_legacy_direct_rooms(username, friendnames):
+    # Give the oldest unkeyed room of each pair its pair_key, and return the keys claimed
+    oldest = {}
+    for room in rooms_collection.find(_legacy_direct_rooms_query(username, friendnames),
+                                      {'created_by': 1, 'direct_to': 1}).sort('_id', ASCENDING):
+        oldest.setdefault(_direct_pair_key(room['created_by'], room['direct_to']), room['_id'])
+    if oldest:
+        try:
+            rooms_collection.bulk_write([
+                UpdateOne({'_id': room_id, 'pair_key': {'$exists': False}}, {'$set': {'pair_key': key}})
+                for key, room_id in oldest.items()
+            ], ordered=False)
+        except BulkWriteError as e:
+            # Another request keyed a room for the pair first; the caller reads it by key
+            if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+    return list(oldest)
+
+def direct_room(username, friendname):
+    """
+    Return the id of the DM room between two users, creating it if needed. The room is
+    found by its unique pair_key, falling back to a room from before pair_key existed
+    (which is then keyed), and otherwise created by one atomic upsert on the key.
+    """
+    # Check both users exist, with one query at most
+    existing = users_exist([username, friendname])
+    for name in (username, friendname):
+        if name not in existing:
+            raise ValueError(f"User '{name}' does not exist in the system.")
+
+    pair_key = _direct_pair_key(username, friendname)
+    room = rooms_collection.find_one({'pair_key': pair_key}, {'_id': 1})
+    if room is None and _claim_legacy_direct_rooms(username, [friendname]):
+        room = rooms_collection.find_one({'pair_key': pair_key}, {'_id': 1})
+    if room is None:
+        try:
+            room = rooms_collection.find_one_and_update(
+                {'pair_key': pair_key},
+                _direct_room_update(username, friendname),
+                projection={'_id': 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # Both users opened the DM at once and the other upsert inserted it first
+            room = rooms_collection.find_one({'pair_key': pair_key}, {'_id': 1})
+    return str(room['_id'])
+
+def direct_rooms(username, friendnames):
+    """
+    Resolve (creating where needed) the user's DM rooms with many friends at once: one
+    query on users, one lookup of existing rooms, one for rooms from before pair_key
+    existed and one bulk upsert for the rest.
+    Returns {'rooms': {friendname: room id}, 'failed': {friendname: reason}}.
+    """
+    friendnames = list(dict.fromkeys(friendname for friendname in friendnames if friendname))
+    existing = users_exist(friendnames + [username])
+    if username not in existing:
+        raise ValueError(f"User '{username}' does not exist in the system.")
+    failed = {friendname: f"User '{friendname}' does not exist in the system."
+              for friendname in friendnames if friendname not in existing}
+    keys = {_direct_pair_key(username, friendname): friendname for friendname in friendnames if friendname not in failed}
+
+    rooms = {room['pair_key']: str(room['_id'])
+             for room in rooms_collection.find({'pair_key': {'$in': list(keys)}}, {'pair_key': 1})}
+    missing = [key for key in keys if key not in rooms]
+    if missing and _claim_legacy_direct_rooms(username, [keys[key] for key in missing]):
+        rooms.update((room['pair_key'], str(room['_id']))
+                     for room in rooms_collection.find({'pair_key': {'$in': missing}}, {'pair_key': 1}))
+        missing = [key for key in missing if key not in rooms]
+    if missing:
+        try:
+            rooms_collection.bulk_write([
+                UpdateOne({'pair_key': key}, _direct_room_update(username, keys[key]), upsert=True) for key in missing
+            ], ordered=False)
+        except BulkWriteError as e:
+            # Duplicate keys are rooms created concurrently, found by the read below
+            if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+                raise
+        rooms.update((room['pair_key'], str(room['_id']))
+                     for room in rooms_collection.find({'pair_key': {'$in': missing}}, {'pair_key': 1}))
+    return {'rooms': {keys[key]: rooms[key] for key in keys if key in rooms}, 'failed': failed}
 
+def backfill_direct_pair_keys():
+    """
+    Set pair_key on Direct rooms created before it existed, oldest first. When earlier
+    races left several rooms for one pair, only one can have the key: the oldest, unless
+    another room of the pair was keyed already (e.g. by direct_room). The rest are
+    reported and left unkeyed.
+    Returns {'updated': n, 'duplicates': [room ids]}.
+    """
+    updated = 0
+    duplicates = []
+    for room in rooms_collection.find({'type': 'Direct', 'pair_key': {'$exists': False}}).sort('_id', ASCENDING):
+        try:
+            rooms_collection.update_one(
+                {'_id': room['_id']},
+                {'$set': {'pair_key': _direct_pair_key(room['created_by'], room['direct_to'])}})
+            updated += 1
+        except DuplicateKeyError:
+            duplicates.append(str(room['_id']))
+    return {'updated': updated, 'duplicates': duplicates}
 
 
-#===================================================================================
+
+# Message Operation -----------------------------------------------------------------------------------------------------
+# Messages are stored one document per message in `messages`, keyed by room and
+# ObjectId (which is time-ordered), instead of being pushed into a single
+# ever-growing `chat_room.chat_list` array. Writes stay constant cost and reads only
+# touch the documents they return. Each message also gets a per-room sequence number
+# (`seq`, allocated from room_summaries) that clients use to sync what they missed.
+def ensure_message_indexes():
+    messages_collection.create_index([('room_id', ASCENDING), ('_id', ASCENDING)], name='room_id_1__id_1')
+    messages_collection.create_index([('room_id', ASCENDING), ('seq', ASCENDING)], name='room_id_1_seq_1', unique=True,
+                                     partialFilterExpression={'seq': {'$exists': True}})
+    # Legacy chat_list messages are upserted on their position in the old array (see migrate_chat_lists)
+    messages_collection.create_index([('room_id', ASCENDING), ('legacy_index', ASCENDING)], name='room_id_1_legacy_index_1',
+                                     unique=True, partialFilterExpression={'legacy_index': {'$exists': True}})
+    # Per-room full-text search over message bodies and senders (room_id must be matched exactly)
+    messages_collection.create_index([('room_id', ASCENDING), ('message', TEXT), ('sender', TEXT)],
+                                     name='room_id_1_message_text_sender_text', weights={'message': 2, 'sender': 1})
+    message_archives_collection.create_index([('room_id', ASCENDING), ('_id', ASCENDING)], name='room_id_1__id_1')
+    message_archives_collection.create_index([('room_id', ASCENDING), ('last_id', ASCENDING)], name='room_id_1_last_id_1')
+    message_archives_collection.create_index([('room_id', ASCENDING), ('last_seq', ASCENDING)], name='room_id_1_last_seq_1')
+
 def create_new_chat_room(room_id):
     """
-    Create a new chat room with an empty chat list.
+    Create a new chat room. Messages are stored per document, so nothing needs
+    to be allocated up front.
+    """
+    return None
+
+def allocate_message_seqs(room_id, count=1, last_message=None):
+    """
+    Atomically reserve `count` sequence numbers for the room and return the first one.
+    `last_message` also records the room's newest message preview in the same update.
     """
-    room_data = {
-        "_id": room_id,
-        "chat_list": []
+    update = {"$inc": {"last_seq": count}}
+    if last_message:
+        update["$set"] = {"last_message": last_message}
+    summary = room_summaries_collection.find_one_and_update(
+        {"_id": str(room_id)},
+        update,
+        projection={"last_seq": 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return summary["last_seq"] - count + 1
+
+def build_message(room_id, sender, message):
+    """
+    Build a message document. The _id is assigned here so the message's identity is
+    fixed when it is accepted; its seq is allocated when it is written (add_messages).
+    """
+    if not isinstance(message, str):
+        raise ValueError("message must be a string")
+    return {
+        "_id": ObjectId(),
+        "room_id": str(room_id),
+        "sender": sender,
+        "message": message,
+        "created_at": datetime.now()
     }
-    chat_room_collection.insert_one(room_data)
+
+def sequence_messages(messages):
+    """
+    Give the messages that have no seq yet consecutive sequence numbers, in _id order,
+    with one allocation per room that also records the room's newest message preview.
+    Messages that already have a seq (e.g. a retried batch) keep it.
+    """
+    by_room = {}
+    for message in messages:
+        if message.get("seq") is None:
+            by_room.setdefault(message["room_id"], []).append(message)
+    for room_id, room_messages in by_room.items():
+        room_messages.sort(key=lambda message: message["_id"])
+        newest = room_messages[-1]
+        preview = {"sender": newest["sender"], "message": newest["message"][:MESSAGE_PREVIEW_LENGTH], "created_at": newest["created_at"]}
+        first_seq = allocate_message_seqs(room_id, len(room_messages), last_message=preview)
+        for index, message in enumerate(room_messages):
+            message["seq"] = first_seq + index
 
 def add_message(room_id, sender, message):
     """
     Add a message to the chat room.
     """
-    chat_room_collection.update_one(
-        {"_id": room_id},
-        {"$push": {"chat_list": {"sender": sender, "message": message, "created_at": datetime.now()}}},
-        upsert=True
-    )
+    add_messages([build_message(room_id, sender, message)])
+
+def add_messages(messages):
+    """
+    Write a batch of messages built with build_message in one bulk insert, allocating
+    their sequence numbers first (one room_summaries update per room in the batch).
+    """
+    if not messages:
+        return
+    sequence_messages(messages)
+    try:
+        messages_collection.insert_many(messages, ordered=False)
+    except BulkWriteError as e:
+        # Messages carry their own _id, so a retried batch may hit duplicates that were
+        # already written; anything else is a real failure
+        if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+            raise
+    advance_read_markers(messages)
 
 def get_messages(room_id):
     """
-    Retrieve all messages for the chat room.
+    Retrieve all messages for the chat room, oldest first, including archived ones.
     """
-    chat_room = chat_room_collection.find_one({"_id": room_id})
-    return chat_room.get("chat_list", []) if chat_room else []
+    archived = [{"sender": message["sender"], "message": message["message"], "created_at": message["created_at"]}
+                for message in _archived_after(room_id, "_id", None)]
+    messages = messages_collection.find(
+        {"room_id": str(room_id)},
+        {"_id": 0, "sender": 1, "message": 1, "created_at": 1}
+    ).sort("_id", ASCENDING)
+    return archived + list(messages)
+
+def _object_id_at(created_at):
+    # Keep legacy messages ordered by their original time while staying unique
+    object_id = ObjectId()
+    if not created_at:
+        return object_id
+    return ObjectId(struct.pack('>I', int(created_at.timestamp())) + object_id.binary[4:])
 
+def _format_message(message):
+    return {
+        "id": str(message["_id"]),
+        "seq": message.get("seq"),
+        "sender": message["sender"],
+        "message": message["message"],
+        "created_at": message["created_at"]
+    }
 
+def get_messages_page(room_id, before=None, after=None, limit=MESSAGE_PAGE_SIZE):
+    """
+    Retrieve one page of messages for the chat room, oldest first.
+    `before`/`after` are message ids used as exclusive cursors. Without cursors the
+    most recent page is returned; with only `after` the page reads forward from it.
+    Pages reaching past the hot messages continue into archived history.
+    """
+    query = {"room_id": str(room_id)}
+    id_range = {}
+    for operator, cursor in (("$lt", before), ("$gt", after)):
+        if cursor:
+            if not ObjectId.is_valid(cursor):
+                raise ValueError("Invalid message cursor '{}'".format(cursor))
+            id_range[operator] = ObjectId(cursor)
+    if id_range:
+        query["_id"] = id_range
+    limit = max(1, min(int(limit), MAX_MESSAGE_PAGE_SIZE))
 
+    direction = ASCENDING if after and not before else DESCENDING
+    # Archived messages are always older than the room's hot messages
+    if direction == ASCENDING:
+        messages = _archived_after(room_id, "_id", id_range["$gt"], limit + 1)
+        if len(messages) <= limit:
+            messages += list(messages_collection.find(query).sort("_id", direction).limit(limit + 1 - len(messages)))
+    else:
+        messages = list(messages_collection.find(query).sort("_id", direction).limit(limit + 1))
+        if len(messages) <= limit:
+            oldest = messages[-1]["_id"] if messages else id_range.get("$lt")
+            messages += _archived_before(room_id, oldest, id_range.get("$gt"), limit + 1 - len(messages))
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if direction == DESCENDING:
+        messages.reverse()
+    return {
+        "messages": [_format_message(message) for message in messages],
+        "has_more": has_more,
+        "before": str(messages[0]["_id"]) if messages else before,
+        "after": str(messages[-1]["_id"]) if messages else after
+    }
+
+def get_room_summaries(room_ids):
+    """
+    Return {room id: summary} with last_seq and last_message for the rooms, in one query.
+    """
+    if not room_ids:
+        return {}
+    summaries = room_summaries_collection.find({"_id": {"$in": [str(room_id) for room_id in room_ids]}})
+    return {summary["_id"]: summary for summary in summaries}
+
+def _room_last_seq(room_id):
+    # The room's newest sequence number, 0 before its first message
+    summary = room_summaries_collection.find_one({"_id": str(room_id)}, {"last_seq": 1})
+    return summary.get("last_seq", 0) if summary else 0
+
+def _read_marker(room_id, username):
+    # (collection, filter, upsert) of the user's read marker: Direct markers live in read_markers,
+    # group markers on the room_members row, which a PublicGroup user only has once joined
+    if get_room_type(room_id) == 'Direct':
+        return read_markers_collection, {'_id': {'room_id': str(room_id), 'username': username}}, True
+    return room_members_collection, {'_id': {'room_id': ObjectId(room_id), 'username': username}}, False
+
+def get_read_markers(room_ids, username):
+    """
+    Return {room id: last_read_seq} of the user's read_markers in the rooms, in one query.
+    """
+    if not room_ids:
+        return {}
+    markers = read_markers_collection.find(
+        {'_id': {'$in': [{'room_id': str(room_id), 'username': username} for room_id in room_ids]}})
+    return {marker['_id']['room_id']: marker.get('last_read_seq', 0) for marker in markers}
+
+def mark_room_read(room_id, username, seq):
+    """
+    Move the user's read marker in the room forward to `seq` (never backwards).
+    Returns False if the room does not exist or the user is not a member (or, in a
+    PublicGroup room, has not joined it).
+    """
+    if not get_room(room_id) or not is_room_member(room_id, username):
+        return False
+    collection, query, upsert = _read_marker(room_id, username)
+    result = collection.update_one(query, {'$max': {'last_read_seq': int(seq)}}, upsert=upsert)
+    return result.matched_count > 0 or result.upserted_id is not None
+
+def advance_read_markers(messages):
+    """
+    Mark each sender's own messages as read: one $max update per (room, sender), sent
+    as one bulk write per collection.
+    """
+    newest = {}
+    for message in messages:
+        key = (message["room_id"], message["sender"])
+        newest[key] = max(newest.get(key, 0), message["seq"])
+    updates = {}
+    for (room_id, username), seq in newest.items():
+        if not get_room(room_id):
+            continue
+        collection, query, upsert = _read_marker(room_id, username)
+        updates.setdefault(collection.name, (collection, []))[1].append(
+            UpdateOne(query, {'$max': {'last_read_seq': seq}}, upsert=upsert))
+    for collection, operations in updates.values():
+        collection.bulk_write(operations, ordered=False)
+
+def get_messages_since(room_id, seq, limit=MESSAGE_PAGE_SIZE):
+    """
+    Retrieve up to `limit` messages of the chat room with a sequence number above `seq`,
+    oldest first, so a reconnecting client only transfers what it missed.
+    Only the contiguous run from seq + 1 is returned: sequence numbers are allocated before
+    a batch is inserted, so a recent gap may still be filled by another worker's batch.
+    """
+    limit = max(1, min(int(limit), MAX_MESSAGE_PAGE_SIZE))
+    messages = _archived_after(room_id, "seq", int(seq), limit + 1)
+    if len(messages) <= limit:
+        messages += list(messages_collection.find({"room_id": str(room_id), "seq": {"$gt": int(seq)}})
+                         .sort("seq", ASCENDING).limit(limit + 1 - len(messages)))
+    grace_start = datetime.now(timezone.utc) - timedelta(seconds=SEQ_GAP_GRACE)
+    last_seq = int(seq)
+    for index, message in enumerate(messages):
+        if message["seq"] != last_seq + 1 and message["_id"].generation_time > grace_start:
+            messages = messages[:index]
+            break
+        last_seq = message["seq"]
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    return {
+        "messages": [_format_message(message) for message in messages],
+        "has_more": has_more,
+        "last_seq": messages[-1]["seq"] if messages else int(seq)
+    }
+
+def search_messages(room_id, text, sender=None, offset=0, limit=SEARCH_PAGE_SIZE, context=SEARCH_CONTEXT):
+    """
+    Full-text search over the room's hot (unarchived) messages, best matches first. Each hit comes with
+    up to `context` messages before and after it (by seq), fetched in one extra query.
+    """
+    offset = max(0, int(offset))
+    limit = max(1, min(int(limit), MAX_SEARCH_PAGE_SIZE))
+    context = max(0, min(int(context), MAX_SEARCH_CONTEXT))
+    query = {"room_id": str(room_id), "$text": {"$search": text}}
+    if sender:
+        query["sender"] = sender
+    hits = list(messages_collection.find(query, {"score": {"$meta": "textScore"}, "room_id": 0})
+                .sort([("score", {"$meta": "textScore"}), ("_id", DESCENDING)])
+                .skip(offset).limit(limit + 1))
+    has_more = len(hits) > limit
+    hits = hits[:limit]
+
+    around = {}
+    seqs = [hit["seq"] for hit in hits if hit.get("seq") is not None]
+    if context and seqs:
+        nearby = messages_collection.find({
+            "room_id": str(room_id),
+            "$or": [{"seq": {"$gte": seq - context, "$lte": seq + context}} for seq in seqs]
+        }).sort("seq", ASCENDING)
+        around = {message["seq"]: _format_message(message) for message in nearby}
+
+    results = []
+    for hit in hits:
+        seq = hit.get("seq")
+        results.append({
+            "message": _format_message(hit),
+            "score": hit["score"],
+            "before": [around[n] for n in range(seq - context, seq) if n in around] if seq is not None else [],
+            "after": [around[n] for n in range(seq + 1, seq + context + 1) if n in around] if seq is not None else []
+        })
+    return {"hits": results, "offset": offset, "has_more": has_more}
+
+def _assign_missing_seqs(room_id):
+    # Number the room's messages that have no sequence number yet, in _id order
+    message_ids = [message["_id"] for message in
+                   messages_collection.find({"room_id": room_id, "seq": {"$exists": False}}, {"_id": 1}).sort("_id", ASCENDING)]
+    if not message_ids:
+        return 0
+    first_seq = allocate_message_seqs(room_id, len(message_ids))
+    messages_collection.bulk_write([
+        UpdateOne({"_id": message_id}, {"$set": {"seq": first_seq + index}})
+        for index, message_id in enumerate(message_ids)
+    ], ordered=False)
+    return len(message_ids)
+
+def backfill_message_seqs():
+    """
+    Give messages written without a sequence number one, in _id order per room.
+    Returns the number of messages updated.
+    """
+    updated = 0
+    for room_id in messages_collection.distinct("room_id", {"seq": {"$exists": False}}):
+        updated += _assign_missing_seqs(room_id)
+    return updated
+
+def migrate_chat_lists(batch_size=1000):
+    """
+    Move messages from legacy `chat_room.chat_list` arrays into `messages`.
+    Each legacy message is upserted on (room_id, legacy_index), so the migration
+    can be re-run safely after an interruption. Sequence numbers are only allocated
+    for the messages that end up without one, so a re-run does not use up numbers;
+    run it before serving traffic so legacy messages are numbered before new ones.
+    Returns the number of messages moved.
+    """
+    migrated = 0
+    for chat_room in chat_room_collection.find({"chat_list.0": {"$exists": True}}):
+        room_id = str(chat_room["_id"])
+        operations = []
+        for index, chat in enumerate(chat_room["chat_list"]):
+            operations.append(UpdateOne(
+                {"room_id": room_id, "legacy_index": index},
+                {"$setOnInsert": {
+                    "_id": _object_id_at(chat.get("created_at")),
+                    "sender": chat.get("sender"),
+                    "message": chat.get("message"),
+                    "created_at": chat.get("created_at")
+                }},
+                upsert=True
+            ))
+            if len(operations) >= batch_size:
+                messages_collection.bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            messages_collection.bulk_write(operations, ordered=False)
+        # Covers messages inserted here and by an earlier run interrupted before this point
+        _assign_missing_seqs(room_id)
+        chat_room_collection.update_one({"_id": chat_room["_id"]}, {"$unset": {"chat_list": ""}})
+        migrated += len(chat_room["chat_list"])
+    return migrated
+
+# Archive Operation -----------------------------------------------------------------------------------------------------
+# Messages older than ARCHIVE_AFTER_DAYS are moved, oldest first, into message_archives
+# segments of up to ARCHIVE_SEGMENT_SIZE messages kept as one zlib-compressed BSON blob,
+# so `messages` and its indexes only hold recent history. The history API reads archived
+# pages on demand. A segment is keyed by the _id of its first message, so a compaction
+# interrupted between writing a segment and deleting its messages rewrites the same
+# segment when it runs again.
+def _pack_messages(messages):
+    return Binary(zlib.compress(bson.encode({"messages": messages}), ARCHIVE_COMPRESSION_LEVEL))
+
+def _unpack_messages(segment):
+    messages = bson.decode(zlib.decompress(segment["messages"]))["messages"]
+    for message in messages:
+        message["room_id"] = segment["room_id"]
+    return messages
+
+def _archived_before(room_id, before=None, after=None, limit=MESSAGE_PAGE_SIZE):
+    # Up to `limit` archived messages with ids between `after` and `before`, newest first
+    query = {"room_id": str(room_id)}
+    if before:
+        query["_id"] = {"$lt": before}
+    if after:
+        query["last_id"] = {"$gt": after}
+    messages = []
+    for segment in message_archives_collection.find(query).sort("_id", DESCENDING):
+        messages += [message for message in reversed(_unpack_messages(segment))
+                     if (not before or message["_id"] < before) and (not after or message["_id"] > after)]
+        if len(messages) >= limit:
+            break
+    return messages[:limit]
+
+def _archived_after(room_id, field, after, limit=None):
+    # Up to `limit` archived messages whose `field` (_id or seq) is above `after`, oldest first
+    query = {"room_id": str(room_id)}
+    if after is not None:
+        query["last_seq" if field == "seq" else "last_id"] = {"$gt": after}
+    messages = []
+    for segment in message_archives_collection.find(query).sort("_id", ASCENDING):
+        messages += [message for message in _unpack_messages(segment)
+                     if after is None or (message.get(field) is not None and message[field] > after)]
+        if limit and len(messages) >= limit:
+            break
+    return messages[:limit] if limit else messages
+
+def _room_type_of(room_id):
+    # Legacy chat rooms may not have a rooms document (or an ObjectId id)
+    return get_room_type(room_id) if ObjectId.is_valid(room_id) else None
+
+def expire_room_messages(room_id, now=None):
+    """
+    Delete the room's messages older than its room type's RETENTION_DAYS. Archive
+    segments are dropped whole, once their newest message has expired.
+    Returns the number of messages deleted.
+    """
+    days = RETENTION_DAYS.get(_room_type_of(room_id))
+    if not days:
+        return 0
+    cutoff = ObjectId.from_datetime((now or datetime.now(timezone.utc)) - timedelta(days=days))
+    expired = messages_collection.delete_many({"room_id": str(room_id), "_id": {"$lt": cutoff}}).deleted_count
+    segments = list(message_archives_collection.find({"room_id": str(room_id), "last_id": {"$lt": cutoff}}, {"count": 1}))
+    if segments:
+        message_archives_collection.delete_many({"_id": {"$in": [segment["_id"] for segment in segments]}})
+        expired += sum(segment["count"] for segment in segments)
+    return expired
+
+def archive_room_messages(room_id, now=None):
+    """
+    Move the room's messages older than ARCHIVE_AFTER_DAYS into archive segments.
+    Returns the number of messages archived.
+    """
+    if not ARCHIVE_AFTER_DAYS:
+        return 0
+    room_id = str(room_id)
+    cutoff = ObjectId.from_datetime((now or datetime.now(timezone.utc)) - timedelta(days=ARCHIVE_AFTER_DAYS))
+    # A short final segment is only written once the room has gone quiet; otherwise
+    # the messages wait for the next run so segments stay full and compress well
+    quiet = messages_collection.count_documents({"room_id": room_id, "_id": {"$gte": cutoff}}, limit=1) == 0
+    archived = 0
+    while True:
+        messages = list(messages_collection.find({"room_id": room_id, "_id": {"$lt": cutoff}})
+                        .sort("_id", ASCENDING).limit(ARCHIVE_SEGMENT_SIZE))
+        if not messages or (len(messages) < ARCHIVE_SEGMENT_SIZE and not quiet):
+            break
+        for message in messages:
+            del message["room_id"]
+        seqs = [message["seq"] for message in messages if message.get("seq") is not None]
+        message_archives_collection.replace_one({"_id": messages[0]["_id"]}, {
+            "room_id": room_id,
+            "last_id": messages[-1]["_id"],
+            "first_seq": min(seqs, default=None),
+            "last_seq": max(seqs, default=None),
+            "count": len(messages),
+            "archived_at": datetime.now(),
+            "messages": _pack_messages(messages)
+        }, upsert=True)
+        messages_collection.delete_many({"room_id": room_id, "_id": {"$in": [message["_id"] for message in messages]}})
+        archived += len(messages)
+        if len(messages) < ARCHIVE_SEGMENT_SIZE:
+            break
+    return archived
+
+def compact_messages(now=None):
+    """
+    Apply retention policies and archive old messages in every room that has messages.
+    Returns {'archived': n, 'expired': n, 'pruned_rooms': [ids of rooms that lost messages]}.
+    """
+    archived = expired = 0
+    pruned_rooms = []
+    for summary in room_summaries_collection.find({}, {"_id": 1}):
+        room_expired = expire_room_messages(summary["_id"], now)
+        if room_expired:
+            expired += room_expired
+            pruned_rooms.append(summary["_id"])
+        archived += archive_room_messages(summary["_id"], now)
+    return {"archived": archived, "expired": expired, "pruned_rooms": pruned_rooms}
+
+# Index Operation -------------------------------------------------------------------------------------------------------
+def ensure_indexes():
+    """
+    Create the indexes the queries above rely on. create_index is a no-op for
+    indexes that already exist, so this is safe to run on every startup.
+    """
+    ensure_user_indexes()
+    ensure_room_indexes()
+    ensure_message_indexes()
+
+def _query_shapes():
+    # One entry per query shape used in this module, with placeholder values
+    username, friendname, room_id = 'username', 'friendname', ObjectId()
+    return [
+        ('get_user', users_collection, {'_id': username}, None),
+        ('users_exist', users_collection, {'_id': {'$in': [username, friendname]}}, None),
+        ('get_revoked_tokens', revoked_tokens_collection, {'expires_at': {'$gt': datetime.utcnow()}}, None),
+        ('get_all_friends', users_collection,
+         {'$and': [{'_id': {'$ne': username}}, {'username_lower': {'$gte': 'a', '$lt': 'a\U0010ffff'}}]},
+         [('username_lower', ASCENDING), ('_id', ASCENDING)]),
+        ('get_room', rooms_collection, {'_id': room_id}, None),
+        ('get_rooms_from_type (public)', rooms_collection, {'type': 'PublicGroup', '_id': {'$gt': room_id}}, [('_id', ASCENDING)]),
+        ('get_rooms_from_type (Direct)', rooms_collection,
+         {'type': 'Direct', '$or': [{'created_by': username}, {'direct_to': username}]}, None),
+        ('direct_room', rooms_collection, {'pair_key': _direct_pair_key(username, friendname)}, None),
+        ('direct_rooms', rooms_collection, {'pair_key': {'$in': [_direct_pair_key(username, friendname)]}}, None),
+        ('get_room_membership', room_members_collection, {'_id': {'room_id': room_id, 'username': username}}, None),
+        ('mark_room_read', room_members_collection, {'_id': {'room_id': room_id, 'username': username}}, None),
+        ('mark_room_read (read_markers)', read_markers_collection, {'_id': {'room_id': str(room_id), 'username': username}}, None),
+        ('_room_last_seq', room_summaries_collection, {'_id': str(room_id)}, None),
+        ('get_rooms_for_user', room_members_collection, {'_id.username': username}, None),
+        ('get_direct_rooms_for_user', rooms_collection,
+         {'type': 'Direct', '$or': [{'created_by': username}, {'direct_to': username}]}, None),
+        ('get_read_markers', read_markers_collection,
+         {'_id': {'$in': [{'room_id': str(room_id), 'username': username}]}}, None),
+        ('get_room_members', room_members_collection, {'_id.room_id': room_id}, None),
+        ('get_messages', messages_collection, {'room_id': str(room_id)}, [('_id', ASCENDING)]),
+        ('get_messages_page', messages_collection, {'room_id': str(room_id), '_id': {'$lt': room_id}}, [('_id', DESCENDING)]),
+        ('search_messages', messages_collection, {'room_id': str(room_id), '$text': {'$search': 'hello'}}, None),
+        ('get_room_summaries', room_summaries_collection, {'_id': {'$in': [str(room_id)]}}, None),
+        ('get_messages_since', messages_collection, {'room_id': str(room_id), 'seq': {'$gt': 0}}, [('seq', ASCENDING)]),
+        ('search_messages (context)', messages_collection,
+         {'room_id': str(room_id), '$or': [{'seq': {'$gte': 1, '$lte': 5}}]}, [('seq', ASCENDING)]),
+        ('migrate_chat_lists', messages_collection, {'room_id': str(room_id), 'legacy_index': 0}, None),
+        ('backfill_message_seqs', messages_collection, {'room_id': str(room_id), 'seq': {'$exists': False}}, [('_id', ASCENDING)]),
+        ('archive_room_messages', messages_collection, {'room_id': str(room_id), '_id': {'$lt': room_id}}, [('_id', ASCENDING)]),
+        ('archive_room_messages (quiet)', messages_collection, {'room_id': str(room_id), '_id': {'$gte': room_id}}, None),
+        ('_archived_before', message_archives_collection,
+         {'room_id': str(room_id), '_id': {'$lt': room_id}, 'last_id': {'$gt': room_id}}, [('_id', DESCENDING)]),
+        ('_archived_after (_id)', message_archives_collection, {'room_id': str(room_id), 'last_id': {'$gt': room_id}}, [('_id', ASCENDING)]),
+        ('_archived_after (seq)', message_archives_collection, {'room_id': str(room_id), 'last_seq': {'$gt': 0}}, [('_id', ASCENDING)]),
+        ('expire_room_messages', message_archives_collection, {'room_id': str(room_id), 'last_id': {'$lt': room_id}}, None),
+        ('backfill_direct_pair_keys', rooms_collection, {'type': 'Direct', 'pair_key': {'$exists': False}}, [('_id', ASCENDING)]),
+        ('_claim_legacy_direct_rooms', rooms_collection, _legacy_direct_rooms_query(username, [username]), [('_id', ASCENDING)]),
+    ]
+
+def _plan_stages(plan):
+    stages = [plan.get('stage')]
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            stages += _plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        stages += _plan_stages(child)
+    return [stage for stage in stages if stage]
+
+def explain_queries():
+    """
+    Run explain on every query shape in this module and report the winning plan's
+    stages. Entries with 'collscan' set are queries that no index serves, and entries
+    with 'blocking_sort' set are sorted in memory because no index covers the sort.
+    """
+    report = []
+    for name, collection, query, sort in _query_shapes():
+        cursor = collection.find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        stages = _plan_stages(plan)
+        report.append({
+            'name': name,
+            'collection': collection.name,
+            'stages': stages,
+            'collscan': 'COLLSCAN' in stages,
+            'blocking_sort': 'SORT' in stages
+        })
+    return report
+
+# Time every operation above (see metrics.instrument_module)
+metrics.instrument_module(globals(), __name__)
+
+if ENSURE_INDEXES_ON_STARTUP:
+    try:
+        ensure_indexes()
+    except Exception as e:
+        print(e)
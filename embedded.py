@@ -0,0 +1,985 @@
+"""
+Embedded document store implementing the part of the pymongo API that db.py uses.
+
+Documents are kept in process memory and normalized through BSON on every write, so
+they come back with the types MongoDB would return (millisecond datetimes, lists for
+tuples) and can be persisted as-is. Indexes keep their MongoDB meaning: unique and
+partial unique indexes reject duplicates with error code 11000, TTL indexes expire
+documents and text indexes serve $text queries. The leading field of every index is
+also kept as a value -> documents lookup, so equality, $in and range queries on it
+touch only the matching documents instead of scanning the collection.
+
+With a SQLite path every write is persisted to the file and the collections are
+loaded back into memory when the database is opened. Errors are pymongo's own
+(DuplicateKeyError, BulkWriteError, OperationFailure), so callers handle both
+backends the same way.
+"""
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import bisect
+import heapq
+import operator
+import re
+import sqlite3
+import threading
+import time
+
+import bson
+from bson import ObjectId
+from pymongo import ASCENDING, TEXT
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.operations import UpdateOne
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+# How often TTL indexes are checked for expired documents, in seconds
+TTL_INTERVAL = 1.0
+
+_COMPARISONS = {'$gt': operator.gt, '$gte': operator.ge, '$lt': operator.lt, '$lte': operator.le}
+_TOKEN = re.compile(r'\w+')
+_STOP_WORDS = frozenset('a an and are as at be by for from has in is it of on or that the this to was were will with'.split())
+
+
+# Values ----------------------------------------------------------------------------------------------------------------
+def _normalize(document):
+    # Round-trip through BSON, as a write to MongoDB would
+    return bson.decode(bson.encode(document))
+
+
+def _copy(value):
+    # Called for every field of every document returned, so immutable values return first
+    if type(value) in _SCALARS:
+        return value
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+
+# Immutable types documents hold, and the BSON type order of the ones that compare
+# by their Python value (see _sort_key)
+_SCALARS = frozenset((str, int, float, bool, type(None), bytes, ObjectId, datetime))
+_SORT_ORDER = {str: 3, int: 2, float: 2, datetime: 9}
+
+
+def _sort_key(value):
+    """
+    A hashable key that orders values across types the way BSON comparison does
+    (null < numbers < strings < objects < arrays < binary < ObjectId < bool < date).
+    """
+    order = _SORT_ORDER.get(type(value))
+    if order is not None:
+        return (order, value)
+    if value is None:
+        return (1,)
+    if isinstance(value, bool):
+        return (8, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    if isinstance(value, dict):
+        return (4, tuple((key, _sort_key(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return (5, tuple(_sort_key(item) for item in value))
+    if isinstance(value, bytes):
+        return (6, value)
+    if isinstance(value, ObjectId):
+        return (7, value.binary)
+    if isinstance(value, datetime):
+        return (9, value)
+    return (10, str(value))
+
+
+def _resolve(value, parts):
+    # Every value a dotted path reaches, descending into arrays of subdocuments
+    if not parts:
+        return [value]
+    if isinstance(value, dict):
+        return _resolve(value[parts[0]], parts[1:]) if parts[0] in value else []
+    if isinstance(value, list):
+        if parts[0].isdigit():
+            index = int(parts[0])
+            return _resolve(value[index], parts[1:]) if index < len(value) else []
+        return [found for item in value if isinstance(item, dict) for found in _resolve(item, parts)]
+    return []
+
+
+def _candidates(resolved):
+    # An array field matches both as a whole and through each of its elements
+    values = []
+    for value in resolved:
+        values.append(value)
+        if isinstance(value, list):
+            values.extend(value)
+    return values
+
+
+def _get_path(document, path, default=None):
+    value = document
+    for part in path.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return default
+    return value
+
+
+def _set_path(document, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        if isinstance(document, list) and part.isdigit():
+            document = document[int(part)]
+            continue
+        child = document.get(part)
+        if not isinstance(child, (dict, list)):
+            child = document[part] = {}
+        document = child
+    if isinstance(document, list):
+        document[int(parts[-1])] = value
+    else:
+        document[parts[-1]] = value
+
+
+def _unset_path(document, path):
+    parts = path.split('.')
+    parent = _get_path(document, '.'.join(parts[:-1])) if len(parts) > 1 else document
+    if isinstance(parent, dict):
+        parent.pop(parts[-1], None)
+
+
+# Queries ---------------------------------------------------------------------------------------------------------------
+def _is_operator_dict(condition):
+    return isinstance(condition, dict) and bool(condition) and all(key.startswith('$') for key in condition)
+
+
+def _equals_any(resolved, value):
+    if value is None and not resolved:
+        return True
+    key = _sort_key(value)
+    return any(_sort_key(candidate) == key for candidate in _candidates(resolved))
+
+
+def _match_operator(resolved, op, argument):
+    if op == '$eq':
+        return _equals_any(resolved, argument)
+    if op == '$ne':
+        return not _equals_any(resolved, argument)
+    if op in _COMPARISONS:
+        key = _sort_key(argument)
+        return any(candidate[0] == key[0] and _COMPARISONS[op](candidate, key)
+                   for candidate in map(_sort_key, _candidates(resolved)))
+    if op == '$in':
+        return any(_equals_any(resolved, item) for item in argument)
+    if op == '$exists':
+        return bool(resolved) == bool(argument)
+    raise OperationFailure('unknown operator: {}'.format(op), code=2)
+
+
+def _match_field(document, path, condition):
+    resolved = _resolve(document, path.split('.'))
+    if _is_operator_dict(condition):
+        return all(_match_operator(resolved, op, argument) for op, argument in condition.items())
+    return _equals_any(resolved, condition)
+
+
+def _matches(document, query):
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(_matches(document, clause) for clause in condition):
+                return False
+        elif key == '$or':
+            if not any(_matches(document, clause) for clause in condition):
+                return False
+        elif key == '$text':
+            # Scored separately (see Collection._select)
+            continue
+        elif key.startswith('$'):
+            raise OperationFailure('unknown top level operator: {}'.format(key), code=2)
+        elif not _match_field(document, key, condition):
+            return False
+    return True
+
+
+def _field_conditions(query):
+    # (path, condition) pairs every matching document must satisfy
+    for key, condition in query.items():
+        if key == '$and':
+            for clause in condition:
+                yield from _field_conditions(clause)
+        elif not key.startswith('$'):
+            yield key, condition
+
+
+def _upsert_seed(query):
+    # The document an upsert starts from: the query's equality conditions
+    document = {}
+    for path, condition in _field_conditions(query):
+        if not _is_operator_dict(condition):
+            _set_path(document, path, _copy(condition))
+        elif '$eq' in condition:
+            _set_path(document, path, _copy(condition['$eq']))
+    return document
+
+
+# Text search -----------------------------------------------------------------------------------------------------------
+def _stem(word):
+    # Rough English suffix stripping, enough to match "run"/"running" or "test"/"tests"
+    for suffix in ('ing', 'ed', 'es', 's'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            stem = word[:-len(suffix)]
+            if suffix in ('ing', 'ed') and stem[-1] == stem[-2] and stem[-1] not in 'aeioulsz':
+                stem = stem[:-1]
+            return stem
+    return word
+
+
+def _tokens(text):
+    return [_stem(token) for token in _TOKEN.findall(text.lower()) if token not in _STOP_WORDS]
+
+
+def _parse_search(search):
+    phrases = [phrase.lower() for phrase in re.findall(r'"([^"]+)"', search)]
+    words = re.sub(r'"[^"]*"', ' ', search).split()
+    terms = {token for word in words if not word.startswith('-') for token in _tokens(word)}
+    negated = {token for word in words if word.startswith('-') for token in _tokens(word[1:])}
+    return terms | {token for phrase in phrases for token in _tokens(phrase)}, negated, phrases
+
+
+def _text_score(document, weights, terms, negated, phrases):
+    # Weighted share of matching tokens per field, or None if the document does not match
+    score = 0.0
+    texts = []
+    for field, weight in weights.items():
+        value = _get_path(document, field)
+        if not isinstance(value, str):
+            continue
+        texts.append(value.lower())
+        tokens = _tokens(value)
+        if negated.intersection(tokens):
+            return None
+        matched = sum(1 for token in tokens if token in terms)
+        if matched:
+            score += weight * (0.5 + 0.5 * matched / len(tokens))
+    if not score or any(not any(phrase in text for text in texts) for phrase in phrases):
+        return None
+    return score
+
+
+# Aggregation expressions -----------------------------------------------------------------------------------------------
+def _evaluate(expression, document):
+    if isinstance(expression, str) and expression.startswith('$'):
+        return _copy(_get_path(document, expression[1:]))
+    if _is_operator_dict(expression) and len(expression) == 1:
+        op, argument = next(iter(expression.items()))
+        if op == '$literal':
+            return argument
+        values = [_evaluate(item, document) for item in (argument if isinstance(argument, list) else [argument])]
+        if op == '$toLower':
+            return (values[0] or '').lower()
+        raise OperationFailure('Unrecognized expression {}'.format(op), code=168)
+    if isinstance(expression, dict):
+        return {key: _evaluate(value, document) for key, value in expression.items()}
+    if isinstance(expression, list):
+        return [_evaluate(value, document) for value in expression]
+    return expression
+
+
+def _include(document, paths):
+    result = {}
+    for key, value in document.items():
+        subpaths = [path[1:] for path in paths if path[0] == key]
+        if not subpaths:
+            continue
+        if any(not path for path in subpaths):
+            result[key] = _copy(value)
+        elif isinstance(value, dict):
+            result[key] = _include(value, subpaths)
+    return result
+
+
+def _project(document, projection, score=None):
+    if not projection:
+        return _copy(document)
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    meta = [key for key, value in projection.items() if isinstance(value, dict) and '$meta' in value]
+    fields = {key: value for key, value in projection.items() if key not in meta}
+    if any(value for key, value in fields.items() if key != '_id'):
+        paths = [key.split('.') for key, value in fields.items() if value and key != '_id']
+        if fields.get('_id', 1):
+            paths.append(['_id'])
+        result = _include(document, paths)
+    else:
+        result = _copy(document)
+        for path, value in fields.items():
+            if not value:
+                _unset_path(result, path)
+    for key in meta:
+        result[key] = score
+    return result
+
+
+def _project_stage(document, specification):
+    # $project in a pipeline: field inclusion/exclusion plus computed fields
+    exclusions = [key for key, value in specification.items() if value in (0, False)]
+    if len(exclusions) == len(specification):
+        return _project(document, specification)
+    result = {'_id': _copy(document['_id'])} if '_id' in document and '_id' not in exclusions else {}
+    for key, value in specification.items():
+        if value in (0, False):
+            continue
+        if value is True or value == 1:
+            found = _get_path(document, key)
+            if found is not None:
+                _set_path(result, key, _copy(found))
+        else:
+            _set_path(result, key, _evaluate(value, document))
+    return result
+
+
+def _sort_documents(documents, specification, scores=None):
+    for field, direction in reversed(specification):
+        if isinstance(direction, dict):
+            documents.sort(key=lambda document: scores.get(id(document), 0), reverse=True)
+        else:
+            documents.sort(key=lambda document: _sort_key(_get_path(document, field)), reverse=direction < 0)
+    return documents
+
+
+def _sort_specification(key_or_list, direction=None):
+    if isinstance(key_or_list, str):
+        return [(key_or_list, ASCENDING if direction is None else direction)]
+    if isinstance(key_or_list, dict):
+        return list(key_or_list.items())
+    return [(key, value) for key, value in key_or_list]
+
+
+# Indexes ---------------------------------------------------------------------------------------------------------------
+class _FieldLookup:
+    """
+    Value -> documents map for one field, shared by every index that leads with it.
+    Buckets are kept in insertion order; the sorted list of values used for range
+    queries is rebuilt only after values are added or removed.
+    """
+
+    def __init__(self, path):
+        self.parts = path.split('.')
+        self.buckets = {}
+        self._ordered = None
+
+    def _values(self, document):
+        return {_sort_key(value) for value in (_candidates(_resolve(document, self.parts)) or [None])}
+
+    def add(self, key, document):
+        for value in self._values(document):
+            bucket = self.buckets.get(value)
+            if bucket is None:
+                bucket = self.buckets[value] = {}
+                self._ordered = None
+            bucket[key] = None
+
+    def remove(self, key, document):
+        for value in self._values(document):
+            bucket = self.buckets.get(value)
+            if bucket is not None:
+                bucket.pop(key, None)
+                if not bucket:
+                    del self.buckets[value]
+                    self._ordered = None
+
+    def keys(self, condition):
+        """
+        Document keys that may satisfy `condition`, or None if it can't use the lookup.
+        """
+        if not _is_operator_dict(condition):
+            return list(self.buckets.get(_sort_key(condition), ()))
+        if '$eq' in condition:
+            return list(self.buckets.get(_sort_key(condition['$eq']), ()))
+        if '$in' in condition:
+            keys = {}
+            for value in condition['$in']:
+                keys.update(self.buckets.get(_sort_key(value), {}))
+            return list(keys)
+        bounds = [(op, _sort_key(value)) for op, value in condition.items() if op in _COMPARISONS]
+        if not bounds:
+            return None
+        if self._ordered is None:
+            self._ordered = sorted(self.buckets)
+        # Comparisons only match values of the same type, so stay within that type's range
+        rank = bounds[0][1][0]
+        low, high = (rank,), (rank + 1,)
+        start, stop = bisect.bisect_left(self._ordered, low), bisect.bisect_left(self._ordered, high)
+        for op, value in bounds:
+            if op == '$gt':
+                start = max(start, bisect.bisect_right(self._ordered, value))
+            elif op == '$gte':
+                start = max(start, bisect.bisect_left(self._ordered, value))
+            elif op == '$lt':
+                stop = min(stop, bisect.bisect_left(self._ordered, value))
+            else:
+                stop = min(stop, bisect.bisect_right(self._ordered, value))
+        return [key for value in self._ordered[start:stop] for key in self.buckets[value]]
+
+
+class _Index:
+    def __init__(self, name, keys, unique=False, partial_filter=None, expire_after=None, weights=None):
+        self.name = name
+        self.keys = keys
+        self.unique = unique
+        self.partial_filter = partial_filter
+        self.expire_after = expire_after
+        self.text_weights = {field: (weights or {}).get(field, 1) for field, direction in keys if direction == TEXT}
+        self.fields = [field for field, direction in keys if direction != TEXT]
+        self._owners = {}
+
+    def specification(self):
+        specification = {'key': [list(key) for key in self.keys], 'name': self.name}
+        if self.unique:
+            specification['unique'] = True
+        if self.partial_filter:
+            specification['partialFilterExpression'] = self.partial_filter
+        if self.expire_after is not None:
+            specification['expireAfterSeconds'] = self.expire_after
+        if self.text_weights:
+            specification['weights'] = self.text_weights
+        return specification
+
+    def _unique_key(self, document):
+        if not self.unique or (self.partial_filter and not _matches(document, self.partial_filter)):
+            return None
+        return tuple(_sort_key(_get_path(document, field)) for field in self.fields)
+
+    def check(self, key, document, namespace):
+        unique_key = self._unique_key(document)
+        if unique_key is None:
+            return
+        owner = self._owners.get(unique_key)
+        if owner is not None and owner != key:
+            values = {field: _get_path(document, field) for field in self.fields}
+            message = 'E11000 duplicate key error collection: {} index: {} dup key: {}'.format(namespace, self.name, values)
+            raise DuplicateKeyError(message, 11000, {
+                'code': 11000, 'errmsg': message, 'keyPattern': dict(self.keys), 'keyValue': values})
+
+    def add(self, key, document):
+        unique_key = self._unique_key(document)
+        if unique_key is not None:
+            self._owners[unique_key] = key
+
+    def remove(self, key, document):
+        unique_key = self._unique_key(document)
+        if unique_key is not None and self._owners.get(unique_key) == key:
+            del self._owners[unique_key]
+
+
+# Collections -----------------------------------------------------------------------------------------------------------
+class Cursor:
+    """
+    Lazily evaluated find() result supporting sort, skip and limit.
+    """
+
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._results = None
+
+    def sort(self, key_or_list, direction=None):
+        self._sort = _sort_specification(key_or_list, direction)
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._results is None:
+            self._results = iter(self.collection._find(self._query, self._projection, self._sort, self._skip, self._limit))
+        return next(self._results)
+
+
+class Collection:
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = '{}.{}'.format(database.name, name)
+        self._documents = {}
+        self._indexes = {}
+        self._lookups = {}
+        self._next_expiry = 0
+
+    def __repr__(self):
+        return 'Collection({!r}, {!r})'.format(self.database, self.name)
+
+    # Storage -----------------------------------------------------------------------------------------------------------
+    def _store(self, key, document):
+        self._documents[key] = document
+        for index in self._indexes.values():
+            index.add(key, document)
+        for lookup in self._lookups.values():
+            lookup.add(key, document)
+        self.database._persist(self.name, document)
+
+    def _unstore(self, key, persist=True):
+        document = self._documents.pop(key)
+        for index in self._indexes.values():
+            index.remove(key, document)
+        for lookup in self._lookups.values():
+            lookup.remove(key, document)
+        if persist:
+            self.database._persist_delete(self.name, document['_id'])
+        return document
+
+    def _check(self, key, document):
+        for index in self._indexes.values():
+            index.check(key, document, self.full_name)
+
+    def _insert(self, document):
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        document = _normalize(document)
+        key = _sort_key(document['_id'])
+        if key in self._documents:
+            message = 'E11000 duplicate key error collection: {} index: _id_ dup key: {{ _id: {!r} }}'.format(
+                self.full_name, document['_id'])
+            raise DuplicateKeyError(message, 11000, {'code': 11000, 'errmsg': message, 'keyPattern': {'_id': 1},
+                                                     'keyValue': {'_id': document['_id']}})
+        self._check(key, document)
+        self._store(key, document)
+        return document['_id']
+
+    def _replace(self, key, document):
+        previous = self._unstore(key, persist=False)
+        try:
+            self._check(key, document)
+        except DuplicateKeyError:
+            self._store(key, previous)
+            raise
+        self._store(key, document)
+
+    def _expire(self):
+        now = time.monotonic()
+        if now < self._next_expiry:
+            return
+        self._next_expiry = now + TTL_INTERVAL
+        for index in self._indexes.values():
+            if index.expire_after is None or not index.fields:
+                continue
+            cutoff = datetime.utcnow() - timedelta(seconds=index.expire_after)
+            for key in self._lookups[index.fields[0]].keys({'$lte': cutoff}):
+                self._unstore(key)
+
+    # Query execution ---------------------------------------------------------------------------------------------------
+    def _candidate_keys(self, query):
+        """
+        Keys of the documents that may match, found through the _id or the smallest index
+        lookup, or None if the query needs a collection scan.
+        """
+        best = None
+        for path, condition in _field_conditions(query):
+            if path == '_id':
+                if not _is_operator_dict(condition):
+                    return [_sort_key(condition)]
+                if '$in' in condition:
+                    return [_sort_key(value) for value in condition['$in']]
+                continue
+            lookup = self._lookups.get(path)
+            keys = lookup.keys(condition) if lookup else None
+            if keys is not None and (best is None or len(keys) < len(best)):
+                best = keys
+        return best
+
+    def _text_index(self):
+        for index in self._indexes.values():
+            if index.text_weights:
+                return index
+        raise OperationFailure('text index required for $text query', code=27)
+
+    def _select(self, query, sort=None, skip=0, limit=0):
+        """
+        Return (matching documents in result order, {id(document): text score}).
+        """
+        self._expire()
+        query = query or {}
+        keys = self._candidate_keys(query)
+        documents = self._documents.values() if keys is None else \
+            [self._documents[key] for key in keys if key in self._documents]
+        scores = {}
+        if '$text' in query:
+            weights = self._text_index().text_weights
+            terms, negated, phrases = _parse_search(query['$text']['$search'])
+            scored = []
+            for document in documents:
+                score = _text_score(document, weights, terms, negated, phrases)
+                if score is not None:
+                    scores[id(document)] = score
+                    scored.append(document)
+            documents = scored
+        matched = (document for document in documents if _matches(document, query))
+        if not sort:
+            results = []
+            for document in matched:
+                results.append(document)
+                if limit and len(results) >= skip + limit:
+                    break
+            return results[skip:], scores
+        if limit and len(sort) == 1 and not isinstance(sort[0][1], dict):
+            field, direction = sort[0]
+            pick = heapq.nsmallest if direction > 0 else heapq.nlargest
+            results = pick(skip + limit, matched, key=lambda document: _sort_key(_get_path(document, field)))
+        else:
+            results = _sort_documents(list(matched), sort, scores)
+        return results[skip:skip + limit if limit else None], scores
+
+    def _find(self, query, projection=None, sort=None, skip=0, limit=0):
+        with self.database._lock:
+            documents, scores = self._select(query, sort, skip, limit)
+            return [_project(document, projection, scores.get(id(document))) for document in documents]
+
+    def _update(self, query, update, upsert=False, multi=False, sort=None, replace=False):
+        """
+        Apply an update and return (raw result, [(before, after)] per changed document).
+        """
+        query = query or {}
+        if not replace and not isinstance(update, list) and not _is_operator_dict(update):
+            raise ValueError('update only works with $ operators')
+        documents, _ = self._select(query, sort, 0, 0 if multi else 1)
+        changes = []
+        modified = 0
+        for document in documents:
+            key = _sort_key(document['_id'])
+            if replace:
+                updated = dict(_copy(update), _id=document['_id'])
+            else:
+                updated = _apply_update(_copy(document), update, inserting=False)
+            if _sort_key(updated.get('_id')) != key:
+                raise OperationFailure("Performing an update on the path '_id' would modify the immutable field '_id'", code=66)
+            updated = _normalize(updated)
+            if updated != document:
+                self._replace(key, updated)
+                modified += 1
+            changes.append((document, updated))
+        raw = {'n': len(documents), 'nModified': modified, 'ok': 1.0}
+        if not documents and upsert:
+            seed = _upsert_seed(query)
+            if replace:
+                document = dict(_copy(update), **({'_id': seed['_id']} if '_id' in seed else {}))
+            else:
+                document = _apply_update(seed, update, inserting=True)
+            inserted_id = self._insert(document)
+            raw.update(n=1, upserted=inserted_id)
+            changes.append((None, self._documents[_sort_key(inserted_id)]))
+        return raw, changes
+
+    # pymongo API -------------------------------------------------------------------------------------------------------
+    def find(self, filter=None, projection=None, skip=0, limit=0, sort=None, **kwargs):
+        cursor = Cursor(self, filter or {}, projection).skip(skip).limit(limit)
+        return cursor.sort(sort) if sort else cursor
+
+    def find_one(self, filter=None, projection=None, *args, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        for document in self.find(filter, projection, *args, **kwargs).limit(1):
+            return document
+        return None
+
+    def count_documents(self, filter, skip=0, limit=0, **kwargs):
+        with self.database._lock:
+            return len(self._select(filter, None, skip, limit)[0])
+
+    def distinct(self, key, filter=None, **kwargs):
+        with self.database._lock:
+            documents, _ = self._select(filter)
+            values = {}
+            for document in documents:
+                for value in _candidates(_resolve(document, key.split('.'))):
+                    if not isinstance(value, list):
+                        values.setdefault(_sort_key(value), value)
+            return [_copy(value) for value in values.values()]
+
+    def insert_one(self, document, **kwargs):
+        with self.database._transaction():
+            return InsertOneResult(self._insert(document), True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        with self.database._transaction():
+            inserted_ids, errors = [], []
+            for index, document in enumerate(documents):
+                try:
+                    inserted_ids.append(self._insert(document))
+                except DuplicateKeyError as e:
+                    errors.append(dict(e.details, index=index, op=document))
+                    if ordered:
+                        break
+            if errors:
+                raise BulkWriteError({'writeErrors': errors, 'writeConcernErrors': [], 'nInserted': len(inserted_ids),
+                                      'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []})
+            return InsertManyResult(inserted_ids, True)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        with self.database._transaction():
+            return UpdateResult(self._update(filter, update, upsert)[0], True)
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        with self.database._transaction():
+            return UpdateResult(self._update(filter, update, upsert, multi=True)[0], True)
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        with self.database._transaction():
+            return UpdateResult(self._update(filter, replacement, upsert, replace=True)[0], True)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False, return_document=False, **kwargs):
+        with self.database._transaction():
+            sort = _sort_specification(sort) if sort else None
+            _, changes = self._update(filter, update, upsert, sort=sort)
+            if not changes:
+                return None
+            document = changes[0][1] if return_document else changes[0][0]
+            return _project(document, projection) if document is not None else None
+
+    def delete_one(self, filter, **kwargs):
+        with self.database._transaction():
+            documents, _ = self._select(filter, None, 0, 1)
+            for document in documents:
+                self._unstore(_sort_key(document['_id']))
+            return DeleteResult({'n': len(documents), 'ok': 1.0}, True)
+
+    def delete_many(self, filter, **kwargs):
+        with self.database._transaction():
+            documents, _ = self._select(filter)
+            for document in documents:
+                self._unstore(_sort_key(document['_id']))
+            return DeleteResult({'n': len(documents), 'ok': 1.0}, True)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        with self.database._transaction():
+            result = {'writeErrors': [], 'writeConcernErrors': [], 'nInserted': 0, 'nUpserted': 0,
+                      'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+            for index, request in enumerate(requests):
+                try:
+                    if not isinstance(request, UpdateOne):
+                        raise TypeError('{!r} is not a valid request'.format(request))
+                    raw, _ = self._update(request._filter, request._doc, request._upsert)
+                    if 'upserted' in raw:
+                        result['nUpserted'] += 1
+                        result['upserted'].append({'index': index, '_id': raw['upserted']})
+                    else:
+                        result['nMatched'] += raw['n']
+                        result['nModified'] += raw['nModified']
+                except DuplicateKeyError as e:
+                    result['writeErrors'].append(dict(e.details, index=index, op=request))
+                    if ordered:
+                        break
+            if result['writeErrors']:
+                raise BulkWriteError(result)
+            return BulkWriteResult(result, True)
+
+    def aggregate(self, pipeline, **kwargs):
+        with self.database._lock:
+            documents = None
+            for stage in pipeline:
+                (op, specification), = stage.items()
+                if op == '$match' and documents is None:
+                    documents = [_copy(document) for document in self._select(specification)[0]]
+                    continue
+                if documents is None:
+                    self._expire()
+                    documents = [_copy(document) for document in self._documents.values()]
+                if op == '$match':
+                    documents = [document for document in documents if _matches(document, specification)]
+                elif op == '$lookup':
+                    foreign = self.database.get_collection(specification['from'])
+                    for document in documents:
+                        values = _candidates(_resolve(document, specification['localField'].split('.'))) or [None]
+                        document[specification['as']] = foreign._find({specification['foreignField']: {'$in': values}})
+                elif op == '$unwind':
+                    if isinstance(specification, str):
+                        specification = {'path': specification}
+                    path = specification['path'][1:]
+                    unwound = []
+                    for document in documents:
+                        values = _get_path(document, path)
+                        if isinstance(values, list) and values:
+                            for value in values:
+                                unwound.append(dict(_copy(document)))
+                                _set_path(unwound[-1], path, value)
+                        elif specification.get('preserveNullAndEmptyArrays'):
+                            unwound.append(document)
+                    documents = unwound
+                elif op == '$project':
+                    documents = [_project_stage(document, specification) for document in documents]
+                else:
+                    raise OperationFailure('Unrecognized pipeline stage name: {}'.format(op), code=40324)
+            return iter(documents if documents is not None else self._find({}))
+
+    def create_index(self, keys, name=None, unique=False, partialFilterExpression=None, expireAfterSeconds=None,
+                     weights=None, **kwargs):
+        keys = _sort_specification(keys)
+        name = name or '_'.join('{}_{}'.format(field, direction) for field, direction in keys)
+        with self.database._transaction():
+            if name in self._indexes:
+                return name
+            index = _Index(name, keys, unique, partialFilterExpression, expireAfterSeconds, weights)
+            if index.text_weights and any(existing.text_weights for existing in self._indexes.values()):
+                raise OperationFailure('An equivalent text index already exists', code=85)
+            for key, document in self._documents.items():
+                index.check(key, document, self.full_name)
+                index.add(key, document)
+            if index.fields and index.fields[0] not in self._lookups:
+                lookup = self._lookups[index.fields[0]] = _FieldLookup(index.fields[0])
+                for key, document in self._documents.items():
+                    lookup.add(key, document)
+            self._indexes[name] = index
+            self.database._persist_index(self.name, index)
+            return name
+
+    def index_information(self):
+        information = {'_id_': {'key': [('_id', 1)]}}
+        for name, index in self._indexes.items():
+            information[name] = dict(index.specification(), key=list(index.keys))
+            del information[name]['name']
+        return information
+
+
+
+def _apply_update(document, update, inserting):
+    if isinstance(update, list):
+        # Aggregation pipeline update
+        for stage in update:
+            (op, specification), = stage.items()
+            if op == '$set':
+                values = {field: _evaluate(expression, document) for field, expression in specification.items()}
+                for field, value in values.items():
+                    _set_path(document, field, value)
+            else:
+                raise OperationFailure('{} is not allowed to be used within an update'.format(op), code=72)
+        return document
+    for op, fields in update.items():
+        if op == '$setOnInsert' and not inserting:
+            continue
+        for path, value in fields.items():
+            current = _get_path(document, path)
+            if op in ('$set', '$setOnInsert'):
+                _set_path(document, path, _copy(value))
+            elif op == '$unset':
+                _unset_path(document, path)
+            elif op == '$inc':
+                if current is not None and not isinstance(current, (int, float)):
+                    raise OperationFailure('Cannot apply $inc to a value of non-numeric type', code=14)
+                _set_path(document, path, (current or 0) + value)
+            elif op == '$max':
+                if current is None or _sort_key(value) > _sort_key(current):
+                    _set_path(document, path, _copy(value))
+            else:
+                raise OperationFailure("Unknown modifier: {}".format(op), code=9)
+    return document
+
+
+# Databases -------------------------------------------------------------------------------------------------------------
+class Database:
+    """
+    A set of collections, kept in memory and optionally persisted to a SQLite file
+    (one table per collection holding BSON documents, plus the index definitions).
+    """
+
+    def __init__(self, name='chat-db', path=None):
+        self.name = name
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._collections = {}
+        self._connection = None
+        if path:
+            self._open(path)
+
+    def __repr__(self):
+        return 'Database({!r}, {!r})'.format(self.name, self.path)
+
+    def _open(self, path):
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level='DEFERRED')
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS _indexes '
+                                 '(collection TEXT, name TEXT, specification BLOB, PRIMARY KEY (collection, name))')
+        tables = [row[0] for row in self._connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name != '_indexes'")]
+        for table in tables:
+            collection = self._collections[table] = Collection(self, table)
+            for (document,) in self._connection.execute('SELECT document FROM {}'.format(self._table(table))):
+                document = bson.decode(document)
+                collection._documents[_sort_key(document['_id'])] = document
+        for name, specification in self._connection.execute('SELECT collection, specification FROM _indexes').fetchall():
+            specification = bson.decode(specification)
+            self.get_collection(name).create_index([tuple(key) for key in specification['key']], name=specification['name'],
+                                    unique=specification.get('unique', False),
+                                    partialFilterExpression=specification.get('partialFilterExpression'),
+                                    expireAfterSeconds=specification.get('expireAfterSeconds'),
+                                    weights=specification.get('weights'))
+        self._connection.commit()
+
+    @staticmethod
+    def _table(name):
+        return '"{}"'.format(name.replace('"', '""'))
+
+    @contextmanager
+    def _transaction(self):
+        # Hold the lock for the whole write and commit once the outermost write finishes
+        with self._lock:
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0 and self._connection is not None:
+                    self._connection.commit()
+
+    def _persist(self, collection, document):
+        if self._connection is not None:
+            self._connection.execute('INSERT OR REPLACE INTO {} (id, document) VALUES (?, ?)'.format(self._table(collection)),
+                                     (bson.encode({'_id': document['_id']}), bson.encode(document)))
+
+    def _persist_delete(self, collection, document_id):
+        if self._connection is not None:
+            self._connection.execute('DELETE FROM {} WHERE id = ?'.format(self._table(collection)),
+                                     (bson.encode({'_id': document_id}),))
+
+    def _persist_index(self, collection, index, drop=False):
+        if self._connection is None:
+            return
+        if drop:
+            self._connection.execute('DELETE FROM _indexes WHERE collection = ? AND name = ?', (collection, index.name))
+        else:
+            self._connection.execute('INSERT OR REPLACE INTO _indexes (collection, name, specification) VALUES (?, ?, ?)',
+                                     (collection, index.name, bson.encode(index.specification())))
+
+    def get_collection(self, name, **kwargs):
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = self._collections[name] = Collection(self, name)
+                if self._connection is not None:
+                    self._connection.execute('CREATE TABLE IF NOT EXISTS {} (id BLOB PRIMARY KEY, document BLOB)'
+                                             .format(self._table(name)))
+                    self._connection.commit()
+            return collection
+
+    def __getitem__(self, name):
+        return self.get_collection(name)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,70 @@
+import threading
+import time
+
+from cache import TTLCache
+
+
+class RevocationList:
+    """
+    Revoked token ids (jti), checked in memory on every request and socket event.
+
+    `save(jti, expires_at)` persists a revocation and `load()` returns every revocation
+    that has not expired as {jti: expires_at (epoch seconds)}. The local set is reloaded
+    at most every `refresh_interval` seconds, so revocations made by other workers apply
+    here within that delay without a database lookup per check.
+    """
+
+    def __init__(self, save, load, refresh_interval=5.0):
+        self.save = save
+        self.load = load
+        self.refresh_interval = refresh_interval
+        self._revoked = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def revoke(self, jti, expires_at):
+        with self._lock:
+            self._revoked[jti] = expires_at
+        self.save(jti, expires_at)
+
+    def is_revoked(self, jti):
+        self._refresh()
+        expires_at = self._revoked.get(jti)
+        return expires_at is not None and expires_at > time.time()
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._loaded_at is not None and now - self._loaded_at < self.refresh_interval:
+            return
+        self._loaded_at = now
+        try:
+            revoked = self.load()
+        except Exception:
+            # Keep the last known list if the database is unavailable; retry next interval
+            return
+        with self._lock:
+            self._revoked.update(revoked)
+            current = time.time()
+            for jti in [jti for jti, expires_at in self._revoked.items() if expires_at <= current]:
+                del self._revoked[jti]
+
+
+class ClaimsCache:
+    """
+    Decoded JWT claims keyed by the raw token, so a token is verified once and reused
+    for `ttl` seconds (never past its own expiry).
+    """
+
+    def __init__(self, decode, maxsize=10000, ttl=60.0):
+        self.decode = decode
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def claims(self, token):
+        claims = self._cache.get_or_load(token, lambda: self.decode(token))
+        if claims.get('exp') is not None and claims['exp'] <= time.time():
+            self._cache.discard(token)
+            raise ValueError('Token has expired')
+        return claims
+
+    def stats(self):
+        return self._cache.stats()
@@ -0,0 +1,96 @@
+import argparse
+from dotenv import load_dotenv
+
+# Load environment variables before db connects
+load_dotenv()
+import db
+import embedded
+from message_writer import DEAD_LETTER_PATH, DeadLetterFile
+
+
+def migrate_messages(args):
+    migrated = db.migrate_chat_lists(batch_size=args.batch_size)
+    print(f"Migrated {migrated} messages from chat_room.chat_list to messages")
+
+
+def replay_messages(args):
+    replayed = DeadLetterFile(args.path).replay(db.add_messages)
+    print(f"Replayed {replayed} messages from {args.path}")
+
+
+def backfill_users(args):
+    updated = db.backfill_username_lower()
+    print(f"Set username_lower on {updated} users")
+
+
+def backfill_direct_rooms(args):
+    result = db.backfill_direct_pair_keys()
+    print(f"Set pair_key on {result['updated']} direct rooms")
+    if result['duplicates']:
+        print(f"Duplicate direct rooms left without a pair_key: {', '.join(result['duplicates'])}")
+
+
+def backfill_sequences(args):
+    updated = db.backfill_message_seqs()
+    print(f"Assigned sequence numbers to {updated} messages")
+
+
+def compact_messages(args):
+    result = db.compact_messages()
+    print(f"Archived {result['archived']} messages and deleted {result['expired']} expired messages")
+
+
+def ensure_indexes(args):
+    db.ensure_indexes()
+    print("Indexes are up to date")
+
+
+def check_queries(args):
+    # The embedded engine has no query planner, so there is nothing to explain
+    if isinstance(db.chat_db, embedded.Database):
+        raise SystemExit("check-queries needs MongoDB (MONGO_URI); the embedded engine cannot explain queries")
+    problems = 0
+    for entry in db.explain_queries():
+        status = 'COLLSCAN' if entry['collscan'] else 'SORT' if entry['blocking_sort'] else 'ok'
+        print(f"{status:8} {entry['collection']:13} {entry['name']:30} {' <- '.join(entry['stages'])}")
+        problems += entry['collscan'] or entry['blocking_sort']
+    if problems:
+        raise SystemExit(f"{problems} queries still do a collection scan or an in-memory sort")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Chat server maintenance commands')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate-messages', help='Move legacy chat_list arrays into the messages collection')
+    migrate_parser.add_argument('--batch-size', type=int, default=1000)
+    migrate_parser.set_defaults(func=migrate_messages)
+
+    replay_parser = subparsers.add_parser('replay-messages', help='Write messages whose batched write failed (see MESSAGE_DEAD_LETTER_PATH)')
+    replay_parser.add_argument('--path', default=DEAD_LETTER_PATH)
+    replay_parser.set_defaults(func=replay_messages)
+
+    backfill_parser = subparsers.add_parser('backfill-users', help='Add the username_lower search field to existing users')
+    backfill_parser.set_defaults(func=backfill_users)
+
+    direct_parser = subparsers.add_parser('backfill-direct-rooms', help='Add the unique pair_key to existing direct rooms')
+    direct_parser.set_defaults(func=backfill_direct_rooms)
+
+    sequences_parser = subparsers.add_parser('backfill-sequences', help='Assign per-room sequence numbers to messages without one')
+    sequences_parser.set_defaults(func=backfill_sequences)
+
+    compact_parser = subparsers.add_parser('compact-messages', help='Apply retention policies and archive old messages')
+    compact_parser.set_defaults(func=compact_messages)
+
+    indexes_parser = subparsers.add_parser('ensure-indexes', help='Create the indexes used by db.py (idempotent)')
+    indexes_parser.set_defaults(func=ensure_indexes)
+
+    check_parser = subparsers.add_parser('check-queries', help='Explain every db.py query shape and report collection scans')
+    check_parser.set_defaults(func=check_queries)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
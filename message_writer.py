@@ -0,0 +1,175 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+import bson
+
+logger = logging.getLogger(__name__)
+
+# Where batches that could not be written are kept until replayed (see DeadLetterFile)
+DEAD_LETTER_PATH = os.getenv('MESSAGE_DEAD_LETTER_PATH', 'unwritten-messages.bson')
+
+
+class MessageWriter:
+    """
+    Write-behind queue for chat messages.
+
+    Messages are queued and written by a background thread in bulk, either when
+    `batch_size` messages are pending or `flush_interval` seconds after the first
+    one arrived. The queue holds at most `max_pending` messages; when it is full,
+    `submit` waits up to `put_timeout` seconds and then writes the message itself,
+    so a slow database pushes back on senders instead of growing memory.
+    `on_written(batch)` is called after each batch is written. A batch that still fails
+    after `max_retries` attempts is passed to `on_failure(batch)` (e.g. DeadLetterFile.save),
+    since its messages have already been broadcast.
+    """
+
+    def __init__(self, write_many, batch_size=100, flush_interval=0.05, max_pending=10000,
+                 put_timeout=1.0, max_retries=3, on_written=None, on_failure=None):
+        self.write_many = write_many
+        self.on_written = on_written
+        self.on_failure = on_failure
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+            self._thread.start()
+
+    def submit(self, message):
+        if self._thread is None or self._stopped.is_set():
+            self._write([message])
+            return
+        try:
+            self._queue.put(message, timeout=self.put_timeout)
+        except queue.Full:
+            logger.warning("Message write queue is full, writing synchronously")
+            self._write([message])
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        """
+        Block until every message queued so far has been written.
+        """
+        if self._thread is None:
+            return
+        self._queue.join()
+
+    def close(self):
+        """
+        Stop the background thread and write any messages still queued.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._write(self._drain(self._queue.qsize()))
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._write(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _drain(self, count):
+        batch = []
+        for _ in range(count):
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            self._queue.task_done()
+        return batch
+
+    def _write(self, batch):
+        if not batch:
+            return
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                self.write_many(batch)
+            except Exception as e:
+                logger.error("Failed to write %d messages (attempt %d/%d): %s", len(batch), attempt, self.max_retries, e)
+                time.sleep(min(0.1 * attempt, 1.0))
+                continue
+            if self.on_written:
+                try:
+                    self.on_written(batch)
+                except Exception as e:
+                    logger.error("Failed to announce %d written messages: %s", len(batch), e)
+            return
+        logger.error("Giving up on %d messages after %d failed attempts", len(batch), self.max_retries)
+        if self.on_failure:
+            try:
+                self.on_failure(batch)
+            except Exception as e:
+                logger.error("Lost %d messages: %s", len(batch), e)
+
+
+class DeadLetterFile:
+    """
+    Append-only file of messages that could not be written, stored as consecutive BSON
+    documents so they keep their _id, seq and datetimes. `replay` writes them again
+    once the database is back; messages that did reach it are skipped as duplicates.
+    """
+
+    def __init__(self, path=DEAD_LETTER_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def save(self, messages):
+        data = b''.join(bson.encode(message) for message in messages)
+        with self._lock, open(self.path, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def replay(self, write_many, batch_size=1000):
+        """
+        Write every saved message with `write_many` and remove the file. Returns the number replayed.
+        """
+        replaying = self.path + '.replaying'
+        with self._lock:
+            # A replay that failed part way is finished first; messages saved while
+            # replaying go to a fresh file
+            if not os.path.exists(replaying):
+                if not os.path.exists(self.path):
+                    return 0
+                os.replace(self.path, replaying)
+        replayed = 0
+        with open(replaying, 'rb') as f:
+            batch = []
+            for message in bson.decode_file_iter(f):
+                batch.append(message)
+                if len(batch) >= batch_size:
+                    write_many(batch)
+                    replayed += len(batch)
+                    batch = []
+            if batch:
+                write_many(batch)
+                replayed += len(batch)
+        os.remove(replaying)
+        return replayed
@@ -0,0 +1,237 @@
+from contextvars import ContextVar
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = []
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _header(self):
+        return ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.type)]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            for labels, value in self._values.items():
+                lines.append('{}{} {}'.format(self.name, _format_labels(self.labelnames, labels), value))
+        return lines
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down. With `function`, the value is read when scraped.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self):
+        lines = self._header()
+        if self.function is not None:
+            values = self.function()
+            values = values.items() if isinstance(values, dict) else [((), values)]
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        for labels, value in values:
+            lines.append('{}{} {}'.format(self.name, _format_labels(self.labelnames, labels), value))
+        return lines
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def render(self):
+        lines = self._header()
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(self.name, _format_labels(self.labelnames, labels, [('le', le)]), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, _format_labels(self.labelnames, labels), total))
+            lines.append('{}_count{} {}'.format(self.name, _format_labels(self.labelnames, labels), cumulative))
+        return lines
+
+
+def render():
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics --------------------------------------------------------------------------------------------------------------
+db_operation_seconds = Histogram('chat_db_operation_seconds', 'Time spent in db.py operations', ['operation'])
+db_operation_errors = Counter('chat_db_operation_errors_total', 'db.py operations that raised', ['operation'])
+mongo_command_seconds = Histogram('chat_mongo_command_seconds', 'MongoDB command round-trip time', ['command'])
+mongo_command_failures = Counter('chat_mongo_command_failures_total', 'MongoDB commands that failed', ['command'])
+http_request_seconds = Histogram('chat_http_request_seconds', 'Flask request latency', ['method', 'endpoint', 'status'])
+mongo_calls_per_request = Histogram('chat_mongo_calls_per_request', 'MongoDB commands issued per HTTP request or socket event',
+                                    ['handler'], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100))
+socketio_event_seconds = Histogram('chat_socketio_event_seconds', 'Socket.IO event handler latency', ['event'])
+broadcast_fanout = Histogram('chat_broadcast_fanout', 'Local recipients per room broadcast',
+                             buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000))
+messages_write_failed = Counter('chat_message_write_failures_total', 'Messages whose batched write failed after retries',
+                                ['outcome'])
+messages_archived = Counter('chat_messages_archived_total', 'Messages moved into archive segments')
+messages_expired = Counter('chat_messages_expired_total', 'Messages deleted by retention policies')
+socketio_events_throttled = Counter('chat_socketio_events_throttled_total', 'send_message events refused by rate limits',
+                                    ['scope'])
+socketio_events_dropped = Counter('chat_socketio_events_dropped_total', 'Outbound events dropped for slow consumers',
+                                  ['policy'])
+
+
+# Per-request accounting -----------------------------------------------------------------------------------------------
+class RequestStats:
+    def __init__(self, handler):
+        self.handler = handler
+        self.start = time.perf_counter()
+        self.mongo_calls = 0
+        self.mongo_seconds = 0.0
+
+
+_request_stats = ContextVar('request_stats', default=None)
+
+
+def begin(handler):
+    """
+    Start counting MongoDB calls for the current request or socket event.
+    """
+    stats = RequestStats(handler)
+    return stats, _request_stats.set(stats)
+
+
+def end(stats, token, slow_threshold=None):
+    _request_stats.reset(token)
+    elapsed = time.perf_counter() - stats.start
+    mongo_calls_per_request.observe(stats.mongo_calls, stats.handler)
+    if slow_threshold and elapsed >= slow_threshold:
+        logger.warning("Slow %s: %.1f ms, %d MongoDB calls (%.1f ms)",
+                       stats.handler, elapsed * 1000, stats.mongo_calls, stats.mongo_seconds * 1000)
+    return elapsed
+
+
+class _CommandListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        mongo_command_failures.inc(event.command_name)
+        self._record(event)
+
+    def _record(self, event):
+        seconds = event.duration_micros / 1e6
+        mongo_command_seconds.observe(seconds, event.command_name)
+        stats = _request_stats.get()
+        if stats is not None:
+            stats.mongo_calls += 1
+            stats.mongo_seconds += seconds
+
+
+# Applies to MongoClients created after this module is imported
+monitoring.register(_CommandListener())
+
+
+def instrument_module(module_globals, module_name):
+    """
+    Replace every public function defined in a module with a timed wrapper. Calls
+    inside the module resolve the names at call time, so they are timed as well.
+    """
+    for name, function in list(module_globals.items()):
+        if (name.startswith('_') or not inspect.isfunction(function) or function.__module__ != module_name
+                or inspect.isgeneratorfunction(function)):
+            continue
+        module_globals[name] = _timed_operation(name, function)
+
+
+def _timed_operation(name, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        except Exception:
+            db_operation_errors.inc(name)
+            raise
+        finally:
+            db_operation_seconds.observe(time.perf_counter() - start, name)
+    return wrapper
+
+
+def timed_event(event, slow_threshold=None):
+    """
+    Decorator for Socket.IO handlers: records latency and MongoDB calls per event.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            stats, token = begin('socketio:' + event)
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                socketio_event_seconds.observe(end(stats, token, slow_threshold), event)
+        return wrapper
+    return decorator
@@ -0,0 +1,42 @@
+import os
+import threading
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# werkzeug method string for new hashes, e.g. "scrypt:16384:8:1" or "pbkdf2:sha256:260000".
+# Unset keeps werkzeug's default. When set, stored hashes made another way are upgraded on login.
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD')
+# Hashes computed at the same time; further logins wait for a free slot
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 4))
+
+_slots = threading.BoundedSemaphore(PASSWORD_HASH_WORKERS)
+
+
+def _offload(function, *args):
+    # Under eventlet, run the CPU-bound hash on a real OS thread (eventlet.tpool) so the
+    # event loop keeps serving sockets; hashlib releases the GIL while it works
+    with _slots:
+        try:
+            from eventlet import patcher, tpool
+            if patcher.is_monkey_patched('thread'):
+                return tpool.execute(function, *args)
+        except ImportError:
+            pass
+        return function(*args)
+
+
+def hash_password(password):
+    if PASSWORD_HASH_METHOD:
+        return _offload(generate_password_hash, password, PASSWORD_HASH_METHOD)
+    return _offload(generate_password_hash, password)
+
+
+def check_password(password_hash, password):
+    return _offload(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """
+    Whether a stored hash was made with a different method than PASSWORD_HASH_METHOD.
+    """
+    return bool(PASSWORD_HASH_METHOD) and password_hash.split('$', 1)[0] != PASSWORD_HASH_METHOD
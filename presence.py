@@ -0,0 +1,214 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _Session:
+    def __init__(self, username, now):
+        self.username = username
+        self.last_seen = now
+        self.active = True
+        self.rooms = set()
+
+
+class PresenceTracker:
+    """
+    Who is online and who is typing in each room, kept in this worker's memory.
+
+    A user is online in a room while one of their connections has joined it and sent
+    a heartbeat (or any activity) within `heartbeat_ttl` seconds. A typing flag lasts
+    `typing_ttl` seconds unless refreshed. Changes are not broadcast as they happen:
+    they are collected per room and `drain()` returns only the net change since the
+    previous call, so reconnects, repeated keystrokes and typing refreshes inside one
+    `flush_interval` cost at most one `presence` event per room.
+    """
+
+    def __init__(self, heartbeat_ttl=60.0, typing_ttl=5.0, flush_interval=0.5):
+        self.heartbeat_ttl = heartbeat_ttl
+        self.typing_ttl = typing_ttl
+        self.flush_interval = flush_interval
+        self._sessions = {}
+        # room id -> {username: online connections}
+        self._online = {}
+        # room id -> {username: typing expiry}
+        self._typing = {}
+        # room id -> {username: online before the first unsent change}
+        self._changed = {}
+        # room ids whose typing list may differ from the last one sent, and what was sent
+        self._typing_changed = set()
+        self._typing_sent = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    # Connections ------------------------------------------------------------------------------------------------------
+    def connect(self, sid, username):
+        with self._lock:
+            self._sessions[sid] = _Session(username, time.monotonic())
+
+    def disconnect(self, sid):
+        with self._lock:
+            session = self._sessions.pop(sid, None)
+            if session and session.active:
+                for room_id in session.rooms:
+                    self._remove(room_id, session.username)
+
+    def join(self, sid, room_id):
+        with self._lock:
+            session = self._touch(sid)
+            if session and room_id not in session.rooms:
+                session.rooms.add(room_id)
+                if session.active:
+                    self._add(room_id, session.username)
+
+    def leave(self, sid, room_id):
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session and room_id in session.rooms:
+                session.rooms.discard(room_id)
+                if session.active:
+                    self._remove(room_id, session.username)
+
+    def heartbeat(self, sid):
+        with self._lock:
+            self._touch(sid)
+
+    def typing(self, sid, room_id, is_typing=True):
+        """
+        Set or clear the user's typing flag in a room. Refreshing a flag that is
+        already set only extends it, so clients may call this on every keystroke.
+        """
+        with self._lock:
+            session = self._touch(sid)
+            if session is None or room_id not in session.rooms:
+                return
+            typing = self._typing.setdefault(room_id, {})
+            if is_typing:
+                if session.username not in typing:
+                    self._typing_changed.add(room_id)
+                typing[session.username] = time.monotonic() + self.typing_ttl
+            elif typing.pop(session.username, None) is not None:
+                self._typing_changed.add(room_id)
+            if not typing:
+                del self._typing[room_id]
+
+    # Snapshots --------------------------------------------------------------------------------------------------------
+    def online(self, room_id):
+        with self._lock:
+            return sorted(self._online.get(room_id, ()))
+
+    def snapshot(self, room_id):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                'room': room_id,
+                'online': sorted(self._online.get(room_id, ())),
+                'typing': sorted(username for username, expires in self._typing.get(room_id, {}).items() if expires > now)
+            }
+
+    # Broadcasts -------------------------------------------------------------------------------------------------------
+    def expire(self):
+        """
+        Mark connections without a recent heartbeat offline and drop stale typing flags.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for session in self._sessions.values():
+                if session.active and session.last_seen + self.heartbeat_ttl <= now:
+                    session.active = False
+                    for room_id in session.rooms:
+                        self._remove(room_id, session.username)
+            for room_id in list(self._typing):
+                typing = self._typing[room_id]
+                for username in [username for username, expires in typing.items() if expires <= now]:
+                    del typing[username]
+                    self._typing_changed.add(room_id)
+                if not typing:
+                    del self._typing[room_id]
+
+    def drain(self):
+        """
+        Return {room id: {'room', 'joined', 'left', 'typing'}} for rooms whose presence
+        changed since the last call. `typing` is the full list of users typing.
+        """
+        with self._lock:
+            updates = {}
+            for room_id, before in self._changed.items():
+                online = self._online.get(room_id, {})
+                joined = sorted(username for username, was_online in before.items() if not was_online and username in online)
+                left = sorted(username for username, was_online in before.items() if was_online and username not in online)
+                if joined or left:
+                    updates[room_id] = {'room': room_id, 'joined': joined, 'left': left}
+            for room_id in self._typing_changed:
+                typing = sorted(self._typing.get(room_id, ()))
+                if typing != self._typing_sent.get(room_id, []):
+                    updates.setdefault(room_id, {'room': room_id, 'joined': [], 'left': []})
+                    if typing:
+                        self._typing_sent[room_id] = typing
+                    else:
+                        self._typing_sent.pop(room_id, None)
+            for room_id, update in updates.items():
+                update['typing'] = self._typing_sent.get(room_id, [])
+            self._changed.clear()
+            self._typing_changed.clear()
+            return updates
+
+    def start(self, emit):
+        """
+        Every `flush_interval` seconds, expire stale presence and call `emit(room_id, update)`
+        for each room in drain(), on a background thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(emit,), name='presence', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, emit):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.expire()
+                for room_id, update in self.drain().items():
+                    emit(room_id, update)
+            except Exception as e:
+                logger.error("Failed to broadcast presence: %s", e)
+
+    # Internals (called with the lock held) ----------------------------------------------------------------------------
+    def _touch(self, sid):
+        session = self._sessions.get(sid)
+        if session is None:
+            return None
+        session.last_seen = time.monotonic()
+        if not session.active:
+            session.active = True
+            for room_id in session.rooms:
+                self._add(room_id, session.username)
+        return session
+
+    def _add(self, room_id, username):
+        online = self._online.setdefault(room_id, {})
+        if username not in online:
+            self._changed.setdefault(room_id, {}).setdefault(username, False)
+        online[username] = online.get(username, 0) + 1
+
+    def _remove(self, room_id, username):
+        online = self._online.get(room_id)
+        if not online or username not in online:
+            return
+        online[username] -= 1
+        if online[username] == 0:
+            del online[username]
+            self._changed.setdefault(room_id, {}).setdefault(username, True)
+            # Going offline also ends typing
+            if self._typing.get(room_id, {}).pop(username, None) is not None:
+                self._typing_changed.add(room_id)
+                if not self._typing[room_id]:
+                    del self._typing[room_id]
+        if not online:
+            del self._online[room_id]
@@ -0,0 +1,98 @@
+import threading
+import time
+
+
+class AttemptLimiter:
+    """
+    Counts failed attempts per key (username, IP address, ...) in a fixed window and
+    blocks the key once it reaches `max_attempts` until the window ends.
+    """
+
+    def __init__(self, max_attempts, window, max_keys=100000):
+        self.max_attempts = max_attempts
+        self.window = window
+        self.max_keys = max_keys
+        self.blocked_total = 0
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def retry_after(self, key):
+        """
+        Seconds until the key may try again, or 0 if it is not blocked.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._attempts.get(key)
+            if entry is None or entry[1] <= now:
+                return 0
+            if entry[0] < self.max_attempts:
+                return 0
+            self.blocked_total += 1
+            return entry[1] - now
+
+    def record(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._attempts.get(key)
+            if entry is None or entry[1] <= now:
+                if len(self._attempts) >= self.max_keys:
+                    self._prune(now)
+                self._attempts[key] = [1, now + self.window]
+            else:
+                entry[0] += 1
+
+    def reset(self, key):
+        with self._lock:
+            self._attempts.pop(key, None)
+
+    def _prune(self, now):
+        for key in [key for key, entry in self._attempts.items() if entry[1] <= now]:
+            del self._attempts[key]
+
+
+class TokenBucketLimiter:
+    """
+    Token bucket per key (connection, room, ...): each key may act `burst` times at once
+    and then `rate` times per second on average. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.throttled_total = 0
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, tokens=1):
+        """
+        Take `tokens` from the key's bucket. Returns 0 if they were available, otherwise
+        the seconds until they will be (nothing is taken then).
+        """
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._prune(now)
+                bucket = self._buckets[key] = [self.burst, now]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= tokens:
+                bucket[0] -= tokens
+                return 0
+            self.throttled_total += 1
+            return (tokens - bucket[0]) / self.rate
+
+    def discard(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def _prune(self, now):
+        # Buckets that have refilled completely are the same as new ones
+        for key in [key for key, (tokens, updated) in self._buckets.items()
+                    if tokens + (now - updated) * self.rate >= self.burst]:
+            del self._buckets[key]
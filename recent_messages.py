@@ -0,0 +1,180 @@
+from collections import OrderedDict, deque
+import threading
+import time
+
+# Rough per-message bookkeeping cost on top of the text itself (dict, strings, datetime)
+MESSAGE_OVERHEAD_BYTES = 400
+
+
+def _message_size(message):
+    return MESSAGE_OVERHEAD_BYTES + len(message['sender'] or '') + len(message['message'] or '')
+
+
+def latest_page(messages, limit, complete):
+    """
+    Build a get_messages_page-style page from the newest `limit` of `messages`.
+    """
+    page = messages[-limit:]
+    return {
+        'messages': page,
+        'has_more': len(messages) > limit or not complete,
+        'before': page[0]['id'] if page else None,
+        'after': page[-1]['id'] if page else None
+    }
+
+
+class _RoomBuffer:
+    def __init__(self, per_room):
+        self.messages = deque(maxlen=per_room)
+        self.size = 0
+        # warm: holds the room's newest messages as read from the database (until warm_until)
+        # complete: holds the room's entire history
+        self.warm = False
+        self.warm_until = None
+        self.complete = False
+
+
+class RecentMessages:
+    """
+    Per-room ring buffers of the newest messages, used to serve the latest history
+    page without a database read.
+
+    Messages are appended as they are sent. A room's buffer is warmed on its first
+    read from a database page and merged with anything sent meanwhile. Rooms are
+    evicted least-recently-used once the buffers together exceed `max_bytes`.
+    With several workers a buffer only sees messages sent through its own worker, so
+    `ttl` makes warm buffers re-read the database after that many seconds.
+    """
+
+    def __init__(self, per_room=100, max_bytes=64 * 1024 * 1024, ttl=None):
+        self.per_room = per_room
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._rooms = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, room_id, message):
+        """
+        Append a sent message ({'id', 'seq', 'sender', 'message', 'created_at'}) to the room's buffer.
+        Its seq may be None until the message is written (see `sequenced`).
+        """
+        with self._lock:
+            room = self._room(room_id)
+            if len(room.messages) == room.messages.maxlen:
+                self._drop_oldest(room)
+            room.messages.append(message)
+            room.size += _message_size(message)
+            self.size += _message_size(message)
+            self._evict()
+
+    def sequenced(self, room_id, seqs):
+        """
+        Record the sequence numbers ({message id: seq}) given to buffered messages when they were written.
+        """
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None:
+                return
+            for message in room.messages:
+                if message['id'] in seqs:
+                    message['seq'] = seqs[message['id']]
+
+    def latest(self, room_id, limit):
+        """
+        The newest page of the room's messages, or None if the buffer cannot serve it.
+        """
+        limit = max(1, limit)
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if (room is None or not room.warm or (room.warm_until and room.warm_until < time.monotonic())
+                    or (len(room.messages) < limit and not room.complete)):
+                self.misses += 1
+                return None
+            self._rooms.move_to_end(room_id)
+            self.hits += 1
+            return latest_page(list(room.messages), limit, room.complete)
+
+    def since(self, room_id, seq, limit):
+        """
+        Up to `limit` buffered messages from sequence number seq + 1 on, or None if the
+        buffer does not reach back to seq + 1 or has a gap in the numbers (e.g. messages
+        sent through another worker), so the caller falls back to the database.
+        Messages whose seq is not allocated yet are left out.
+        """
+        limit = max(1, limit)
+        with self._lock:
+            room = self._rooms.get(room_id)
+            if room is None or not room.warm or (room.warm_until and room.warm_until < time.monotonic()):
+                self.misses += 1
+                return None
+            seqs = sorted(message['seq'] for message in room.messages if message['seq'] is not None)
+            newer = sorted((message for message in room.messages if message['seq'] is not None and message['seq'] > seq),
+                           key=lambda message: message['seq'])
+            reaches_back = room.complete or (seqs and seqs[0] <= seq + 1)
+            contiguous = all(message['seq'] == seq + 1 + index for index, message in enumerate(newer[:limit + 1]))
+            if not reaches_back or not contiguous:
+                self.misses += 1
+                return None
+            self._rooms.move_to_end(room_id)
+            self.hits += 1
+        page = newer[:limit]
+        return {
+            'messages': page,
+            'has_more': len(newer) > limit,
+            'last_seq': page[-1]['seq'] if page else seq
+        }
+
+    def warm(self, room_id, page):
+        """
+        Fill the room's buffer from a latest page read from the database
+        (get_messages_page without cursors), keeping messages sent since.
+        """
+        with self._lock:
+            room = self._room(room_id)
+            merged = {message['id']: message for message in page['messages']}
+            for message in room.messages:
+                merged.setdefault(message['id'], message)
+            messages = [merged[message_id] for message_id in sorted(merged)]
+            self.size -= room.size
+            room.messages.clear()
+            room.size = 0
+            for message in messages[-self.per_room:]:
+                room.messages.append(message)
+                room.size += _message_size(message)
+            self.size += room.size
+            room.warm = True
+            room.warm_until = time.monotonic() + self.ttl if self.ttl else None
+            room.complete = not page['has_more'] and len(messages) <= self.per_room
+            self._evict()
+
+    def discard(self, room_id):
+        with self._lock:
+            room = self._rooms.pop(room_id, None)
+            if room:
+                self.size -= room.size
+
+    def stats(self):
+        with self._lock:
+            return {'rooms': len(self._rooms), 'bytes': self.size, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def _room(self, room_id):
+        room = self._rooms.get(room_id)
+        if room is None:
+            room = self._rooms[room_id] = _RoomBuffer(self.per_room)
+        self._rooms.move_to_end(room_id)
+        return room
+
+    def _drop_oldest(self, room):
+        dropped = room.messages.popleft()
+        room.size -= _message_size(dropped)
+        self.size -= _message_size(dropped)
+        room.complete = False
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._rooms:
+            _, room = self._rooms.popitem(last=False)
+            self.size -= room.size
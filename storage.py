@@ -0,0 +1,38 @@
+"""
+Storage backends behind db.py.
+
+db.py reaches its collections only through the database returned by open_database()
+and the pymongo Collection API. STORAGE_URL picks the backend:
+  - mongodb:// or mongodb+srv:// (the default, taken from MONGO_URI): MongoDB via pymongo
+  - memory://: the embedded engine (embedded.py), nothing is persisted
+  - sqlite:///chat.db or sqlite:////var/lib/chat/chat.db: the embedded engine persisted
+    to a SQLite file (relative or absolute path)
+The embedded engine needs no server, so tests, benchmarks and single-node deployments
+start immediately and every query stays in process.
+"""
+import os
+
+from pymongo.mongo_client import MongoClient
+from pymongo.server_api import ServerApi
+
+import embedded
+
+STORAGE_URL = os.getenv("STORAGE_URL") or os.getenv("MONGO_URI")
+DATABASE_NAME = os.getenv("DATABASE_NAME", "chat-db")
+
+
+def open_database(url=STORAGE_URL, name=DATABASE_NAME):
+    if url and url.startswith('memory://'):
+        return embedded.Database(name)
+    if url and url.startswith('sqlite:///'):
+        return embedded.Database(name, url[len('sqlite:///'):])
+
+    # Create a new client and connect to the server
+    client = MongoClient(url, server_api=ServerApi('1'))
+    # Send a ping to confirm a successful connection
+    try:
+        client.admin.command('ping')
+        print("Pinged your deployment. You successfully connected to MongoDB!")
+    except Exception as e:
+        print(e)
+    return client.get_database(name)
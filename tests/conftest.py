@@ -0,0 +1,107 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+# Configure the app for in-process tests before anything imports it
+os.environ['EVENTLET_MONKEY_PATCH'] = '0'
+os.environ.setdefault('STORAGE_URL', 'memory://')
+os.environ['COMPACTION_INTERVAL'] = '0'
+os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1'
+os.environ.setdefault('JWT_SECRET_KEY', 'test-secret-key-test-secret-key-test')
+os.environ.pop('SOCKETIO_MESSAGE_QUEUE', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def app_module():
+    import app
+    return app
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def make_user(app_module):
+    """
+    Create a user with a unique name and return (username, access token).
+    """
+    import db
+    from flask_jwt_extended import create_access_token
+
+    def make(prefix='user'):
+        username = '{}-{}'.format(prefix, uuid.uuid4().hex[:8])
+        db.save_user(username, 'password')
+        with app_module.app.app_context():
+            return username, create_access_token(identity=username)
+    return make
+
+
+@pytest.fixture
+def make_room(client):
+    """
+    Create a room through the API as `token`'s user and return its id.
+    """
+    def make(token, members='', room_type='PrivateGroup', name='room'):
+        response = client.post('/create-room', headers={'Authorization': 'Bearer ' + token},
+                               json={'room_name': name, 'room_type': room_type, 'members': members})
+        assert response.status_code == 200, response.get_data(as_text=True)
+        return response.get_json()['room_id']
+    return make
+
+
+@pytest.fixture
+def connect(app_module):
+    """
+    Open authenticated Socket.IO test clients, disconnected after the test.
+    """
+    sockets = []
+
+    def connect(token):
+        socket = app_module.socketio.test_client(app_module.app, auth={'token': token})
+        assert socket.is_connected()
+        sockets.append(socket)
+        return socket
+    yield connect
+    for socket in sockets:
+        if socket.is_connected():
+            socket.disconnect()
+
+
+def auth(token):
+    return {'Authorization': 'Bearer ' + token}
+
+
+def post(client, token, path, body):
+    response = client.post(path, headers=auth(token), json=body)
+    return response.status_code, response.get_json()
+
+
+def history(client, token, room_id, **params):
+    response = client.get('/chatRoom/{}/'.format(room_id), headers=auth(token), query_string=params)
+    return response.status_code, response.get_json()
+
+
+def search(client, token, room_id, **params):
+    response = client.get('/chatRoom/{}/search'.format(room_id), headers=auth(token), query_string=params)
+    return response.status_code, response.get_json()
+
+
+def rooms_list(client, token, room_type, **params):
+    response = client.get('/rooms_list/{}'.format(room_type), headers=auth(token), query_string=params)
+    assert response.status_code == 200
+    return [room['_id'] for room in response.get_json()]
+
+
+def home_rooms(client, token):
+    response = client.get('/', headers=auth(token))
+    assert response.status_code == 200
+    return {room['room_id']: room for room in response.get_json()['rooms']}
+
+
+def received(socket, event):
+    return [packet['args'][0] for packet in socket.get_received() if packet['name'] == event]
@@ -0,0 +1,25 @@
+import asyncio
+
+import pytest
+
+import async_db
+
+
+def test_gather_returns_results_in_order(make_user, make_room):
+    _, token = make_user()
+    room_id = make_room(token)
+    room, members = async_db.gather(async_db.futures.get_room(room_id), async_db.futures.get_room_members(room_id))
+    assert str(room['_id']) == room_id
+    assert len(members) == 1
+
+
+def test_gather_reraises_errors(app_module):
+    with pytest.raises(ValueError):
+        async_db.gather(async_db.futures.get_messages_page('room', before='not-an-id'))
+
+
+def test_operations_can_be_awaited(make_user, make_room):
+    _, token = make_user()
+    room_id = make_room(token)
+    room = asyncio.run(async_db.aio.get_room(room_id))
+    assert str(room['_id']) == room_id
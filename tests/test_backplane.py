@@ -0,0 +1,41 @@
+import threading
+import uuid
+
+import socketio
+
+from backplane import ControlManager, LocalPubSubManager
+
+
+def _worker(channel):
+    server = socketio.Server(async_mode='threading', client_manager=LocalPubSubManager(channel=channel))
+    # Start the pub/sub listener, as the first socket connection would
+    server.manager_initialized = True
+    server.manager.initialize()
+    return server
+
+
+def test_control_messages_reach_every_worker():
+    channel = uuid.uuid4().hex
+    workers = [_worker(channel) for _ in range(3)]
+    received = []
+    done = threading.Event()
+
+    def handler(data):
+        received.append(data)
+        if len(received) == len(workers):
+            done.set()
+    for worker in workers:
+        worker.manager.on_control('unsubscribe', handler)
+
+    workers[0].manager.publish_control('unsubscribe', {'room': 'r', 'username': 'bob'})
+
+    assert done.wait(2)
+    assert received == [{'room': 'r', 'username': 'bob'}] * 3
+
+
+def test_control_messages_without_a_backplane_run_locally():
+    manager = ControlManager()
+    received = []
+    manager.on_control('unsubscribe', received.append)
+    manager.publish_control('unsubscribe', {'room': 'r'})
+    assert received == [{'room': 'r'}]
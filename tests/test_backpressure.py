@@ -0,0 +1,57 @@
+import queue
+from types import SimpleNamespace
+
+from engineio import packet as eio_packet
+import msgpack
+from socketio import packet as sio_packet
+
+from backpressure import OutboundLimiter
+
+
+def _limiter(policy, max_queue=3):
+    drops = []
+    socket = SimpleNamespace(queue=queue.Queue())
+    eio = SimpleNamespace(sockets={'sid': socket}, send_packet=lambda sid, pkt: socket.queue.put(pkt))
+    server = SimpleNamespace(eio=eio, start_background_task=lambda *args: None)
+    limiter = OutboundLimiter(max_queue=max_queue, policy=policy, on_drop=lambda policy, count: drops.append(count))
+    limiter.install(server)
+    return limiter, socket.queue, drops
+
+
+def _emit(limiter, event, data, id=None):
+    encoded = sio_packet.Packet(sio_packet.EVENT, data=[event, data], namespace='/', id=id).encode()
+    for part in encoded if isinstance(encoded, list) else [encoded]:
+        limiter.send_packet('sid', eio_packet.Packet(eio_packet.MESSAGE, data=part))
+
+
+def _queued(q):
+    return [pkt.data for pkt in q.queue]
+
+
+def test_drop_oldest_drops_a_binary_event_with_its_attachments():
+    limiter, q, drops = _limiter('drop_oldest')
+    _emit(limiter, 'receive_message', msgpack.packb(['room-a', 'id', 'alice', 'hi']))
+    _emit(limiter, 'receive_message', {'room': 'room-a', 'message': 'b'})
+    _emit(limiter, 'receive_message', {'room': 'room-a', 'message': 'c'})
+    assert len(q.queue) == 2
+    assert not any(isinstance(data, bytes) for data in _queued(q))
+    assert drops == [1]
+
+
+def test_coalesce_reads_rooms_of_binary_events():
+    limiter, q, drops = _limiter('coalesce', max_queue=2)
+    _emit(limiter, 'receive_message', {'room': 'room-a'})
+    _emit(limiter, 'receive_message', {'room': 'room-b'})
+    _emit(limiter, 'receive_message', msgpack.packb(['room-c', 'id', 'alice', 'hi']))
+    assert _queued(q) == ['2["resync",{"rooms":["room-a","room-b","room-c"]}]']
+    assert drops == [3]
+
+
+def test_disconnect_policy_drops_binary_events_and_keeps_acks():
+    limiter, q, drops = _limiter('disconnect', max_queue=1)
+    _emit(limiter, 'receive_message', {'room': 'room-a'})
+    _emit(limiter, 'receive_message', b'binary')
+    assert len(q.queue) == 1 and drops == [1]
+    # A binary event with an ack id is always sent
+    _emit(limiter, 'reply', b'binary', id=7)
+    assert len(q.queue) == 3
@@ -0,0 +1,42 @@
+from cache import TTLCache
+
+
+def test_get_or_load_caches_the_loaded_value():
+    cache = TTLCache(ttl=60)
+    calls = []
+    assert cache.get_or_load('room', lambda: calls.append(1) or 'value') == 'value'
+    assert cache.get_or_load('room', lambda: calls.append(1) or 'other') == 'value'
+    assert len(calls) == 1
+
+
+def test_invalidation_during_a_load_is_not_lost():
+    cache = TTLCache(ttl=60)
+
+    def load_then_invalidate():
+        # e.g. the member is removed while their membership row is being read
+        cache.discard('membership')
+        return 'stale'
+
+    assert cache.get_or_load('membership', load_then_invalidate) == 'stale'
+    assert cache.get('membership') is None
+    assert cache.get_or_load('membership', lambda: 'fresh') == 'fresh'
+    assert cache.get('membership') == 'fresh'
+
+
+def test_discard_many_and_discard_if_cancel_loads():
+    cache = TTLCache(ttl=60)
+    cache.get_or_load(('room', 'alice'), lambda: cache.discard_many([('room', 'alice')]) or 'stale')
+    cache.get_or_load(('room', 'bob'), lambda: cache.discard_if(lambda key: key[0] == 'room') or 'stale')
+    assert cache.get(('room', 'alice')) is None
+    assert cache.get(('room', 'bob')) is None
+
+
+def test_entries_are_evicted_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.stats()['evictions'] == 1
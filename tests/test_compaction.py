@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+import db
+
+
+def _old_messages(room_id, count, days_ago):
+    start = datetime.now(timezone.utc) - timedelta(days=days_ago)
+    messages = []
+    for i in range(count):
+        message = db.build_message(room_id, 'alice', 'old {}'.format(i))
+        message['_id'] = ObjectId.from_datetime(start + timedelta(seconds=i))
+        messages.append(message)
+    db.add_messages(messages)
+
+
+def test_old_messages_are_archived_and_still_readable(make_user, make_room):
+    _, token = make_user()
+    room_id = make_room(token, room_type='PublicGroup')
+    _old_messages(room_id, 5, days_ago=db.ARCHIVE_AFTER_DAYS + 10)
+
+    result = db.compact_messages()
+    assert result['archived'] >= 5
+    assert db.messages_collection.count_documents({'room_id': room_id}) == 0
+    assert db.message_archives_collection.count_documents({'room_id': room_id}) == 1
+
+    page = db.get_messages_page(room_id)
+    assert [message['message'] for message in page['messages']] == ['old {}'.format(i) for i in range(5)]
+    since = db.get_messages_since(room_id, 2)
+    assert [message['seq'] for message in since['messages']] == [3, 4, 5]
+
+
+def test_retention_deletes_expired_messages(monkeypatch, make_user, make_room):
+    _, token = make_user()
+    room_id = make_room(token, room_type='PublicGroup')
+    _old_messages(room_id, 3, days_ago=40)
+    db.add_messages([db.build_message(room_id, 'alice', 'new')])
+    monkeypatch.setitem(db.RETENTION_DAYS, 'PublicGroup', 30)
+
+    result = db.compact_messages()
+    assert room_id in result['pruned_rooms']
+    assert [message['message'] for message in db.get_messages_page(room_id)['messages']] == ['new']
@@ -0,0 +1,50 @@
+from datetime import datetime
+
+import db
+
+
+def _legacy_room(created_by, direct_to):
+    # A Direct room as created before pair_key existed
+    return str(db.rooms_collection.insert_one({'name': 'Direct', 'type': 'Direct', 'created_by': created_by,
+                                               'direct_to': direct_to, 'created_at': datetime.now()}).inserted_id)
+
+
+def test_direct_room_is_created_once_for_both_users(make_user):
+    alice, _ = make_user('alice')
+    bob, _ = make_user('bob')
+    room_id = db.direct_room(alice, bob)
+    assert db.direct_room(bob, alice) == room_id
+    assert db.direct_rooms(alice, [bob])['rooms'] == {bob: room_id}
+
+
+def test_direct_room_finds_and_keys_a_legacy_room(make_user):
+    alice, _ = make_user('alice')
+    bob, _ = make_user('bob')
+    oldest = _legacy_room(bob, alice)
+    _legacy_room(alice, bob)
+
+    assert db.direct_room(alice, bob) == oldest
+    assert db.rooms_collection.count_documents({'pair_key': db._direct_pair_key(alice, bob)}) == 1
+
+
+def test_direct_rooms_keys_legacy_rooms_in_batch(make_user):
+    alice, _ = make_user('alice')
+    bob, _ = make_user('bob')
+    carol, _ = make_user('carol')
+    legacy = _legacy_room(alice, bob)
+
+    result = db.direct_rooms(alice, [bob, carol])
+    assert result['rooms'][bob] == legacy
+    assert result['rooms'][carol] not in (legacy, None)
+    assert db.direct_room(carol, alice) == result['rooms'][carol]
+
+
+def test_backfill_keeps_the_oldest_room_of_a_pair(make_user):
+    alice, _ = make_user('alice')
+    bob, _ = make_user('bob')
+    oldest = _legacy_room(alice, bob)
+    duplicate = _legacy_room(bob, alice)
+
+    result = db.backfill_direct_pair_keys()
+    assert duplicate in result['duplicates']
+    assert db.direct_room(alice, bob) == oldest
@@ -0,0 +1,44 @@
+import pytest
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import embedded
+
+
+def test_queries_sorts_and_updates():
+    collection = embedded.Database().get_collection('items')
+    collection.insert_many([{'_id': i, 'group': i % 2, 'value': i * 10} for i in range(6)])
+    assert [item['_id'] for item in collection.find({'group': 1, 'value': {'$gt': 10}}).sort('_id', DESCENDING)] == [5, 3]
+    assert [item['_id'] for item in collection.find({'_id': {'$in': [4, 0, 2]}}).sort('value', ASCENDING).limit(2)] == [0, 2]
+    assert collection.count_documents({'group': 0}) == 3
+
+    collection.update_one({'_id': 1}, {'$max': {'value': 5}})
+    assert collection.find_one({'_id': 1})['value'] == 10
+    counter = collection.find_one_and_update({'_id': 'counter'}, {'$inc': {'n': 2}}, upsert=True,
+                                             return_document=ReturnDocument.AFTER)
+    assert counter == {'_id': 'counter', 'n': 2}
+
+
+def test_unique_partial_indexes_are_enforced():
+    collection = embedded.Database().get_collection('rooms')
+    collection.create_index([('pair_key', ASCENDING)], name='pair_key_1', unique=True,
+                            partialFilterExpression={'pair_key': {'$exists': True}})
+    collection.insert_many([{'name': 'a'}, {'name': 'b'}, {'pair_key': 'x'}])
+    with pytest.raises(DuplicateKeyError):
+        collection.insert_one({'pair_key': 'x'})
+
+
+def test_sqlite_databases_keep_documents_and_indexes(tmp_path):
+    path = str(tmp_path / 'chat.db')
+    database = embedded.Database('chat', path)
+    collection = database.get_collection('users')
+    collection.create_index([('email', ASCENDING)], name='email_1', unique=True)
+    collection.insert_one({'_id': 'alice', 'email': 'alice@example.com'})
+    collection.update_one({'_id': 'alice'}, {'$set': {'name': 'Alice'}})
+    database.close()
+
+    reopened = embedded.Database('chat', path).get_collection('users')
+    assert reopened.find_one({'_id': 'alice'}) == {'_id': 'alice', 'email': 'alice@example.com', 'name': 'Alice'}
+    assert 'email_1' in reopened.index_information()
+    with pytest.raises(DuplicateKeyError):
+        reopened.insert_one({'_id': 'bob', 'email': 'alice@example.com'})
@@ -0,0 +1,45 @@
+import uuid
+
+import db
+from conftest import auth
+
+
+def _users(count):
+    prefix = 'f' + uuid.uuid4().hex[:6]
+    names = ['{}-{}'.format(prefix, i) for i in range(count)]
+    for name in names:
+        db.save_user(name, 'password')
+    return prefix, names
+
+
+def test_friends_pages_through_a_prefix(client, make_user):
+    _, token = make_user()
+    prefix, names = _users(5)
+
+    seen, after = [], None
+    while True:
+        response = client.get('/friends', query_string={'prefix': prefix.upper(), 'limit': 2, 'after': after},
+                              headers=auth(token))
+        assert response.status_code == 200
+        page = response.get_json()
+        seen += page['friends']
+        after = page['next']
+        if after is None:
+            break
+    assert seen == names
+
+
+def test_friends_limit_is_clamped(client, make_user):
+    _, token = make_user()
+    prefix, names = _users(2)
+    page = client.get('/friends', query_string={'prefix': prefix, 'limit': 0}, headers=auth(token)).get_json()
+    assert page == {'friends': names[:1], 'next': names[0]}
+    page = client.get('/friends', query_string={'prefix': prefix, 'limit': -5, 'after': page['next']},
+                      headers=auth(token)).get_json()
+    assert page == {'friends': names[1:], 'next': None}
+
+
+def test_friends_excludes_the_current_user(client, make_user):
+    username, token = make_user()
+    page = client.get('/friends', query_string={'prefix': username}, headers=auth(token)).get_json()
+    assert page == {'friends': [], 'next': None}
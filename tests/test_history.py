@@ -0,0 +1,33 @@
+import db
+from conftest import history
+
+
+def _texts(room):
+    return [message['message'] for message in room['chat_messages']]
+
+
+def test_history_pages_backwards_and_forwards(client, make_user, make_room):
+    owner, token = make_user()
+    room_id = make_room(token)
+    for i in range(7):
+        db.add_message(room_id, owner, 'm{}'.format(i))
+
+    status, latest = history(client, token, room_id, limit=3)
+    assert status == 200
+    assert _texts(latest) == ['m4', 'm5', 'm6'] and latest['paging']['has_more']
+
+    _, older = history(client, token, room_id, limit=3, before=latest['paging']['before'])
+    assert _texts(older) == ['m1', 'm2', 'm3'] and older['paging']['has_more']
+    _, oldest = history(client, token, room_id, limit=3, before=older['paging']['before'])
+    assert _texts(oldest) == ['m0'] and not oldest['paging']['has_more']
+
+    _, newer = history(client, token, room_id, limit=2, after=oldest['paging']['after'])
+    assert _texts(newer) == ['m1', 'm2'] and newer['paging']['has_more']
+
+
+def test_history_checks_membership_and_cursors(client, make_user, make_room):
+    _, owner_token = make_user('owner')
+    _, other_token = make_user('other')
+    room_id = make_room(owner_token)
+    assert history(client, other_token, room_id)[0] == 403
+    assert history(client, owner_token, room_id, before='not-an-id')[0] == 400
@@ -0,0 +1,42 @@
+import time
+
+import pytest
+
+from conftest import auth
+from identity import ClaimsCache, RevocationList
+
+
+def test_revocations_from_other_workers_are_loaded_on_refresh():
+    stored = {}
+    revocations = RevocationList(lambda jti, expires_at: stored.update({jti: expires_at}), lambda: dict(stored),
+                                 refresh_interval=0)
+    other_worker = RevocationList(lambda jti, expires_at: stored.update({jti: expires_at}), lambda: dict(stored))
+    assert not revocations.is_revoked('a')
+    other_worker.revoke('a', time.time() + 60)
+    other_worker.revoke('expired', time.time() - 1)
+    assert revocations.is_revoked('a')
+    assert not revocations.is_revoked('expired')
+
+
+def test_claims_are_decoded_once_until_they_expire():
+    decoded = []
+
+    def decode(token):
+        decoded.append(token)
+        return {'sub': 'alice', 'exp': time.time() + (60 if token == 'fresh' else -1)}
+    claims = ClaimsCache(decode)
+    assert claims.claims('fresh')['sub'] == 'alice'
+    assert claims.claims('fresh')['sub'] == 'alice'
+    assert decoded == ['fresh']
+    with pytest.raises(ValueError):
+        claims.claims('stale')
+
+
+def test_logout_revokes_the_token_for_requests_and_sockets(client, app_module, make_user, connect):
+    _, token = make_user()
+    socket = connect(token)
+    assert client.post('/logout', headers=auth(token)).status_code == 204
+
+    assert client.get('/', headers=auth(token)).status_code == 401
+    assert not socket.is_connected()
+    assert not app_module.socketio.test_client(app_module.app, auth={'token': token}).is_connected()
@@ -0,0 +1,27 @@
+import pytest
+
+import db
+import embedded
+import manage
+
+needs_mongodb = pytest.mark.skipif(isinstance(db.chat_db, embedded.Database),
+                                   reason='explain needs MongoDB; set STORAGE_URL=mongodb://...')
+
+
+@needs_mongodb
+def test_every_query_shape_uses_an_index():
+    report = db.explain_queries()
+    assert [entry['name'] for entry in report if entry['collscan']] == []
+
+
+def test_query_shapes_cover_maintenance_and_archive_queries():
+    names = {name for name, *_ in db._query_shapes()}
+    assert {'migrate_chat_lists', 'mark_room_read', 'get_messages_since', '_archived_before',
+            '_archived_after (_id)', '_archived_after (seq)', 'expire_room_messages'} <= names
+
+
+def test_check_queries_refuses_the_embedded_engine():
+    if not isinstance(db.chat_db, embedded.Database):
+        pytest.skip('runs only on the embedded engine')
+    with pytest.raises(SystemExit, match='needs MongoDB'):
+        manage.check_queries(None)
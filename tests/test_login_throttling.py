@@ -0,0 +1,29 @@
+import uuid
+
+
+def _login(client, username, password, ip):
+    return client.post('/login', json={'username': username, 'password': password}, environ_base={'REMOTE_ADDR': ip})
+
+
+def _signup(client, username, ip):
+    return client.post('/signup', json={'username': username, 'password': 'password'}, environ_base={'REMOTE_ADDR': ip})
+
+
+def test_failed_logins_lock_the_username_only_from_that_ip(client, app_module, make_user):
+    username, _ = make_user()
+    for _ in range(app_module.login_attempts_by_user.max_attempts):
+        assert _login(client, username, 'wrong', '10.0.1.1').status_code == 401
+    assert _login(client, username, 'password', '10.0.1.1').status_code == 429
+    assert _login(client, username, 'password', '10.0.1.2').status_code == 200
+
+
+def test_every_signup_attempt_is_throttled(client, app_module):
+    limit = app_module.signup_attempts_by_ip.max_attempts
+    taken = 'taken-' + uuid.uuid4().hex[:8]
+    assert _signup(client, taken, '10.0.2.1').status_code == 200
+    assert _signup(client, taken, '10.0.2.1').status_code == 400
+    for _ in range(limit - 2):
+        assert _signup(client, 'new-' + uuid.uuid4().hex[:8], '10.0.2.1').status_code == 200
+    response = _signup(client, 'new-' + uuid.uuid4().hex[:8], '10.0.2.1')
+    assert response.status_code == 429 and int(response.headers['Retry-After']) > 0
+    assert _signup(client, 'new-' + uuid.uuid4().hex[:8], '10.0.2.2').status_code == 200
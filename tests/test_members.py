@@ -0,0 +1,32 @@
+import db
+from conftest import post
+
+
+def test_members_are_added_and_removed_in_bulk(client, make_user, make_room):
+    owner, token = make_user('owner')
+    alice, _ = make_user('alice')
+    bob, _ = make_user('bob')
+    room_id = make_room(token, members=alice)
+
+    status, result = post(client, token, '/rooms/{}/add_members'.format(room_id),
+                          {'usernames': [alice, bob, 'nobody', '']})
+    assert status == 200
+    assert result['added'] == [bob]
+    assert set(result['failed']) == {alice, 'nobody'}
+    assert {member['_id']['username'] for member in db.get_room_members(room_id)} == {owner, alice, bob}
+
+    status, result = post(client, token, '/rooms/{}/remove_members'.format(room_id),
+                          {'usernames': '{}, {}, nobody'.format(alice, bob)})
+    assert status == 200
+    assert result['removed'] == [alice, bob] and list(result['failed']) == ['nobody']
+    assert not db.is_room_member(room_id, alice)
+
+
+def test_only_admins_change_members(client, make_user, make_room):
+    _, owner_token = make_user('owner')
+    member, member_token = make_user('member')
+    room_id = make_room(owner_token, members=member)
+    status, result = post(client, member_token, '/rooms/{}/add_members'.format(room_id), {'usernames': [member]})
+    assert status == 400 and 'permission' in result['error']
+    status, _ = post(client, member_token, '/rooms/{}/remove_members'.format(room_id), {'usernames': [member]})
+    assert status == 400
@@ -0,0 +1,60 @@
+from datetime import datetime
+
+from bson import ObjectId
+
+import db
+from message_writer import DeadLetterFile, MessageWriter
+
+
+def test_failed_batch_goes_to_on_failure():
+    failed = []
+
+    def write_many(batch):
+        raise RuntimeError('database is down')
+
+    writer = MessageWriter(write_many, max_retries=2, on_failure=failed.append)
+    writer.submit({'_id': 1})
+    assert failed == [[{'_id': 1}]]
+
+
+def test_batches_are_written_in_bulk():
+    written = []
+    writer = MessageWriter(written.append, batch_size=10, flush_interval=0.01)
+    writer.start()
+    for i in range(25):
+        writer.submit({'_id': i})
+    writer.flush()
+    writer.close()
+    assert sorted(message['_id'] for batch in written for message in batch) == list(range(25))
+    assert len(written) < 25
+
+
+def test_dead_letter_file_replays_messages_once(tmp_path, app_module):
+    room_id = str(ObjectId())
+    messages = [db.build_message(room_id, 'alice', 'lost {}'.format(i)) for i in range(3)]
+    dead_letters = DeadLetterFile(str(tmp_path / 'unwritten.bson'))
+    dead_letters.save(messages[:2])
+    dead_letters.save(messages[2:])
+    # One of them did reach the database before the batch failed
+    db.add_messages(messages[:1])
+
+    assert dead_letters.replay(db.add_messages) == 3
+    assert dead_letters.replay(db.add_messages) == 0
+
+    stored = list(db.messages_collection.find({'room_id': room_id}).sort('_id', 1))
+    assert [message['message'] for message in stored] == ['lost 0', 'lost 1', 'lost 2']
+    assert isinstance(stored[0]['created_at'], datetime)
+
+
+def test_sequence_numbers_are_allocated_per_batch(app_module):
+    rooms = [str(ObjectId()), str(ObjectId())]
+    messages = [db.build_message(rooms[i % 2], 'alice', 'm{}'.format(i)) for i in range(5)]
+    db.add_messages(messages)
+    assert [message['seq'] for message in messages] == [1, 1, 2, 2, 3]
+    summaries = db.get_room_summaries(rooms)
+    assert summaries[rooms[0]]['last_seq'] == 3
+    assert summaries[rooms[0]]['last_message']['message'] == 'm4'
+
+    # A retried batch keeps the numbers it was given
+    db.add_messages(messages)
+    assert db.get_room_summaries(rooms)[rooms[0]]['last_seq'] == 3
@@ -0,0 +1,25 @@
+import metrics
+from conftest import auth
+
+
+def test_metrics_report_requests_and_db_operations(client, make_user):
+    _, token = make_user()
+    assert client.get('/', headers=auth(token)).status_code == 200
+    body = client.get('/metrics').get_data(as_text=True)
+    assert 'chat_http_request_seconds_count{method="GET",endpoint="/",status="200"}' in body
+    assert 'chat_db_operation_seconds_count{operation="get_rooms_for_user"}' in body
+
+
+def test_counters_render_in_prometheus_format():
+    counter = metrics.Counter('chat_test_total', 'A test counter', ['outcome'])
+    counter.inc('ok')
+    counter.inc('ok', amount=2)
+    metrics._metrics.remove(counter)
+    assert counter.render() == ['# HELP chat_test_total A test counter', '# TYPE chat_test_total counter',
+                                'chat_test_total{outcome="ok"} 3']
+
+
+def test_metrics_token_is_required_when_set(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'METRICS_TOKEN', 'scrape-token')
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer scrape-token'}).status_code == 200
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+import db
+
+
+def _legacy_room(count):
+    room_id = ObjectId()
+    start = datetime(2023, 1, 1)
+    db.chat_room_collection.insert_one({'_id': room_id, 'chat_list': [
+        {'sender': 'alice', 'message': 'legacy {}'.format(i), 'created_at': start + timedelta(minutes=i)}
+        for i in range(count)]})
+    return str(room_id)
+
+
+def test_migrate_chat_lists_numbers_messages_in_order(app_module):
+    room_id = _legacy_room(5)
+
+    assert db.migrate_chat_lists(batch_size=2) == 5
+
+    messages = list(db.messages_collection.find({'room_id': room_id}).sort('seq', 1))
+    assert [message['seq'] for message in messages] == [1, 2, 3, 4, 5]
+    assert [message['message'] for message in messages] == ['legacy {}'.format(i) for i in range(5)]
+    assert db.get_room_summaries([room_id])[room_id]['last_seq'] == 5
+
+
+def test_interrupted_migration_only_numbers_inserted_messages(app_module):
+    room_id = _legacy_room(4)
+    # An earlier run inserted the first two messages and stopped before numbering them
+    chat_list = db.chat_room_collection.find_one({'_id': ObjectId(room_id)})['chat_list']
+    for index, chat in enumerate(chat_list[:2]):
+        db.messages_collection.insert_one(dict(chat, room_id=room_id, legacy_index=index))
+
+    db.migrate_chat_lists()
+    # Nothing left to move, so a re-run allocates nothing
+    db.chat_room_collection.update_one({'_id': ObjectId(room_id)}, {'$set': {'chat_list': chat_list}})
+    db.migrate_chat_lists()
+
+    messages = list(db.messages_collection.find({'room_id': room_id}).sort('seq', 1))
+    assert len(messages) == 4
+    assert [message['seq'] for message in messages] == [1, 2, 3, 4]
+    assert db.get_room_summaries([room_id])[room_id]['last_seq'] == 4
+
+
+def test_legacy_index_is_indexed(app_module):
+    assert 'room_id_1_legacy_index_1' in db.messages_collection.index_information()
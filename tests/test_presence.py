@@ -0,0 +1,46 @@
+import time
+
+from conftest import auth
+from presence import PresenceTracker
+
+
+def test_changes_are_coalesced_per_room():
+    presence = PresenceTracker()
+    presence.connect('s1', 'alice')
+    presence.connect('s2', 'alice')
+    presence.connect('s3', 'bob')
+    presence.join('s1', 'room')
+    presence.join('s2', 'room')
+    presence.join('s3', 'room')
+    for _ in range(5):
+        presence.typing('s3', 'room')
+    assert presence.drain() == {'room': {'room': 'room', 'joined': ['alice', 'bob'], 'left': [], 'typing': ['bob']}}
+
+    # A reconnect between two drains is not a change; alice stays online through s2
+    presence.disconnect('s1')
+    presence.typing('s3', 'room')
+    assert presence.drain() == {}
+    presence.disconnect('s3')
+    assert presence.drain() == {'room': {'room': 'room', 'joined': [], 'left': ['bob'], 'typing': []}}
+
+
+def test_missed_heartbeats_and_typing_expire():
+    presence = PresenceTracker(heartbeat_ttl=0.05, typing_ttl=0.01)
+    presence.connect('s1', 'alice')
+    presence.join('s1', 'room')
+    presence.typing('s1', 'room')
+    time.sleep(0.06)
+    presence.expire()
+    assert presence.snapshot('room') == {'room': 'room', 'online': [], 'typing': []}
+    presence.heartbeat('s1')
+    assert presence.online('room') == ['alice']
+
+
+def test_presence_endpoint_lists_joined_sockets(client, make_user, make_room, connect):
+    owner, token = make_user()
+    room_id = make_room(token)
+    socket = connect(token)
+    socket.emit('join_room', {'room': room_id}, callback=True)
+    socket.emit('typing', {'room': room_id, 'typing': True}, callback=True)
+    response = client.get('/rooms/{}/presence'.format(room_id), headers=auth(token))
+    assert response.get_json() == {'room': room_id, 'online': [owner], 'typing': [owner]}
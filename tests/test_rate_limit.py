@@ -0,0 +1,31 @@
+import time
+
+from rate_limit import AttemptLimiter, TokenBucketLimiter
+
+
+def test_token_bucket_allows_a_burst_then_the_rate():
+    limiter = TokenBucketLimiter(rate=100, burst=2)
+    assert limiter.acquire('a') == 0
+    assert limiter.acquire('a') == 0
+    retry_after = limiter.acquire('a')
+    assert 0 < retry_after <= 0.01
+    # Keys are independent
+    assert limiter.acquire('b') == 0
+    time.sleep(retry_after)
+    assert limiter.acquire('a') == 0
+
+
+def test_token_bucket_rate_zero_disables_the_limit():
+    limiter = TokenBucketLimiter(rate=0, burst=1)
+    assert all(limiter.acquire('a') == 0 for _ in range(100))
+    assert limiter.throttled_total == 0
+
+
+def test_attempt_limiter_blocks_after_max_attempts_until_reset():
+    limiter = AttemptLimiter(max_attempts=2, window=60)
+    limiter.record('key')
+    assert limiter.retry_after('key') == 0
+    limiter.record('key')
+    assert 59 < limiter.retry_after('key') <= 60
+    limiter.reset('key')
+    assert limiter.retry_after('key') == 0
@@ -0,0 +1,74 @@
+import pytest
+from bson import ObjectId
+
+import db
+from conftest import auth, home_rooms
+
+
+def _unread(client, token, room_id):
+    return home_rooms(client, token)[room_id]['unread_count']
+
+
+def test_build_message_refuses_non_text():
+    with pytest.raises(ValueError):
+        db.build_message(str(ObjectId()), 'alice', ['not', 'text'])
+
+
+def test_new_members_and_senders_have_read_the_history(client, make_user, make_room):
+    owner, owner_token = make_user('owner')
+    member, member_token = make_user('member')
+    room_id = make_room(owner_token)
+    db.add_messages([db.build_message(room_id, owner, 'm{}'.format(i)) for i in range(3)])
+    assert _unread(client, owner_token, room_id) == 0
+
+    assert client.post('/rooms/{}/add_member/{}'.format(room_id, member), headers=auth(owner_token)).status_code == 200
+    assert _unread(client, member_token, room_id) == 0
+
+    db.add_messages([db.build_message(room_id, owner, 'after')])
+    assert _unread(client, member_token, room_id) == 1
+    assert _unread(client, owner_token, room_id) == 0
+
+
+def test_direct_rooms_are_listed_with_their_read_markers(client, make_user):
+    alice, alice_token = make_user('alice')
+    bob, bob_token = make_user('bob')
+    room_id = db.direct_room(alice, bob)
+    db.add_messages([db.build_message(room_id, alice, 'm{}'.format(i)) for i in range(3)])
+    assert _unread(client, alice_token, room_id) == 0
+    assert _unread(client, bob_token, room_id) == 3
+    assert home_rooms(client, bob_token)[room_id]['direct_to'] == bob
+
+    assert client.post('/chatRoom/{}/read'.format(room_id), headers=auth(bob_token), json={'seq': 2}).status_code == 200
+    client.post('/chatRoom/{}/read'.format(room_id), headers=auth(bob_token), json={'seq': 1})
+    assert _unread(client, bob_token, room_id) == 1
+
+
+def test_public_rooms_are_listed_and_marked_read_once_joined(client, make_user, make_room, connect):
+    owner, owner_token = make_user('owner')
+    _, token = make_user('reader')
+    room_id = make_room(owner_token, room_type='PublicGroup')
+    db.add_messages([db.build_message(room_id, owner, 'm{}'.format(i)) for i in range(2)])
+    assert _unread(client, owner_token, room_id) == 0
+    assert room_id not in home_rooms(client, token)
+    assert client.post('/chatRoom/{}/read'.format(room_id), headers=auth(token), json={'seq': 2}).status_code == 403
+
+    connect(token).emit('join_room', {'room': room_id}, callback=True)
+    assert _unread(client, token, room_id) == 0
+    db.add_messages([db.build_message(room_id, owner, 'after')])
+    assert _unread(client, token, room_id) == 1
+    assert client.post('/chatRoom/{}/read'.format(room_id), headers=auth(token), json={'seq': 3}).status_code == 200
+    assert _unread(client, token, room_id) == 0
+    assert db.read_markers_collection.count_documents({'_id.room_id': room_id}) == 0
+
+
+def test_mark_read_event_reports_non_members(make_user, make_room, connect):
+    owner, owner_token = make_user('owner')
+    room_id = make_room(owner_token)
+    socket = connect(owner_token)
+    socket.emit('join_room', {'room': room_id}, callback=True)
+    assert socket.emit('mark_read', {'room': room_id, 'seq': 1}, callback=True) == {'ok': True}
+    # Removed from the room after joining
+    db.room_members_collection.delete_one({'_id': {'room_id': ObjectId(room_id), 'username': owner}})
+    db.invalidate_membership(room_id, owner)
+    assert socket.emit('mark_read', {'room': room_id, 'seq': 2}, callback=True) == \
+        {'error': 'You are not a member of this room.'}
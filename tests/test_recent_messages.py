@@ -0,0 +1,62 @@
+import time
+from datetime import datetime
+
+from recent_messages import RecentMessages
+
+
+def _message(seq):
+    return {'id': '{:024x}'.format(seq), 'seq': seq, 'sender': 'alice', 'message': 'm{}'.format(seq),
+            'created_at': datetime(2024, 1, 1)}
+
+
+def _page(messages, has_more=False):
+    return {'messages': messages, 'has_more': has_more}
+
+
+def test_latest_page_is_served_once_warm():
+    buffer = RecentMessages(per_room=10)
+    assert buffer.latest('room', 2) is None
+    buffer.warm('room', _page([_message(1), _message(2)]))
+    buffer.add('room', _message(3))
+    page = buffer.latest('room', 2)
+    assert [message['seq'] for message in page['messages']] == [2, 3]
+    assert page['has_more'] is True
+
+
+def test_ttl_makes_warm_buffers_expire():
+    buffer = RecentMessages(per_room=10, ttl=0.05)
+    buffer.warm('room', _page([_message(1)]))
+    assert buffer.latest('room', 1) is not None
+    time.sleep(0.06)
+    assert buffer.latest('room', 1) is None
+
+
+def test_buffers_are_evicted_by_size():
+    buffer = RecentMessages(per_room=10, max_bytes=1000)
+    buffer.warm('a', _page([_message(1)]))
+    buffer.warm('b', _page([_message(1)]))
+    buffer.warm('c', _page([_message(1)]))
+    assert buffer.latest('a', 1) is None
+    assert buffer.latest('c', 1) is not None
+
+
+def test_since_serves_only_a_contiguous_run():
+    buffer = RecentMessages(per_room=10)
+    buffer.warm('room', _page([_message(1), _message(2)], has_more=True))
+    buffer.add('room', _message(3))
+    assert [message['seq'] for message in buffer.since('room', 1, 10)['messages']] == [2, 3]
+    # seq 0 is not buffered, and seq 4 went through another worker
+    assert buffer.since('room', -1, 10) is None
+    buffer.add('room', _message(5))
+    assert buffer.since('room', 1, 10) is None
+    assert buffer.since('room', 1, 1)['messages'] == [_message(2)]
+
+
+def test_since_leaves_out_unwritten_messages():
+    buffer = RecentMessages(per_room=10)
+    buffer.warm('room', _page([_message(1)]))
+    pending = dict(_message(2), seq=None)
+    buffer.add('room', pending)
+    assert buffer.since('room', 1, 10)['messages'] == []
+    buffer.sequenced('room', {pending['id']: 2})
+    assert [message['seq'] for message in buffer.since('room', 1, 10)['messages']] == [2]
@@ -0,0 +1,18 @@
+from conftest import rooms_list
+
+
+def test_private_groups_are_listed_for_members_only(client, make_user, make_room):
+    owner, owner_token = make_user('owner')
+    member, member_token = make_user('member')
+    _, outsider_token = make_user('outsider')
+    room_id = make_room(owner_token, members=member)
+    assert rooms_list(client, owner_token, 'PrivateGroup') == [room_id]
+    assert rooms_list(client, member_token, 'PrivateGroup') == [room_id]
+    assert rooms_list(client, outsider_token, 'PrivateGroup') == []
+
+
+def test_public_groups_are_paginated_by_id(client, make_user, make_room):
+    _, token = make_user()
+    room_ids = [make_room(token, room_type='PublicGroup', name='public {}'.format(i)) for i in range(3)]
+    assert rooms_list(client, token, 'PublicGroup', after=room_ids[0], limit=2) == room_ids[1:]
+    assert rooms_list(client, token, 'PublicGroup', after=room_ids[2]) == []
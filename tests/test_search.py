@@ -0,0 +1,37 @@
+from bson import ObjectId
+
+import db
+from conftest import search
+
+
+def test_search_finds_messages_with_context(client, make_user, make_room):
+    owner, token = make_user()
+    room_id = make_room(token)
+    texts = ['good morning', 'lunch at noon?', 'sure', 'see you at lunch', 'bye']
+    db.add_messages([db.build_message(room_id, owner, text) for text in texts])
+
+    status, result = search(client, token, room_id, q='lunch', context=1)
+    assert status == 200
+    assert sorted(hit['message']['message'] for hit in result['hits']) == ['lunch at noon?', 'see you at lunch']
+    hit = next(hit for hit in result['hits'] if hit['message']['message'] == 'lunch at noon?')
+    assert [message['message'] for message in hit['before']] == ['good morning']
+    assert [message['message'] for message in hit['after']] == ['sure']
+
+    _, result = search(client, token, room_id, q='lunch', limit=1)
+    assert len(result['hits']) == 1 and result['has_more']
+    _, result = search(client, token, room_id, q='lunch', sender='someone-else')
+    assert result['hits'] == []
+
+
+def test_search_requires_text_and_membership(client, make_user, make_room):
+    _, owner_token = make_user('owner')
+    _, other_token = make_user('other')
+    room_id = make_room(owner_token)
+    assert search(client, owner_token, room_id, q=' ')[0] == 400
+    assert search(client, other_token, room_id, q='hello')[0] == 403
+
+
+def test_search_reports_unknown_rooms(client, make_user):
+    _, token = make_user()
+    assert search(client, token, str(ObjectId()), q='hello')[0] == 404
+    assert search(client, token, 'not-an-id', q='hello')[0] == 404
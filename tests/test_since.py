@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson import ObjectId
+
+import db
+from conftest import auth
+
+
+def _store(room_id, seq, object_id=None):
+    db.messages_collection.insert_one({'_id': object_id or ObjectId(), 'room_id': room_id, 'seq': seq,
+                                       'sender': 'alice', 'message': 'm{}'.format(seq), 'created_at': datetime.now()})
+
+
+def test_since_stops_at_a_recent_gap(app_module):
+    room_id = str(ObjectId())
+    for seq in (1, 2, 4):
+        _store(room_id, seq)
+    page = db.get_messages_since(room_id, 0)
+    assert [message['seq'] for message in page['messages']] == [1, 2]
+    assert page['last_seq'] == 2 and page['has_more'] is False
+
+    _store(room_id, 3)
+    assert [message['seq'] for message in db.get_messages_since(room_id, 2)['messages']] == [3, 4]
+
+
+def test_since_skips_an_old_gap(app_module):
+    room_id = str(ObjectId())
+    _store(room_id, 1, ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(hours=2)))
+    _store(room_id, 3, ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(hours=1)))
+    page = db.get_messages_since(room_id, 0)
+    assert [message['seq'] for message in page['messages']] == [1, 3]
+
+
+@pytest.mark.parametrize('room_id', [str(ObjectId()), 'not-an-id'])
+def test_since_reports_unknown_rooms(client, make_user, room_id):
+    _, token = make_user()
+    response = client.get('/chatRoom/{}/since/0'.format(room_id), headers=auth(token))
+    assert response.status_code == 404
@@ -0,0 +1,90 @@
+import pytest
+
+from conftest import auth, received
+
+
+def test_send_message_requires_a_joined_room(make_user, make_room, connect):
+    _, token = make_user()
+    room_id = make_room(token)
+    socket = connect(token)
+    assert socket.emit('send_message', {'room': room_id, 'message': 'hi'}, callback=True) == \
+        {'error': 'You have not joined this room.'}
+    assert socket.emit('join_room', {'room': room_id}, callback=True) == {'ok': True}
+    assert socket.emit('send_message', {'room': room_id, 'message': 'hi'}, callback=True)['ok']
+
+
+@pytest.mark.parametrize('data', [None, 'text', ['room'], 5])
+def test_events_with_a_non_object_payload_are_refused(make_user, connect, data):
+    _, token = make_user()
+    socket = connect(token)
+    for event in ('send_message', 'typing', 'mark_read', 'sync', 'leave_room'):
+        assert socket.emit(event, data, callback=True) == {'error': 'You have not joined this room.'}
+    assert 'error' in socket.emit('join_room', data, callback=True)
+
+
+@pytest.mark.parametrize('message', [5, None, '', '   ', ['hi'], 'x' * 4001])
+def test_invalid_messages_are_refused(make_user, make_room, connect, message):
+    _, token = make_user()
+    room_id = make_room(token)
+    socket = connect(token)
+    socket.emit('join_room', {'room': room_id}, callback=True)
+    ack = socket.emit('send_message', {'room': room_id, 'message': message}, callback=True)
+    assert 'characters' in ack['error']
+
+
+def test_removed_member_is_unsubscribed(client, make_user, make_room, connect):
+    owner, owner_token = make_user('owner')
+    member, member_token = make_user('member')
+    room_id = make_room(owner_token, members=member)
+    owner_socket, member_socket = connect(owner_token), connect(member_token)
+    for socket in (owner_socket, member_socket):
+        assert socket.emit('join_room', {'room': room_id}, callback=True) == {'ok': True}
+
+    response = client.post('/rooms/{}/remove_member/{}'.format(room_id, member), headers=auth(owner_token))
+    assert response.status_code == 200
+    member_socket.get_received()
+
+    owner_socket.emit('send_message', {'room': room_id, 'message': 'members only'}, callback=True)
+    assert received(member_socket, 'receive_message') == []
+    assert member_socket.emit('send_message', {'room': room_id, 'message': 'still here?'}, callback=True) == \
+        {'error': 'You have not joined this room.'}
+    assert member_socket.emit('join_room', {'room': room_id}, callback=True) == \
+        {'error': 'You are not a member of this room.'}
+
+
+def test_sequence_numbers_are_announced_once_written(client, app_module, make_user, make_room, connect):
+    _, token = make_user()
+    room_id = make_room(token)
+    socket, plain_socket = connect(token), connect(token)
+    socket.emit('join_room', {'room': room_id, 'seqs': True}, callback=True)
+    plain_socket.emit('join_room', {'room': room_id}, callback=True)
+    ids = [socket.emit('send_message', {'room': room_id, 'message': text}, callback=True)['id']
+           for text in ('one', 'two')]
+    app_module.message_writer.flush()
+
+    packets = socket.get_received()
+    assert [packet['args'][0]['id'] for packet in packets if packet['name'] == 'receive_message'] == ids
+    seqs = {}
+    for packet in packets:
+        if packet['name'] == 'message_seqs':
+            seqs.update(packet['args'][0]['seqs'])
+    assert [seqs[message_id] for message_id in ids] == [1, 2]
+    # Sockets that did not ask for seqs only get the messages
+    names = [packet['name'] for packet in plain_socket.get_received()]
+    assert 'message_seqs' not in names and names.count('receive_message') == 2
+
+    page = client.get('/chatRoom/{}/since/0'.format(room_id), headers=auth(token)).get_json()
+    assert [message['message'] for message in page['messages']] == ['one', 'two']
+    assert page['last_seq'] == 2
+
+
+def test_send_message_is_rate_limited_per_connection(app_module, make_user, make_room, connect):
+    _, token = make_user()
+    room_id = make_room(token)
+    socket = connect(token)
+    socket.emit('join_room', {'room': room_id}, callback=True)
+    burst = int(app_module.message_rate_per_connection.burst)
+    acks = [socket.emit('send_message', {'room': room_id, 'message': 'm{}'.format(i)}, callback=True)
+            for i in range(burst + 1)]
+    assert all(ack.get('ok') for ack in acks[:burst])
+    assert acks[-1]['error'] == 'Too many messages.' and acks[-1]['retry_after'] > 0
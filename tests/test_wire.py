@@ -0,0 +1,46 @@
+import gzip
+import json
+
+import msgpack
+
+import db
+import wire
+from conftest import auth
+
+
+def _room_with_history(make_user, make_room, count):
+    owner, token = make_user()
+    room_id = make_room(token)
+    db.add_messages([db.build_message(room_id, owner, 'message number {}'.format(i)) for i in range(count)])
+    return room_id, token
+
+
+def test_compact_history_sends_columns_once(client, make_user, make_room):
+    room_id, token = _room_with_history(make_user, make_room, 3)
+    page = client.get('/chatRoom/{}/since/0?format=compact'.format(room_id), headers=auth(token)).get_json()
+    assert page['messages']['columns'] == wire.MESSAGE_COLUMNS
+    seq = wire.MESSAGE_COLUMNS.index('seq')
+    assert [row[seq] for row in page['messages']['rows']] == [1, 2, 3]
+
+
+def test_msgpack_history_is_negotiated_from_accept(client, make_user, make_room):
+    room_id, token = _room_with_history(make_user, make_room, 2)
+    response = client.get('/chatRoom/{}/since/0'.format(room_id), headers=dict(auth(token), Accept=wire.MSGPACK_MIMETYPE))
+    assert response.mimetype == wire.MSGPACK_MIMETYPE
+    assert len(msgpack.unpackb(response.get_data())['messages']['rows']) == 2
+
+
+def test_large_responses_are_gzipped_for_clients_that_accept_it(client, make_user, make_room):
+    room_id, token = _room_with_history(make_user, make_room, 50)
+    path = '/chatRoom/{}/since/0'.format(room_id)
+    plain = client.get(path, headers=auth(token))
+    assert 'Content-Encoding' not in plain.headers
+    compressed = client.get(path, headers=dict(auth(token), **{'Accept-Encoding': 'gzip'}))
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(compressed.get_data())) == plain.get_json()
+
+
+def test_broadcast_frames_follow_the_broadcast_columns():
+    payload = {'room': 'r', 'id': 'i', 'username': 'alice', 'message': 'hi'}
+    assert wire.broadcast_frame(payload, 'json') is payload
+    assert wire.broadcast_frame(payload, 'compact') == ['r', 'i', 'alice', 'hi']
@@ -1,4 +1,4 @@
-from werkzeug.security import check_password_hash
+from passwords import check_password
 
 
 class User:
@@ -23,4 +23,4 @@ class User:
         return self.username
 
     def check_password(self, password_input):
-        return check_password_hash(self.password, password_input)
\ No newline at end of file
+        return check_password(self.password, password_input)
\ No newline at end of file
@@ -0,0 +1,83 @@
+"""
+Wire formats for message history and broadcasts.
+
+Clients pick a format per request (`?format=` or the Accept header) or per socket
+connection (`auth.format`):
+  - json: the default, one object per message
+  - compact: columnar JSON, message fields listed once in `columns` and each
+    message sent as a row
+  - msgpack: the compact layout encoded with MessagePack
+"""
+from datetime import datetime
+import gzip
+
+from flask import Response, jsonify
+import msgpack
+
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+MESSAGE_COLUMNS = ['id', 'seq', 'sender', 'message', 'created_at']
+# Field order of a compact broadcast frame
+BROADCAST_COLUMNS = ['room', 'id', 'username', 'message']
+FORMATS = ('json', 'compact', 'msgpack')
+COMPRESSIBLE_MIMETYPES = ('application/json', MSGPACK_MIMETYPE)
+
+
+def negotiate(requested=None, accept=''):
+    """
+    The wire format for a client: an explicit `requested` name wins over the Accept header.
+    """
+    if requested not in FORMATS:
+        requested = 'msgpack' if MSGPACK_MIMETYPE in (accept or '') else 'json'
+    return requested
+
+
+def columnar(messages):
+    return {'columns': MESSAGE_COLUMNS, 'rows': [[message.get(column) for column in MESSAGE_COLUMNS] for message in messages]}
+
+
+def encode_messages(messages, wire_format):
+    return messages if wire_format == 'json' else columnar(messages)
+
+
+def _msgpack_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError("Cannot serialize {!r}".format(value))
+
+
+def packb(payload):
+    return msgpack.packb(payload, default=_msgpack_default)
+
+
+def response(payload, wire_format, status=200):
+    if wire_format == 'msgpack':
+        return Response(packb(payload), status=status, mimetype=MSGPACK_MIMETYPE)
+    return jsonify(payload), status
+
+
+def broadcast_frame(payload, wire_format):
+    """
+    A receive_message payload ({'room', 'id', 'username', 'message'}) in the
+    client's format: a row of BROADCAST_COLUMNS for compact, or that row as msgpack bytes.
+    """
+    if wire_format == 'json':
+        return payload
+    row = [payload[column] for column in BROADCAST_COLUMNS]
+    return packb(row) if wire_format == 'msgpack' else row
+
+
+def gzip_response(response, accept_encoding, min_size):
+    """
+    Gzip a JSON/msgpack response of at least `min_size` bytes when the client accepts it.
+    """
+    if ('gzip' not in (accept_encoding or '') or response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=5))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response